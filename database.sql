@@ -2,6 +2,7 @@
 -- Generated from DBML diagram
 
 -- Drop tables if they exist (in reverse order of dependencies)
+DROP TABLE IF EXISTS id_blocks;
 DROP TABLE IF EXISTS messages;
 DROP TABLE IF EXISTS room_members;
 DROP TABLE IF EXISTS rooms;
@@ -26,7 +27,9 @@ CREATE TABLE rooms (
 CREATE TABLE room_members (
     room_id INTEGER NOT NULL,
     user_id INTEGER NOT NULL,
+    slot SMALLINT, -- 1 or 2 in DM rooms (at most 2 members), NULL in groups
     UNIQUE (room_id, user_id),
+    UNIQUE (room_id, slot),
     FOREIGN KEY (room_id) REFERENCES rooms(id) ON DELETE CASCADE,
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
 );
@@ -42,10 +45,17 @@ CREATE TABLE messages (
     FOREIGN KEY (sender_id) REFERENCES users(id) ON DELETE CASCADE
 );
 
+-- Create id_blocks table (next free id per table, reserved in blocks by idgen.py)
+CREATE TABLE id_blocks (
+    name VARCHAR(50) PRIMARY KEY,
+    next_id BIGINT NOT NULL
+);
+
 -- Create indexes for better query performance
 CREATE INDEX idx_room_members_room_id ON room_members(room_id);
 CREATE INDEX idx_room_members_user_id ON room_members(user_id);
-CREATE INDEX idx_messages_room_id ON messages(room_id);
+-- (room_id, id) backs keyset pagination of room history (and room_id lookups)
+CREATE INDEX idx_messages_room_id_id ON messages(room_id, id);
 CREATE INDEX idx_messages_sender_id ON messages(sender_id);
 CREATE INDEX idx_messages_created_at ON messages(created_at);
 
@@ -71,16 +81,16 @@ INSERT INTO rooms (id, codename, type, created_at) VALUES
 
 -- Insert room members
 -- Room 1 (DM: Alice & Bob)
-INSERT INTO room_members (room_id, user_id) VALUES
-(1, 1), (1, 2);
+INSERT INTO room_members (room_id, user_id, slot) VALUES
+(1, 1, 1), (1, 2, 2);
 
 -- Room 2 (DM: Alice & Charlie)
-INSERT INTO room_members (room_id, user_id) VALUES
-(2, 1), (2, 3);
+INSERT INTO room_members (room_id, user_id, slot) VALUES
+(2, 1, 1), (2, 3, 2);
 
 -- Room 3 (DM: Bob & Diana)
-INSERT INTO room_members (room_id, user_id) VALUES
-(3, 2), (3, 4);
+INSERT INTO room_members (room_id, user_id, slot) VALUES
+(3, 2, 1), (3, 4, 2);
 
 -- Room 4 (Group: Alice, Bob, Charlie)
 INSERT INTO room_members (room_id, user_id) VALUES
@@ -145,3 +155,6 @@ INSERT INTO messages (id, room_id, sender_id, content, created_at) VALUES
 SELECT setval('users_id_seq', (SELECT MAX(id) FROM users));
 SELECT setval('rooms_id_seq', (SELECT MAX(id) FROM rooms));
 SELECT setval('messages_id_seq', (SELECT MAX(id) FROM messages));
+
+-- Room ids come from id_blocks (the codename is derived from the id before the insert)
+INSERT INTO id_blocks (name, next_id) SELECT 'rooms', COALESCE(MAX(id), 0) + 1 FROM rooms;
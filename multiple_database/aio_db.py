@@ -0,0 +1,231 @@
+# Async counterpart of db.py for the ASGI entry point (asgi.py)
+import asyncio
+import inspect
+import logging
+from contextlib import asynccontextmanager, nullcontext
+from functools import wraps
+
+import psycopg
+from psycopg import AsyncConnection
+from psycopg.pq import TransactionStatus
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from quart import g, has_request_context
+from config import DB_POOL_CONFIG, DB_PIPELINE, SHARD_ROUTING, SHARD_DB_CONFIGS
+from db import prepare_flag, get_prepare_stats, configure_connection, route, connection_kwargs, pool_stats
+
+logger = logging.getLogger(__name__)
+
+_pools = {}  # node -> pool (see db.route)
+
+async def _configure_connection(conn):
+    """Same adapter setup as the sync pool (stable int8 parameter types)"""
+    configure_connection(conn)
+
+async def _check_connection(conn):
+    """Health check run on every checkout; a broken connection is discarded"""
+    await conn.set_autocommit(True)
+    try:
+        await conn.execute("SELECT 1")
+    finally:
+        await conn.set_autocommit(False)
+
+async def open_pool(shard=None):
+    """Open the async connection pool of a shard's node (must run inside the event loop)"""
+    node = route(shard)
+    if node not in _pools:
+        pool = AsyncConnectionPool(
+            kwargs=connection_kwargs(node),
+            connection_class=AsyncConnection,
+            min_size=DB_POOL_CONFIG['min_size'],
+            max_size=DB_POOL_CONFIG['max_size'],
+            max_idle=DB_POOL_CONFIG['max_idle'],
+            timeout=DB_POOL_CONFIG['timeout'],
+            configure=_configure_connection,
+            check=_check_connection,
+            name='chat_async_pool' if node == 'proxy' else f'chat_async_pool_ds_{node}',
+            open=False
+        )
+        _pools[node] = pool
+        await pool.open()
+    return _pools[node]
+
+async def open_pools():
+    """Open the pools of every node statements can be routed to"""
+    await open_pool()
+    if SHARD_ROUTING == 'direct':
+        await asyncio.gather(*(open_pool(shard) for shard in range(len(SHARD_DB_CONFIGS))))
+
+async def close_pool():
+    """Close every async connection pool"""
+    pools = list(_pools.values())
+    _pools.clear()
+    for pool in pools:
+        await pool.close()
+
+def get_pool(shard=None):
+    """Get the async pool of a shard's node opened by open_pools()"""
+    pool = _pools.get(route(shard))
+    if pool is None:
+        raise RuntimeError('Async pool is not open; call open_pools() first')
+    return pool
+
+def get_pool_stats():
+    """Get connection pool usage (see db.get_pool_stats)"""
+    stats = pool_stats(get_pool())
+    if SHARD_ROUTING == 'direct':
+        stats['shards'] = {f'ds_{node}': pool_stats(pool) for node, pool in sorted(_pools.items())}
+    return stats
+
+# ============ REQUEST-SCOPED UNIT OF WORK ============
+
+def init_app(app):
+    """Open the pool with the server and give every request one connection and transaction"""
+    app.before_serving(open_pools)
+    app.after_serving(close_pool)
+    app.after_request(_finish_request_transaction)
+    app.teardown_request(_release_request_connection)
+
+def read_only(f):
+    """Decorator for routes that never write: the request transaction is not committed"""
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        g.db_read_only = True
+        return await f(*args, **kwargs)
+    return decorated_function
+
+async def _get_request_connection(shard=None):
+    """Get the connection bound to the current request on a shard's node,
+    checking one out on first use
+    """
+    node = route(shard)
+    conns = g.setdefault('db_conns', {})
+    conn = conns.get(node)
+    if conn is None:
+        conn = conns[node] = await get_pool(shard).getconn()
+    return conn
+
+def on_commit(callback):
+    """Run callback() once the request transaction has committed (see db.on_commit)
+    A callback may return an awaitable; it is awaited before the response is sent
+    """
+    if has_request_context():
+        g.setdefault('db_on_commit', []).append(callback)
+    else:
+        callback()
+
+async def _finish_request_transaction(response):
+    """Commit the request transaction once; roll back error responses and read-only routes
+    (each node in turn in direct mode, see db._finish_request_transaction)
+    """
+    conns = g.get('db_conns', {})
+    callbacks = g.pop('db_on_commit', [])
+    if g.get('db_read_only') or response.status_code >= 400:
+        for conn in conns.values():
+            await conn.rollback()
+        return response
+    for conn in conns.values():
+        await conn.commit()
+    for callback in callbacks:
+        try:
+            result = callback()
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            # already committed: the response stays a success (see db._finish_request_transaction)
+            logger.exception('on_commit callback %r failed', callback)
+    return response
+
+async def _release_request_connection(exc=None):
+    """Return the request connections to their pools, rolling back anything left open"""
+    for node, conn in g.pop('db_conns', {}).items():
+        try:
+            if conn.info.transaction_status != TransactionStatus.IDLE:
+                await conn.rollback()
+        except psycopg.Error:
+            pass  # broken connection: the pool discards it on return
+        finally:
+            await _pools[node].putconn(conn)
+
+@asynccontextmanager
+async def get_connection(shard=None):
+    """Get a connection to a shard's node for the current unit of work (see db.get_connection)"""
+    if has_request_context():
+        yield await _get_request_connection(shard)
+    else:
+        async with get_pool(shard).connection() as conn:
+            yield conn
+
+async def execute_query(query, params=None, fetch_one=False, fetch_all=False, prepare=False, shard=None):
+    """Execute a query and optionally fetch results (prepare=True for hot statements)"""
+    async with get_connection(shard) as conn:
+        async with conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute(query, params, prepare=prepare_flag(conn, query, prepare))
+
+            if fetch_one:
+                return await cursor.fetchone()
+            elif fetch_all:
+                return await cursor.fetchall()
+            return None
+
+async def execute_detached(query, params=None, fetch_one=False, fetch_all=False, shard=None):
+    """Execute one statement in its own short transaction (see db.execute_detached)"""
+    async with get_pool(shard).connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute(query, params)
+            if fetch_one:
+                return await cursor.fetchone()
+            if fetch_all:
+                return await cursor.fetchall()
+            return None
+
+async def execute_insert(query, params=None, prepare=False, shard=None):
+    """Execute insert and return the inserted id using RETURNING"""
+    async with get_connection(shard) as conn:
+        async with conn.cursor(row_factory=dict_row) as cursor:
+            query = query + " RETURNING id"
+            await cursor.execute(query, params, prepare=prepare_flag(conn, query, prepare))
+            result = await cursor.fetchone()
+            return result['id'] if result else None
+
+async def execute_batch(statements, prepare=False, detached=False, shard=None):
+    """Execute several independent statements with a single network flush (see db.execute_batch)"""
+    async with get_pool(shard).connection() if detached else get_connection(shard) as conn:
+        use_pipeline = DB_PIPELINE and psycopg.AsyncPipeline.is_supported()
+        cursors = []
+        try:
+            async with conn.pipeline() if use_pipeline else nullcontext():
+                for query, params, fetch in statements:
+                    cursor = conn.cursor(row_factory=dict_row)
+                    cursors.append(cursor)
+                    await cursor.execute(query, params, prepare=prepare_flag(conn, query, prepare))
+
+            results = []
+            for cursor, (_, _, fetch) in zip(cursors, statements):
+                if fetch == 'one':
+                    results.append(await cursor.fetchone())
+                elif fetch == 'all':
+                    results.append(await cursor.fetchall())
+                else:
+                    results.append(None)
+            return results
+        finally:
+            for cursor in cursors:
+                await cursor.close()
+
+async def execute_routed(statements, prepare=False):
+    """execute_batch for statements that may live on different shards (see
+    db.execute_routed); the nodes are queried concurrently
+    """
+    by_node = {}
+    for index, (query, params, fetch, shard) in enumerate(statements):
+        by_node.setdefault(route(shard), (shard, []))[1].append((index, (query, params, fetch)))
+    batches = await asyncio.gather(*(
+        execute_batch([statement for _, statement in indexed], prepare=prepare, shard=shard)
+        for shard, indexed in by_node.values()
+    ))
+    results = [None] * len(statements)
+    for (_, indexed), batch in zip(by_node.values(), batches):
+        for (index, _), result in zip(indexed, batch):
+            results[index] = result
+    return results
@@ -0,0 +1,19 @@
+# Async counterpart of idgen.py for the ASGI entry point (asgi.py)
+# Same blocks and counters; one task reserves a new block while the others wait
+import asyncio
+from aio_db import execute_detached
+from idgen import reserve_block_statement, take_id, add_block, _lock, get_idgen_stats
+
+_reserving = asyncio.Lock()
+
+async def next_id(name):
+    """Get a new id for table `name`"""
+    async with _reserving:
+        with _lock:
+            new_id = take_id(name)
+        if new_id is None:
+            rows = await execute_detached(*reserve_block_statement(name), fetch_all=True)
+            with _lock:
+                add_block(name, rows)
+                new_id = take_id(name)
+        return new_id
@@ -0,0 +1,428 @@
+# Async counterpart of models.py for the ASGI entry point (asgi.py)
+# Same functions and SQL (imported from models.py), awaiting aio_db instead of db
+import asyncio
+from aio_db import execute_query, execute_insert, execute_batch, execute_detached, execute_routed, on_commit
+from aio_notify import notify_message, notify_messages
+from config import DB_NOTIFY, CODENAME_LEGACY_LOOKUP, MEMBER_SHARDING
+from models import (
+    CREATE_USER_SQL, COPY_USER_SQL, USERS_BY_IDS_SQL, USER_BY_ID_SQL, USER_BY_USERNAME_SQL, DELETE_USER_SQL,
+    ROOM_BY_ID_SQL, ROOM_BY_CODENAME_SQL, ROOMS_BY_USER_SQL,
+    JOIN_ROOM_SQL, join_room_statements, REMOVE_ROOM_MEMBER_SQL, MEMBER_ROOM_IDS_SQL,
+    ROOM_MEMBERS_SQL, ROOM_MEMBER_COUNT_SQL,
+    CREATE_MESSAGE_SQL, INGEST_MESSAGES_SQL, message_by_id_statement, insert_messages_statements, insert_messages_statement, new_message,
+    message_shard, message_write_shards, shard_room_ids, latest_messages_statements,
+    messages_page_statement, chronological, remember_member_rooms, has_member,
+    messages_read_statement, messages_read_result, restore_users, deleted_user_commands,
+    restore_member_rooms, restore_room_buffer, share_room_buffer_commands,
+    directory_shard, replicate_statements, create_room_statements,
+    member_shard, members_shard, members_write_shards, join_copy_statements, leave_copy_statements
+)
+from aio_singleflight import coalesced
+from codename import encode_codename, decode_codename
+import aio_shared_cache as shared_cache
+import aio_idgen as idgen
+import aio_snowflake as snowflake
+import aio_ingest as ingest
+import cache
+from datetime import datetime
+
+# ============ USER FUNCTIONS ============
+
+async def create_user(username):
+    """Create a new user; returns None if the username is taken (see models.create_user)"""
+    user = (await idgen.next_id('users'), username, datetime.now())
+    if await execute_insert(CREATE_USER_SQL, user) is None:
+        return None
+    await execute_routed(replicate_statements(COPY_USER_SQL, user))
+    return user[0]
+
+async def get_users_by_ids(user_ids):
+    """Get {user_id: user row, or None if deleted} for many users (see models.get_users_by_ids)"""
+    users, missing = cache.get_cached_users(user_ids)
+    if missing:
+        shared = (await shared_cache.get_many(users=missing))[0]
+        users.update(restore_users(shared))
+        missing = [user_id for user_id in missing if user_id not in shared]
+    if missing:
+        rows = await execute_query(USERS_BY_IDS_SQL, (missing,), fetch_all=True, prepare=True, shard=directory_shard())
+        fetched = cache.set_users(rows, missing)
+        await shared_cache.set_users(fetched)
+        users.update(fetched)
+    return users
+
+async def get_user_by_id(user_id):
+    """Get user by ID (user directory cache)"""
+    return (await get_users_by_ids([user_id]))[user_id]
+
+async def get_user_by_username(username):
+    """Get user by username"""
+    return await execute_query(USER_BY_USERNAME_SQL, (username,), fetch_one=True, shard=directory_shard())
+
+async def username_exists(username):
+    """Check if username already exists"""
+    user = await get_user_by_username(username)
+    return user is not None
+
+async def delete_user(user_id):
+    """Delete a user"""
+    rooms = await execute_query(MEMBER_ROOM_IDS_SQL, (user_id,), fetch_all=True, shard=member_shard(user_id)) if shared_cache.enabled() else []
+    await execute_routed([(DELETE_USER_SQL, (user_id,), None, None), *replicate_statements(DELETE_USER_SQL, (user_id,))])
+    forget_member_rooms(user_id)
+    cache.invalidate_user(user_id)
+    on_commit(lambda: cache.set_users([], [user_id]))  # remember it as deleted
+    on_commit(cache.clear_room_buffers)  # their messages were deleted with them
+    on_commit(lambda: shared_cache.drop_member_rooms(user_id, deleted_user_commands(user_id, rooms)))
+
+# ============ ROOM FUNCTIONS ============
+
+async def create_room(room_type, creator_id):
+    """Create a new room and add creator as member, in one round trip (see models.create_room)"""
+    room_id = await idgen.next_id('rooms')
+    codename = encode_codename(room_id)
+    await execute_routed(create_room_statements(room_id, codename, room_type, creator_id), prepare=True)
+    forget_member_rooms(creator_id)
+    on_commit(lambda: shared_cache.add_member_room(creator_id, room_id))
+    return room_id, codename
+
+@coalesced
+async def get_room_by_id(room_id):
+    """Get room by ID (shared cache first: rooms never change)"""
+    room = (await shared_cache.get_many(rooms=[room_id]))[1].get(room_id)
+    if room is None:
+        room = await execute_query(ROOM_BY_ID_SQL, (room_id,), fetch_one=True, shard=directory_shard(room_id))
+        await shared_cache.set_room(room)
+    return room
+
+async def get_room_by_codename(codename):
+    """Get room by codename (see models.get_room_by_codename)"""
+    codename = codename.upper()
+    room_id = decode_codename(codename)
+    if room_id is not None:
+        room = await get_room_by_id(room_id)
+        if room and room['codename'] == codename:
+            return room
+    if not CODENAME_LEGACY_LOOKUP:
+        return None
+    return await execute_query(ROOM_BY_CODENAME_SQL, (codename,), fetch_one=True, shard=directory_shard())
+
+async def get_rooms_by_user(user_id):
+    """Get all rooms for a user (also refreshes the membership cache)"""
+    rooms = await execute_query(ROOMS_BY_USER_SQL, (user_id,), fetch_all=True, shard=member_shard(user_id)) or []
+    await shared_cache.set_member_rooms(user_id, cache.set_member_rooms(user_id, (room['id'] for room in rooms)))
+    return rooms
+
+# ============ ROOM MEMBER FUNCTIONS ============
+
+async def join_room(codename, user_id):
+    """Join a room by codename in one statement (see models.join_room)"""
+    shard, mirrors, statements = None, (), join_room_statements(codename, user_id)
+    if MEMBER_SHARDING:
+        found = await get_room_by_codename(codename)
+        if found is None:
+            return None
+        shard, *mirrors = members_write_shards(found['id'])
+        statements = [(JOIN_ROOM_SQL, (found['id'], found['codename'], user_id, user_id))]
+    room = None
+    for query, params in statements:
+        room = await execute_query(query, params, fetch_one=True, prepare=True, shard=shard)
+        if room:
+            break
+    if room and room['status'] == 'joined':
+        if MEMBER_SHARDING:
+            await execute_routed(join_copy_statements(room, user_id, mirrors))
+        forget_member_rooms(user_id)
+        on_commit(lambda: shared_cache.add_member_room(user_id, room['id']))
+    return room
+
+async def remove_room_member(room_id, user_id):
+    """Remove user from room; returns False if they were not a member"""
+    shard, *mirrors = members_write_shards(room_id)
+    if not await execute_query(REMOVE_ROOM_MEMBER_SQL, (room_id, user_id), fetch_one=True, shard=shard):
+        return False
+    copies = leave_copy_statements(room_id, user_id, mirrors)
+    if copies:
+        await execute_routed(copies)
+    forget_member_rooms(user_id)
+    on_commit(lambda: shared_cache.remove_member_room(user_id, room_id))
+    return True
+
+def forget_member_rooms(user_id):
+    """Drop a user's cached rooms now and again once the change commits"""
+    cache.invalidate_member(user_id)
+    on_commit(lambda: cache.invalidate_member(user_id))
+
+async def is_room_member(room_id, user_id):
+    """Check if user is member of room (see models.is_room_member)"""
+    if cache.check_membership(user_id, room_id):
+        return True
+    if restore_member_rooms(user_id, room_id, (await shared_cache.get_many(member_rooms=[user_id]))[2]):
+        return True
+    rows = await execute_query(MEMBER_ROOM_IDS_SQL, (user_id,), fetch_all=True, prepare=True, shard=member_shard(user_id))
+    room_ids = remember_member_rooms(user_id, rows)
+    await shared_cache.set_member_rooms(user_id, room_ids)
+    return room_id in room_ids
+
+@coalesced
+async def get_room_members(room_id):
+    """Get all members of a room with usernames"""
+    return await execute_query(ROOM_MEMBERS_SQL, (room_id,), fetch_all=True, prepare=True, shard=members_shard(room_id)) or []
+
+async def get_room_member_count(room_id):
+    """Get member count of a room"""
+    result = await execute_query(ROOM_MEMBER_COUNT_SQL, (room_id,), fetch_one=True, shard=members_shard(room_id))
+    return result['count'] if result else 0
+
+# ============ MESSAGE FUNCTIONS ============
+
+async def new_message_id(room_id, shard=None):
+    """A new id tagged with the room's write shard (see models.new_message_id)"""
+    if shard is None:
+        shard = message_write_shards(room_id)[0]
+    return await snowflake.next_id(shard, cache.get_latest_message_id(room_id))
+
+async def create_message(room_id, sender_id, content, sender_name):
+    """Create a new message and return the inserted row (see models.create_message)"""
+    shard, *mirrors = message_write_shards(room_id)
+    params = (await new_message_id(room_id, shard), room_id, sender_id, content)
+    message = dict(await execute_query(CREATE_MESSAGE_SQL, params, fetch_one=True, prepare=True, shard=shard))
+    message['sender_name'] = sender_name
+    for mirror in mirrors:  # a room being moved (reshard.py) is written to both its shards
+        await execute_query(*insert_messages_statement([message]), shard=mirror)
+    on_commit(lambda: cache.append_room_message(room_id, message))
+    on_commit(lambda: shared_cache.append_recent_message(room_id, message))
+    if DB_NOTIFY:
+        await notify_message(room_id, message['id'])
+    return message
+
+async def create_messages(room_id, sender_id, contents, sender_name):
+    """Create several messages in a room with one statement (see models.create_messages)"""
+    messages = [new_message(await new_message_id(room_id), room_id, sender_id, content, sender_name) for content in contents]
+    for query, params, shard in insert_messages_statements(messages):
+        await execute_query(query, params, shard=shard)
+    on_commit(lambda: remember_new_messages(messages))
+    if DB_NOTIFY:
+        on_commit(lambda: notify_messages(messages))
+    return messages
+
+async def queue_message(room_id, sender_id, content, sender_name):
+    """Accept a message for write-behind ingestion (see models.queue_message)"""
+    message = new_message(None, room_id, sender_id, content, sender_name)
+    return message if await ingest.submit(message) else None
+
+async def write_messages(messages):
+    """Ingest flusher: give one batch its ids and insert it per shard, caching
+    and announcing each shard's rows once it commits (see models.write_messages)
+    """
+    messages = [{**message, 'id': await new_message_id(message['room_id'])} for message in messages]
+    written = set()
+    for query, params, shard in insert_messages_statements(messages, INGEST_MESSAGES_SQL):
+        ids = {row['id'] for row in await execute_detached(query, params, fetch_all=True, shard=shard)}
+        await announce_new_messages([message for message in messages if message['id'] in ids - written])
+        written |= ids
+    return [message for message in messages if message['id'] in written]
+
+async def announce_new_messages(messages):
+    """Add committed messages to the room caches and announce them (see models.announce_new_messages)"""
+    if not messages:
+        return
+    await remember_new_messages(messages)
+    if DB_NOTIFY:
+        await notify_messages(messages)
+
+async def remember_new_messages(messages):
+    """Add committed messages to the room buffers and the shared cache (one pipeline)"""
+    commands = []
+    for message in messages:
+        cache.append_room_message(message['room_id'], message)
+        commands += shared_cache.append_recent_message_commands(message['room_id'], message)
+    await shared_cache.write(commands)
+
+async def get_buffered_page(room_id, limit, before=None, after=None):
+    """Answer a page from the room buffer, loading it from the shared cache on a miss"""
+    page = cache.get_room_page(room_id, limit, before, after)
+    if page is None and not cache.has_room_buffer(room_id):
+        recent = (await shared_cache.get_many(recent_messages=[room_id]))[3]
+        page = restore_room_buffer(room_id, recent.get(room_id), limit, before, after)
+    return page
+
+async def fetch_messages_page(room_id, limit=50, before=None, after=None):
+    """Read one page straight from the owning shard (no buffer)"""
+    query, params, newest_first = messages_page_statement(room_id, limit, before, after)
+    return chronological(await execute_query(query, params, fetch_all=True, prepare=True, shard=message_shard(room_id)), newest_first)
+
+@coalesced
+async def get_messages_by_room(room_id, limit=50, before=None, after=None):
+    """Get one page of messages in a room (see models.get_messages_by_room)"""
+    page = await get_buffered_page(room_id, limit, before, after)
+    if page is None:
+        query, params, newest_first, fills = messages_read_statement(room_id, limit, before, after)
+        messages = await execute_query(query, params, fetch_all=True, prepare=True, shard=message_shard(room_id))
+        page = messages_read_result(room_id, limit, before, after, messages, newest_first, fills)
+        await shared_cache.write(share_room_buffer_commands(room_id, fills))
+    if page is None:
+        page = await fetch_messages_page(room_id, limit, before, after)
+    return await attach_sender_names(page)
+
+async def attach_sender_names(messages, known_users=None):
+    """Add sender_name to each message (see models.attach_sender_names)"""
+    if not messages:
+        return []
+
+    sender_map = {u['id']: u['username'] for u in known_users or []}
+    sender_ids = set(msg['sender_id'] for msg in messages if 'sender_name' not in msg) - set(sender_map)
+
+    if sender_ids:
+        users = await get_users_by_ids(sender_ids)
+        sender_map.update({user_id: u['username'] for user_id, u in users.items() if u})
+
+    result = []
+    for msg in messages:
+        msg_dict = dict(msg)
+        if 'sender_name' not in msg_dict:
+            msg_dict['sender_name'] = sender_map.get(msg['sender_id'], 'Unknown')
+        result.append(msg_dict)
+
+    return result
+
+async def read_shard_latest(room_ids, limit):
+    """Latest messages of rooms on one shard: one pipelined batch on a connection of its own"""
+    statements = latest_messages_statements(room_ids, limit)
+    results = await execute_batch(statements, prepare=True, detached=True, shard=message_shard(room_ids[0]))
+    return {room_id: chronological(messages, True) for room_id, messages in zip(room_ids, results)}
+
+async def get_latest_messages(room_ids, limit):
+    """Get {room_id: latest `limit` messages} for many rooms (see models.get_latest_messages)"""
+    latest = {}
+    for room_id in room_ids:
+        page = cache.get_room_page(room_id, limit)
+        if page is not None:
+            latest[room_id] = page
+    missing = [room_id for room_id in room_ids if room_id not in latest]
+    if missing:
+        recent = (await shared_cache.get_many(recent_messages=missing))[3]
+        for room_id in missing:
+            page = restore_room_buffer(room_id, recent.get(room_id), limit)
+            if page is not None:
+                latest[room_id] = page
+        missing = [room_id for room_id in missing if room_id not in latest]
+    if missing:
+        fetched = {}
+        shard_reads = [read_shard_latest(shard, limit) for shard in shard_room_ids(missing).values()]
+        for pages in await asyncio.gather(*shard_reads):
+            fetched.update(pages)
+        named = iter(await attach_sender_names([message for page in fetched.values() for message in page]))
+        latest.update({room_id: [next(named) for _ in page] for room_id, page in fetched.items()})
+    return latest
+
+async def get_latest_messages_for_member(room_ids, user_id, limit):
+    """get_latest_messages for the rooms in room_ids that user_id is a member of"""
+    return await get_latest_messages([room_id for room_id in room_ids if await is_room_member(room_id, user_id)], limit)
+
+async def get_message_by_id(message_id, room_id):
+    """Get message by ID - need room_id for sharding"""
+    msg = await execute_query(*message_by_id_statement(message_id, room_id), fetch_one=True, shard=message_shard(room_id))
+
+    if msg:
+        msg_dict = dict(msg)
+        if 'sender_name' not in msg_dict:
+            sender = await get_user_by_id(msg['sender_id'])
+            msg_dict['sender_name'] = sender['username'] if sender else 'Unknown'
+        return msg_dict
+    return None
+
+# ============ BATCHED READS ============
+
+async def get_dashboard_context(user_id):
+    """Get user and their rooms in one round trip"""
+    user, rooms = await execute_batch([
+        (USER_BY_ID_SQL, (user_id,), 'one'),
+        (ROOMS_BY_USER_SQL, (user_id,), 'all')
+    ], prepare=True, shard=member_shard(user_id))
+    await shared_cache.set_member_rooms(user_id, cache.set_member_rooms(user_id, (room['id'] for room in rooms or [])))
+    return user, rooms or []
+
+async def get_chat_room_context(room_id, user_id, limit=50):
+    """Get everything the chat page needs in one round trip (see models.get_chat_room_context)"""
+    messages = cache.get_room_page(room_id, limit)
+    load_recent = messages is None and not cache.has_room_buffer(room_id)
+    users, rooms, _, recent = await shared_cache.get_many(
+        users=[user_id], rooms=[room_id], recent_messages=[room_id] if load_recent else []
+    )
+    room, user = rooms.get(room_id), users.get(user_id)
+    if messages is None:
+        messages = restore_room_buffer(room_id, recent.get(room_id), limit)
+
+    statements = [(ROOM_MEMBERS_SQL, (room_id,), 'all', members_shard(room_id))]
+    if room is None:
+        statements.append((ROOM_BY_ID_SQL, (room_id,), 'one', directory_shard(room_id)))
+    if user is None:
+        statements.append((USER_BY_ID_SQL, (user_id,), 'one', directory_shard(room_id)))
+    if messages is None:
+        messages_query, messages_params, newest_first, fills = messages_read_statement(room_id, limit)
+        statements.append((messages_query, messages_params, 'all', message_shard(room_id)))
+    members, *rows = await execute_routed(statements, prepare=True)
+
+    rows, writes = iter(rows), []
+    if room is None:
+        room = next(rows)
+        writes += shared_cache.set_room_commands(room)
+    if user is None:
+        user = next(rows)
+        writes += shared_cache.set_users_commands({user_id: user})
+    if messages is None:
+        messages = messages_read_result(room_id, limit, None, None, next(rows), newest_first, fills)
+        writes += share_room_buffer_commands(room_id, fills)
+    await shared_cache.write(writes)
+    is_member = has_member(members, user_id)
+    cache.set_users(members)
+    return {
+        'room': room,
+        'is_member': is_member,
+        'user': user,
+        'messages': await attach_sender_names(messages, members) if is_member else [],
+        'members': members or []
+    }
+
+async def get_messages_for_member(room_id, user_id, limit=50, before=None, after=None):
+    """Check membership and get a page of messages in one round trip (None if not a member)"""
+    if cache.check_membership(user_id, room_id):
+        return await get_messages_by_room(room_id, limit, before, after)  # coalesced with other readers of the room
+
+    page = cache.get_room_page(room_id, limit, before, after)
+    load_recent = page is None and not cache.has_room_buffer(room_id)
+    _, _, member_rooms, recent = await shared_cache.get_many(
+        member_rooms=[user_id], recent_messages=[room_id] if load_recent else []
+    )
+    is_member = restore_member_rooms(user_id, room_id, member_rooms)
+    if page is None:
+        page = restore_room_buffer(room_id, recent.get(room_id), limit, before, after)
+    if is_member and page is not None:
+        return await attach_sender_names(page)
+
+    statements = []
+    if not is_member:
+        statements.append((MEMBER_ROOM_IDS_SQL, (user_id,), 'all', member_shard(user_id)))
+    if page is None:
+        messages_query, messages_params, newest_first, fills = messages_read_statement(room_id, limit, before, after)
+        statements.append((messages_query, messages_params, 'all', message_shard(room_id)))
+    results = await execute_routed(statements, prepare=True)
+
+    writes = []
+    if not is_member:
+        room_ids = remember_member_rooms(user_id, results[0])
+        writes += shared_cache.set_member_rooms_commands(user_id, room_ids)
+        if room_id not in room_ids:
+            await shared_cache.write(writes)
+            return None
+    if page is None:
+        page = messages_read_result(room_id, limit, before, after, results[-1], newest_first, fills)
+        writes += share_room_buffer_commands(room_id, fills)
+    await shared_cache.write(writes)
+    if page is None:
+        page = await fetch_messages_page(room_id, limit, before, after)
+    return await attach_sender_names(page)
+
+async def get_members_for_member(room_id, user_id):
+    """Get room members if the user is one of them (None if not a member)"""
+    members = await get_room_members(room_id)  # coalesced with other members of the room
+    return members if has_member(members, user_id) else None
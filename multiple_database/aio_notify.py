@@ -0,0 +1,127 @@
+# Async counterpart of notify.py for the ASGI entry point (asgi.py)
+# One listener task per worker process instead of a thread; same channel, payload and node
+import asyncio
+import logging
+
+import psycopg
+from psycopg import AsyncConnection
+from psycopg_pool import AsyncConnectionPool
+from quart import has_request_context
+from config import NOTIFY_CHANNEL, NOTIFY_POOL_SIZE
+from aio_db import on_commit
+import cache
+from notify import NOTIFY_SQL, connection_kwargs, format_payload, parse_payload, listen_statement
+
+logger = logging.getLogger(__name__)
+
+_handlers = []
+_listener = None
+_stats = {'received': 0, 'handler_errors': 0, 'reconnects': 0}
+
+# Autocommit connections used to send NOTIFY (see notify.get_notify_pool)
+_notify_pool = None
+_notify_pool_lock = asyncio.Lock()
+
+async def connect():
+    """Open an autocommit connection to the LISTEN/NOTIFY node"""
+    return await AsyncConnection.connect(**connection_kwargs())
+
+async def get_notify_pool():
+    """Get the pool of NOTIFY connections, opening it on first use"""
+    global _notify_pool
+    if _notify_pool is None:
+        async with _notify_pool_lock:
+            if _notify_pool is None:
+                pool = AsyncConnectionPool(
+                    kwargs=connection_kwargs(),
+                    connection_class=AsyncConnection,
+                    min_size=1,
+                    max_size=NOTIFY_POOL_SIZE,
+                    check=AsyncConnectionPool.check_connection,
+                    name='notify_async_pool',
+                    open=False
+                )
+                await pool.open()
+                _notify_pool = pool
+    return _notify_pool
+
+async def _send_notify(payloads):
+    """Send NOTIFYs in one round trip on a pooled connection (see notify._send_notify)"""
+    async with (await get_notify_pool()).connection() as conn:
+        await conn.execute(NOTIFY_SQL, (NOTIFY_CHANNEL, payloads))
+
+async def notify_message(room_id, message_id):
+    """Announce a new message to every worker once the current transaction commits"""
+    payloads = [format_payload(room_id, message_id)]
+    if has_request_context():
+        on_commit(lambda: _send_notify(payloads))
+    else:
+        await _send_notify(payloads)
+
+async def notify_messages(messages):
+    """Announce a batch of written messages in one NOTIFY round trip (see notify.notify_messages)"""
+    await _send_notify([format_payload(message['room_id'], message['id']) for message in messages])
+
+def add_handler(handler):
+    """Register async handler(room_id, message_id); runs in the listener task"""
+    _handlers.append(handler)
+
+async def dispatch(payload):
+    """Pass one notification to every handler; a failing handler does not stop the others"""
+    room_id, message_id = parse_payload(payload)
+    _stats['received'] += 1
+    for handler in list(_handlers):
+        try:
+            await handler(room_id, message_id)
+        except Exception:
+            _stats['handler_errors'] += 1
+            logger.exception('Notify handler %r failed for %s', handler, payload)
+
+async def _listen_forever():
+    """Listener loop: LISTEN on a dedicated autocommit connection, reconnecting with backoff"""
+    delay = 1
+    while True:
+        try:
+            async with await connect() as conn:
+                await conn.execute(listen_statement())
+                cache.follow_messages(True)
+                delay = 1
+                async for notification in conn.notifies():
+                    await dispatch(notification.payload)
+        except psycopg.Error as e:
+            logger.warning('Notify listener disconnected (%s), retrying in %ss', e, delay)
+        finally:
+            cache.follow_messages(False)
+        _stats['reconnects'] += 1
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 30)
+
+async def start_listener():
+    """Start this worker's listener task (once per process)"""
+    global _listener
+    if _listener is None or _listener.done():
+        _listener = asyncio.create_task(_listen_forever())
+
+async def stop_listener():
+    """Cancel the listener task"""
+    global _listener
+    if _listener is not None:
+        _listener.cancel()
+        try:
+            await _listener
+        except asyncio.CancelledError:
+            pass
+        _listener = None
+
+def init_app(app):
+    """Run the listener for as long as the server is serving"""
+    app.before_serving(start_listener)
+    app.after_serving(stop_listener)
+
+def get_notify_stats():
+    """Get listener state: running, notifications received, handler errors and reconnects"""
+    return {
+        'listening': _listener is not None and not _listener.done(),
+        'handlers': len(_handlers),
+        **_stats
+    }
@@ -0,0 +1,26 @@
+# Async counterpart of snowflake.py for the ASGI entry point (asgi.py)
+# Same lease and counters; a worker id is leased through the async pool (one
+# task leases while the others wait), so a message never blocks the event loop
+# on the metadata node. The lease is still renewed by snowflake.py's thread
+import asyncio
+import time
+from aio_db import execute_detached
+from snowflake import lease_expired, claim_statement, add_lease, take_id, _lock, get_snowflake_stats
+
+_claiming = asyncio.Lock()
+
+async def next_id(shard, floor=None):
+    """Get a new message id for a message written to `shard` (see snowflake.next_id)"""
+    with _lock:
+        if not lease_expired():
+            return take_id(shard, floor)
+    async with _claiming:
+        with _lock:
+            if not lease_expired():
+                return take_id(shard, floor)
+        started = time.monotonic()
+        query, params, owner = claim_statement()
+        row = await execute_detached(query, params, fetch_one=True)
+        with _lock:
+            add_lease(row, owner, started)
+            return take_id(shard, floor)
@@ -0,0 +1,540 @@
+# ASGI entry point: the routes of app.py on Quart with async psycopg (aio_db/aio_models)
+# DB waits yield to the event loop instead of holding a thread per request
+# Run: hypercorn asgi:app --bind 0.0.0.0:5000 --workers 2
+from quart import Quart, Response, request, jsonify, session, redirect, url_for, render_template
+from functools import wraps
+import hmac
+import asyncio
+import json
+from config import SECRET_KEY, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, MAX_BATCH_MESSAGES, MAX_LATEST_ROOMS, SSE_KEEPALIVE_SECONDS, SSE_QUEUE_SIZE, DB_NOTIFY, INGEST_QUEUE, STATS_TOKEN
+import aio_models as models
+import aio_db as db
+import aio_notify as notify
+import broker
+import cache
+import singleflight
+import idgen
+import aio_ingest as ingest
+import aio_shared_cache as shared_cache
+import shard_routes
+import snowflake
+
+app = Quart(__name__)
+app.secret_key = SECRET_KEY
+db.init_app(app)
+shard_routes.check_routing()
+
+# ============ HELPER FUNCTIONS ============
+
+def json_response(success, message, data=None, status=200):
+    """Create standardized JSON response"""
+    response = {
+        'success': success,
+        'message': message
+    }
+    if data is not None:
+        response['data'] = data
+    return jsonify(response), status
+
+def message_to_dict(msg):
+    """Convert a message row to a JSON-serializable dict
+    The id is a string: message ids (snowflake.py) are above 2^53, the
+    largest integer a JavaScript number holds exactly (None while queued)
+    """
+    msg_dict = dict(msg)
+    msg_dict['id'] = None if msg_dict['id'] is None else str(msg_dict['id'])
+    msg_dict['created_at'] = msg_dict['created_at'].isoformat() if msg_dict['created_at'] else None
+    return msg_dict
+
+def sse_event(msg_dict):
+    """Format a message as a Server-Sent Event (id lets the browser resume via Last-Event-ID)"""
+    return f"id: {msg_dict['id']}\nevent: message\ndata: {json.dumps(msg_dict)}\n\n"
+
+def login_required(f):
+    """Decorator to check if user is logged in"""
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            if request.is_json:
+                return json_response(False, 'Login required', status=401)
+            return redirect(url_for('index'))
+        return await f(*args, **kwargs)
+    return decorated_function
+
+def stats_token_required(f):
+    """Decorator to allow only requests carrying STATS_TOKEN (404 while it is unset)"""
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        if not STATS_TOKEN:
+            return json_response(False, 'Not found', status=404)
+        token = request.headers.get('X-Stats-Token', '')
+        if not hmac.compare_digest(token.encode(), STATS_TOKEN.encode()):
+            return json_response(False, 'Stats token required', status=401)
+        return await f(*args, **kwargs)
+    return decorated_function
+
+async def get_current_user():
+    """Get current logged in user"""
+    if 'user_id' in session:
+        return await models.get_user_by_id(session['user_id'])
+    return None
+
+# ============ PAGE ROUTES ============
+
+@app.route('/')
+async def index():
+    """Landing page - Login/Register"""
+    if 'user_id' in session:
+        return redirect(url_for('dashboard'))
+    return await render_template('index.html')
+
+@app.route('/dashboard')
+@login_required
+@db.read_only
+async def dashboard():
+    """Dashboard page"""
+    user, rooms = await models.get_dashboard_context(session['user_id'])
+    return await render_template('dashboard.html', user=user, rooms=rooms)
+
+@app.route('/room/<int:room_id>')
+@login_required
+@db.read_only
+async def chat_room(room_id):
+    """Chat room page"""
+    # Room, membership, user, messages and members in one round trip
+    context = await models.get_chat_room_context(room_id, session['user_id'])
+    
+    # Check if room exists and user is member
+    if not context['room'] or not context['is_member']:
+        return redirect(url_for('dashboard'))
+    
+    return await render_template('chat.html', user=context['user'], room=context['room'],
+                           messages=context['messages'], members=context['members'])
+
+# ============ AUTH API ============
+
+@app.route('/api/register', methods=['POST'])
+async def api_register():
+    """Register new user"""
+    data = await request.get_json()
+    
+    if not data or 'username' not in data:
+        return json_response(False, 'Username is required', status=400)
+    
+    username = data['username'].strip().lower()
+    
+    if len(username) < 3:
+        return json_response(False, 'Username must be at least 3 characters', status=400)
+    
+    try:
+        user_id = await models.create_user(username)
+        if user_id is None:
+            return json_response(False, 'Username already exists', status=400)
+        session['user_id'] = user_id
+        session['username'] = username
+        
+        return json_response(True, 'Registration successful', {
+            'user_id': user_id,
+            'username': username
+        })
+    except Exception as e:
+        return json_response(False, str(e), status=500)
+
+@app.route('/api/login', methods=['POST'])
+async def api_login():
+    """Login with username"""
+    data = await request.get_json()
+    
+    if not data or 'username' not in data:
+        return json_response(False, 'Username is required', status=400)
+    
+    username = data['username'].strip().lower()
+    user = await models.get_user_by_username(username)
+    
+    if not user:
+        return json_response(False, 'Username not found', status=404)
+    
+    session['user_id'] = user['id']
+    session['username'] = user['username']
+    
+    return json_response(True, 'Login successful', {
+        'user_id': user['id'],
+        'username': user['username']
+    })
+
+@app.route('/api/logout', methods=['POST'])
+async def api_logout():
+    """Logout user"""
+    session.clear()
+    return json_response(True, 'Logout successful')
+
+@app.route('/logout')
+async def logout():
+    """Logout and redirect to index"""
+    session.clear()
+    return redirect(url_for('index'))
+
+# ============ ROOM API ============
+
+@app.route('/api/rooms', methods=['GET'])
+@login_required
+@db.read_only
+async def api_get_my_rooms():
+    """Get rooms for current user"""
+    rooms = await models.get_rooms_by_user(session['user_id'])
+    rooms_list = [dict(room) for room in rooms] if rooms else []
+    return json_response(True, 'Rooms fetched', rooms_list)
+
+@app.route('/api/rooms', methods=['POST'])
+@login_required
+async def api_create_room():
+    """Create a new room"""
+    data = await request.get_json()
+    
+    room_type = data.get('type', 'group')
+    if room_type not in ['dm', 'group']:
+        return json_response(False, 'Room type must be dm or group', status=400)
+    
+    try:
+        room_id, codename = await models.create_room(room_type, session['user_id'])
+        
+        return json_response(True, 'Room created', {
+            'room_id': room_id,
+            'codename': codename,
+            'type': room_type,
+            'message': f'Share this code with others: {codename}'
+        })
+    except Exception as e:
+        return json_response(False, str(e), status=500)
+
+@app.route('/api/rooms/join', methods=['POST'])
+@login_required
+async def api_join_room():
+    """Join a room by codename"""
+    data = await request.get_json()
+    
+    if not data or 'codename' not in data:
+        return json_response(False, 'Codename is required', status=400)
+    
+    codename = data['codename'].strip().upper()
+    
+    # One statement finds the room, checks membership and the DM limit and joins
+    try:
+        room = await models.join_room(codename, session['user_id'])
+    except Exception as e:
+        return json_response(False, str(e), status=500)
+    
+    if not room:
+        return json_response(False, 'Room not found', status=404)
+    
+    if room['status'] == 'member':
+        return json_response(False, 'Already a member of this room', status=400)
+    
+    if room['status'] == 'full':
+        return json_response(False, 'DM room is full (max 2 members)', status=400)
+    
+    return json_response(True, 'Joined room successfully', {
+        'room_id': room['id'],
+        'codename': room['codename']
+    })
+
+@app.route('/api/rooms/<int:room_id>/leave', methods=['POST'])
+@login_required
+async def api_leave_room(room_id):
+    """Leave a room"""
+    try:
+        if not await models.remove_room_member(room_id, session['user_id']):
+            return json_response(False, 'Not a member of this room', status=400)
+        return json_response(True, 'Left room successfully')
+    except Exception as e:
+        return json_response(False, str(e), status=500)
+
+@app.route('/api/rooms/<int:room_id>/members', methods=['GET'])
+@login_required
+@db.read_only
+async def api_get_room_members(room_id):
+    """Get room members"""
+    members = await models.get_members_for_member(room_id, session['user_id'])
+    if members is None:
+        return json_response(False, 'Not a member of this room', status=403)
+    
+    members_list = [dict(m) for m in members] if members else []
+    return json_response(True, 'Members fetched', members_list)
+
+# ============ MESSAGE API ============
+
+@app.route('/api/rooms/<int:room_id>/messages', methods=['GET'])
+@login_required
+@db.read_only
+async def api_get_messages(room_id):
+    """Get a page of messages in a room
+    Query params: before=<message_id> or after=<message_id>, limit (1-{MAX_PAGE_SIZE})
+    """
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    
+    if before is not None and after is not None:
+        return json_response(False, 'Use either before or after, not both', status=400)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return json_response(False, f'Limit must be between 1 and {MAX_PAGE_SIZE}', status=400)
+    
+    messages = await models.get_messages_for_member(room_id, session['user_id'], limit, before, after)
+    if messages is None:
+        return json_response(False, 'Not a member of this room', status=403)
+    
+    # Convert datetime to string for JSON
+    messages_list = [message_to_dict(msg) for msg in messages]
+    
+    return json_response(True, 'Messages fetched', messages_list)
+
+@app.route('/api/rooms/<int:room_id>/messages/since/<int:message_id>', methods=['GET'])
+@login_required
+@db.read_only
+async def api_sync_messages(room_id, message_id):
+    """Get only the messages newer than message_id (incremental sync for polling)
+    Returns 204 with an empty body when nothing is new
+    """
+    messages = await models.get_messages_for_member(room_id, session['user_id'], MAX_PAGE_SIZE, after=message_id)
+    if messages is None:
+        return json_response(False, 'Not a member of this room', status=403)
+    
+    if not messages:
+        return '', 204
+    
+    return json_response(True, 'Messages fetched', [message_to_dict(msg) for msg in messages])
+
+@app.route('/api/rooms/<int:room_id>/stream', methods=['GET'])
+@login_required
+@db.read_only
+async def api_stream_messages(room_id):
+    """Stream new messages in a room as Server-Sent Events
+    Resumes after Last-Event-ID (or ?after=<message_id>) by sending the missed messages first
+    """
+    user_id = session['user_id']
+    last_id = request.headers.get('Last-Event-ID', type=int) or request.args.get('after', 0, type=int)
+    
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+    overflow = asyncio.Event()
+    
+    def put(event):
+        try:
+            events.put_nowait(event)
+        except asyncio.QueueFull:
+            overflow.set()  # slow client: end the stream, it resumes from Last-Event-ID
+    
+    def deliver(event):
+        # The broker may publish from another thread
+        loop.call_soon_threadsafe(put, event)
+    
+    # Subscribe before reading the backlog so nothing committed in between is lost
+    broker.subscribe(room_id, deliver)
+    try:
+        if last_id:
+            backlog = await models.get_messages_for_member(room_id, user_id, MAX_PAGE_SIZE, after=last_id)
+        else:
+            backlog = [] if await models.is_room_member(room_id, user_id) else None
+    except Exception:
+        broker.unsubscribe(room_id, deliver)
+        raise
+    
+    if backlog is None:
+        broker.unsubscribe(room_id, deliver)
+        return json_response(False, 'Not a member of this room', status=403)
+    
+    backlog = [message_to_dict(msg) for msg in backlog]
+    
+    # Runs after the request has ended and its connection is back in the pool
+    async def stream():
+        sent_ids = set()
+        try:
+            for msg_dict in backlog:
+                sent_ids.add(msg_dict['id'])
+                yield sse_event(msg_dict)
+            while not overflow.is_set():
+                try:
+                    msg_dict = await asyncio.wait_for(events.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ': ping\n\n'
+                    continue
+                if msg_dict['id'] not in sent_ids:
+                    yield sse_event(msg_dict)
+        finally:
+            broker.unsubscribe(room_id, deliver)
+    
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.timeout = None  # long-lived: no RESPONSE_TIMEOUT for this body
+    return response
+
+@app.route('/api/rooms/<int:room_id>/messages', methods=['POST'])
+@login_required
+async def api_send_message(room_id):
+    """Send a message to a room"""
+    if not await models.is_room_member(room_id, session['user_id']):
+        return json_response(False, 'Not a member of this room', status=403)
+    
+    data = await request.get_json()
+    
+    if not data or 'content' not in data:
+        return json_response(False, 'Message content is required', status=400)
+    
+    content = data['content'].strip()
+    if not content:
+        return json_response(False, 'Message cannot be empty', status=400)
+    
+    try:
+        if INGEST_QUEUE:
+            # Queued for the flusher; its id is given when the batch is written
+            message = await models.queue_message(room_id, session['user_id'], content, session['username'])
+            if message is None:
+                return json_response(False, 'Too many messages, try again shortly', status=429)
+            return json_response(True, 'Message accepted', message_to_dict(message), status=202)
+        
+        # One INSERT ... RETURNING *, sender name from the session
+        message = await models.create_message(room_id, session['user_id'], content, session['username'])
+        message_dict = message_to_dict(message)
+        
+        # Without the NOTIFY listener, push to this worker's subscribers once committed
+        if not DB_NOTIFY:
+            db.on_commit(lambda: broker.publish(room_id, message_dict))
+        
+        return json_response(True, 'Message sent', message_dict)
+    except Exception as e:
+        return json_response(False, str(e), status=500)
+
+@app.route('/api/rooms/<int:room_id>/messages/batch', methods=['POST'])
+@login_required
+async def api_send_messages(room_id):
+    """Send several messages to a room with one insert
+    Body: {"messages": [{"content": "..."}, ...]} (1-{MAX_BATCH_MESSAGES} messages)
+    """
+    if not await models.is_room_member(room_id, session['user_id']):
+        return json_response(False, 'Not a member of this room', status=403)
+    
+    data = await request.get_json()
+    items = data.get('messages') if isinstance(data, dict) else None
+    
+    if not isinstance(items, list) or not 1 <= len(items) <= MAX_BATCH_MESSAGES:
+        return json_response(False, f'Between 1 and {MAX_BATCH_MESSAGES} messages are required', status=400)
+    
+    contents = [item.get('content', '').strip() if isinstance(item, dict) else '' for item in items]
+    if not all(contents):
+        return json_response(False, 'Message cannot be empty', status=400)
+    
+    try:
+        messages = await models.create_messages(room_id, session['user_id'], contents, session['username'])
+        messages_list = [message_to_dict(message) for message in messages]
+        
+        # Without the NOTIFY listener, push to this worker's subscribers once committed
+        if not DB_NOTIFY:
+            db.on_commit(lambda: publish_written_messages(messages))
+        
+        return json_response(True, 'Messages sent', messages_list)
+    except Exception as e:
+        return json_response(False, str(e), status=500)
+
+@app.route('/api/messages/latest', methods=['GET'])
+@login_required
+@db.read_only
+async def api_get_latest_messages():
+    """Get the latest messages of several rooms (e.g. dashboard previews)
+    Query params: room_ids=<id>,<id>,... (1-{MAX_LATEST_ROOMS}), limit (1-{MAX_PAGE_SIZE}, default 1)
+    Rooms the user is not a member of are left out
+    """
+    try:
+        room_ids = list(dict.fromkeys(int(room_id) for room_id in request.args.get('room_ids', '').split(',') if room_id))
+    except ValueError:
+        return json_response(False, 'room_ids must be a comma-separated list of ids', status=400)
+    limit = request.args.get('limit', 1, type=int)
+    
+    if not 1 <= len(room_ids) <= MAX_LATEST_ROOMS:
+        return json_response(False, f'Between 1 and {MAX_LATEST_ROOMS} room ids are required', status=400)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return json_response(False, f'Limit must be between 1 and {MAX_PAGE_SIZE}', status=400)
+    
+    latest = await models.get_latest_messages_for_member(room_ids, session['user_id'], limit)
+    return json_response(True, 'Messages fetched', [
+        {'room_id': room_id, 'messages': [message_to_dict(msg) for msg in latest[room_id]]}
+        for room_id in room_ids if room_id in latest
+    ])
+
+# ============ USER API ============
+
+@app.route('/api/user', methods=['GET'])
+@login_required
+@db.read_only
+async def api_get_current_user():
+    """Get current user info"""
+    user = await get_current_user()
+    if user:
+        user_dict = dict(user)
+        user_dict['created_at'] = user_dict['created_at'].isoformat() if user_dict['created_at'] else None
+        return json_response(True, 'User fetched', user_dict)
+    return json_response(False, 'User not found', status=404)
+
+@app.route('/api/user', methods=['DELETE'])
+@login_required
+async def api_delete_account():
+    """Delete current user account"""
+    try:
+        await models.delete_user(session['user_id'])
+        session.clear()
+        return json_response(True, 'Account deleted successfully')
+    except Exception as e:
+        return json_response(False, str(e), status=500)
+
+# ============ MESSAGE FAN-OUT ============
+
+async def push_committed_message(room_id, message_id):
+    """NOTIFY handler: add a message committed on any worker to this worker's
+    room buffer and push it to this worker's stream subscribers
+    """
+    streaming = broker.has_subscribers(room_id)
+    message = cache.get_buffered_message(room_id, message_id)  # sent from this worker
+    if message is None and (streaming or cache.has_room_buffer(room_id)):
+        message = await models.get_message_by_id(message_id, room_id)
+        if message:
+            cache.append_room_message(room_id, message)
+    if message and streaming:
+        broker.publish(room_id, message_to_dict((await models.attach_sender_names([message]))[0]))
+
+if DB_NOTIFY:
+    notify.add_handler(push_committed_message)
+    notify.init_app(app)
+
+async def publish_written_messages(messages):
+    """Without NOTIFY: push written messages (a batch send or an ingest batch) to this worker's stream subscribers"""
+    for message in messages:
+        broker.publish(message['room_id'], message_to_dict(message))
+
+if INGEST_QUEUE:
+    if not DB_NOTIFY:
+        ingest.add_handler(publish_written_messages)
+    ingest.init_app(app, models.write_messages)
+
+# ============ STATS API ============
+
+@app.route('/api/stats', methods=['GET'])
+@stats_token_required
+async def api_get_stats():
+    """Get runtime stats (connection pool, prepared statements, message fan-out, caches, shared cache, single-flight, id blocks, ingest queue, room shard routes)"""
+    return json_response(True, 'Stats fetched', {
+        'pool': db.get_pool_stats(),
+        'prepared_statements': db.get_prepare_stats(),
+        'broker': broker.get_broker_stats(),
+        'notify': notify.get_notify_stats(),
+        'cache': cache.get_cache_stats(),
+        'shared_cache': shared_cache.get_shared_cache_stats(),
+        'single_flight': singleflight.get_single_flight_stats(),
+        'ids': idgen.get_idgen_stats(),
+        'message_ids': snowflake.get_snowflake_stats(),
+        'ingest': ingest.get_ingest_stats(),
+        'shard_routes': shard_routes.get_shard_routes_stats()
+    })
+
+# ============ RUN APP ============
+
+if __name__ == '__main__':
+    app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,308 @@
+# In-process caches (one copy per worker process)
+# Each cache is a bounded LRU of entries that expire after a TTL, with hit/miss counters
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from config import (
+    MEMBERSHIP_CACHE_TTL, MEMBERSHIP_CACHE_SIZE, USER_CACHE_TTL, USER_CACHE_SIZE,
+    ROOM_BUFFER_SIZE, ROOM_BUFFER_TTL, ROOM_BUFFER_MAX_MESSAGES
+)
+
+# ============ TTL / LRU HELPERS ============
+
+def _new_cache(max_size, ttl, weigh=None):
+    """Create an empty cache
+    max_size bounds the total weight of the entries (weigh(value), 1 per entry by default)
+    """
+    return {
+        'entries': OrderedDict(),  # key -> (expires_at, value, weight), least recently used first
+        'max_size': max_size,
+        'ttl': ttl,
+        'weigh': weigh or (lambda value: 1),
+        'size': 0,
+        'lock': threading.Lock(),
+        'hits': 0,
+        'misses': 0,
+        'evictions': 0
+    }
+
+def _store(cache, key, expires_at, value):
+    """Put an entry and evict least recently used ones beyond max_size (lock held)"""
+    old = cache['entries'].pop(key, None)
+    if old is not None:
+        cache['size'] -= old[2]
+    weight = cache['weigh'](value)
+    cache['entries'][key] = (expires_at, value, weight)
+    cache['size'] += weight
+    while cache['size'] > cache['max_size'] and len(cache['entries']) > 1:
+        _, (_, _, evicted_weight) = cache['entries'].popitem(last=False)
+        cache['size'] -= evicted_weight
+        cache['evictions'] += 1
+
+def _cache_lookup(cache, key):
+    """Get a live entry's value (None if absent or expired) without counting it"""
+    with cache['lock']:
+        entry = cache['entries'].get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            cache['entries'].move_to_end(key)
+            return entry[1]
+        if entry is not None:
+            del cache['entries'][key]  # expired
+            cache['size'] -= entry[2]
+        return None
+
+def _cache_count(cache, hit):
+    """Count a hit (answered from the cache) or a miss (went to the database)"""
+    with cache['lock']:
+        cache['hits' if hit else 'misses'] += 1
+    return hit
+
+def _cache_get(cache, key):
+    """Get a live entry's value and count a hit, or return None and count a miss"""
+    value = _cache_lookup(cache, key)
+    _cache_count(cache, value is not None)
+    return value
+
+def _cache_set(cache, key, value):
+    """Store a value, evicting the least recently used entries beyond max_size"""
+    with cache['lock']:
+        _store(cache, key, time.monotonic() + cache['ttl'], value)
+    return value
+
+def _cache_update(cache, key, update):
+    """Replace a live entry's value with update(value), keeping its expiry
+    Returns the new value, or None if there is no live entry
+    """
+    with cache['lock']:
+        entry = cache['entries'].get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        value = update(entry[1])
+        _store(cache, key, entry[0], value)
+        return value
+
+def _cache_delete(cache, key):
+    """Drop an entry if present"""
+    with cache['lock']:
+        entry = cache['entries'].pop(key, None)
+        if entry is not None:
+            cache['size'] -= entry[2]
+
+def _cache_clear(cache):
+    """Drop every entry"""
+    with cache['lock']:
+        cache['entries'].clear()
+        cache['size'] = 0
+
+def _cache_stats(cache):
+    """Get size, hits, misses, hit rate and evictions"""
+    with cache['lock']:
+        hits, misses = cache['hits'], cache['misses']
+        total = hits + misses
+        return {
+            'entries': len(cache['entries']),
+            'size': cache['size'],
+            'max_size': cache['max_size'],
+            'ttl': cache['ttl'],
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / total, 4) if total else 0,
+            'evictions': cache['evictions']
+        }
+
+# ============ MEMBERSHIP CACHE ============
+# user_id -> frozenset of the room ids the user belongs to
+
+_membership = _new_cache(MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_CACHE_TTL)
+
+def check_membership(user_id, room_id):
+    """True if the cache knows the user is in the room; False means ask the database
+    (a missing entry or a room absent from it: the user may have just joined on another worker)
+    """
+    room_ids = _cache_lookup(_membership, user_id)
+    return _cache_count(_membership, room_ids is not None and room_id in room_ids)
+
+def set_member_rooms(user_id, room_ids):
+    """Cache every room id of a user; returns the cached set"""
+    return _cache_set(_membership, user_id, frozenset(room_ids))
+
+def invalidate_member(user_id):
+    """Forget a user's rooms (after joining, leaving or deleting the account)"""
+    _cache_delete(_membership, user_id)
+
+# ============ USER DIRECTORY CACHE ============
+# user_id -> user row (usernames never change), or _NO_USER for ids known
+# not to exist (deleted users), so they are not queried again either
+
+_users = _new_cache(USER_CACHE_SIZE, USER_CACHE_TTL)
+_NO_USER = object()
+
+def get_cached_users(user_ids):
+    """Look up many users at once
+    Returns ({user_id: row, or None for a deleted user}, [user ids to fetch])
+    """
+    users, missing = {}, []
+    for user_id in set(user_ids):
+        entry = _cache_get(_users, user_id)
+        if entry is None:
+            missing.append(user_id)
+        else:
+            users[user_id] = None if entry is _NO_USER else entry
+    return users, missing
+
+def set_users(rows, requested_ids=()):
+    """Cache user rows, plus a negative entry for each requested id not among them
+    Returns {user_id: row or None} for every row and requested id
+    """
+    users = {user_id: None for user_id in requested_ids}
+    users.update({row['id']: dict(row) for row in rows or []})
+    for user_id, user in users.items():
+        _cache_set(_users, user_id, _NO_USER if user is None else user)
+    return users
+
+def invalidate_user(user_id):
+    """Forget a user (after deleting the account)"""
+    _cache_delete(_users, user_id)
+
+# ============ RECENT MESSAGES BUFFER ============
+# room_id -> (messages, complete): the room's latest ROOM_BUFFER_SIZE messages
+# as a tuple ordered by id, and whether that is the room's whole history.
+# Filled by a latest-page read, appended to on commit and by the NOTIFY
+# listener for other workers' messages. The size limit
+# counts messages across all rooms, cold rooms are evicted first.
+# A fill may have been read before a message committed that an append already
+# added (or, with no buffer yet, set aside in _unbuffered_messages), so a fill
+# is merged with both instead of replacing them.
+
+_room_buffers = _new_cache(ROOM_BUFFER_MAX_MESSAGES, ROOM_BUFFER_TTL, weigh=lambda buffer: len(buffer[0]) or 1)
+# room_id -> messages committed while the room had no buffer here (kept one TTL)
+_unbuffered_messages = _new_cache(ROOM_BUFFER_MAX_MESSAGES, ROOM_BUFFER_TTL, weigh=lambda messages: len(messages) or 1)
+_room_buffer_lock = threading.Lock()  # a fill and an append of a room do not interleave
+# Whether this worker hears of every new message: its NOTIFY listener is
+# connected (notify.py). Otherwise a buffer can miss other workers' messages,
+# and a sync read (after) answered from it would move the client's cursor
+# past them for good, so sync reads skip the buffers
+_following = False
+
+def _merge_messages(*groups):
+    """Union of message sequences by id, ordered by id"""
+    by_id = {}
+    for messages in groups:
+        for msg in messages:
+            by_id.setdefault(msg['id'], msg)
+    return tuple(by_id[message_id] for message_id in sorted(by_id))
+
+def _buffer_page(buffer, limit, before=None, after=None):
+    """Slice a page (oldest first) out of a room buffer, or None if it is not all there"""
+    messages, complete = buffer
+    if after is not None:
+        if not _following or (not complete and (not messages or after < messages[0]['id'])):
+            return None
+        return [msg for msg in messages if msg['id'] > after][:limit]
+    older = [msg for msg in messages if msg['id'] < before] if before is not None else messages
+    if len(older) < limit and not complete:
+        return None
+    return list(older[-limit:])
+
+def has_room_buffer(room_id):
+    """Check if this worker buffers a room's recent messages"""
+    return _cache_lookup(_room_buffers, room_id) is not None
+
+def get_room_page(room_id, limit, before=None, after=None):
+    """Answer a page of messages from the buffer (counted as a hit), or None (a miss)"""
+    buffer = _cache_lookup(_room_buffers, room_id)
+    page = _buffer_page(buffer, limit, before, after) if buffer is not None else None
+    _cache_count(_room_buffers, page is not None)
+    return page
+
+def set_room_buffer(room_id, messages, complete):
+    """Buffer a room's latest messages (given oldest first), merged by id with
+    the messages this worker already has for the room
+    """
+    with _room_buffer_lock:
+        current = _cache_lookup(_room_buffers, room_id)
+        unbuffered = _cache_lookup(_unbuffered_messages, room_id) or ()
+        _cache_delete(_unbuffered_messages, room_id)
+        if current is not None:
+            complete = complete or current[1]
+        merged = _merge_messages(
+            (dict(msg) for msg in messages), current[0] if current is not None else (), unbuffered
+        )
+        if len(merged) > ROOM_BUFFER_SIZE:
+            merged, complete = merged[-ROOM_BUFFER_SIZE:], False
+        _cache_set(_room_buffers, room_id, (merged, complete))
+
+def peek_room_page(room_id, limit, before=None, after=None):
+    """Like get_room_page but not counted (right after filling the buffer)"""
+    buffer = _cache_lookup(_room_buffers, room_id)
+    return _buffer_page(buffer, limit, before, after) if buffer is not None else None
+
+def get_room_buffer(room_id):
+    """Get every buffered message of a room (oldest first) and whether that is
+    its whole history, or None; not counted
+    """
+    buffer = _cache_lookup(_room_buffers, room_id)
+    return None if buffer is None else (list(buffer[0]), buffer[1])
+
+def get_latest_message_id(room_id):
+    """Get the newest buffered message id of a room, or None; not counted"""
+    buffer = _cache_lookup(_room_buffers, room_id)
+    return buffer[0][-1]['id'] if buffer is not None and buffer[0] else None
+
+def get_buffered_message(room_id, message_id):
+    """Get one message from a room buffer, or None"""
+    buffer = _cache_lookup(_room_buffers, room_id)
+    for msg in buffer[0] if buffer is not None else ():
+        if msg['id'] == message_id:
+            return msg
+    return None
+
+def append_room_message(room_id, message):
+    """Add a committed message to a room's buffer (in id order, once); for a room
+    with no buffer it is set aside for the next fill (see set_room_buffer)
+    """
+    def append(buffer):
+        messages, complete = buffer
+        ids = [msg['id'] for msg in messages]
+        position = bisect.bisect_left(ids, message['id'])
+        if position < len(ids) and ids[position] == message['id']:
+            return buffer
+        messages = messages[:position] + (dict(message),) + messages[position:]
+        if len(messages) > ROOM_BUFFER_SIZE:
+            return messages[-ROOM_BUFFER_SIZE:], False
+        return messages, complete
+    with _room_buffer_lock:
+        if _cache_update(_room_buffers, room_id, append) is None:
+            unbuffered = _cache_lookup(_unbuffered_messages, room_id) or ()
+            _cache_set(_unbuffered_messages, room_id, _merge_messages(unbuffered, (dict(message),))[-ROOM_BUFFER_SIZE:])
+
+def clear_room_buffers():
+    """Drop every room buffer (e.g. after messages were deleted)"""
+    with _room_buffer_lock:
+        _cache_clear(_room_buffers)
+        _cache_clear(_unbuffered_messages)
+
+def follow_messages(following):
+    """The NOTIFY listener is connected and listening (following=True), or has
+    lost its connection. Before following again every buffer is dropped: it
+    may have missed messages while nobody listened
+    """
+    global _following
+    with _room_buffer_lock:
+        if following:
+            _cache_clear(_room_buffers)
+            _cache_clear(_unbuffered_messages)
+        _following = following
+
+def follows_messages():
+    """Whether sync reads (after) may be answered from the room buffers"""
+    return _following
+
+def get_cache_stats():
+    """Get hit/miss stats of every cache"""
+    return {
+        'membership': _cache_stats(_membership),
+        'users': _cache_stats(_users),
+        'room_buffers': _cache_stats(_room_buffers)
+    }
@@ -1,54 +1,331 @@
+import atexit
+import logging
+import threading
+import weakref
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
 import psycopg
+from psycopg.pq import TransactionStatus
 from psycopg.rows import dict_row
-from config import DB_CONFIG
-
-def get_connection():
-    """Get database connection"""
-    return psycopg.connect(
-        host=DB_CONFIG['host'],
-        port=DB_CONFIG['port'],
-        dbname=DB_CONFIG['database'],
-        user=DB_CONFIG['user'],
-        password=DB_CONFIG['password']
-    )
-
-def execute_query(query, params=None, fetch_one=False, fetch_all=False):
-    """Execute a query and optionally fetch results"""
-    conn = get_connection()
-    cursor = conn.cursor(row_factory=dict_row)
-    
+from psycopg.types.numeric import Int8Dumper, Int8BinaryDumper
+from psycopg_pool import ConnectionPool
+from flask import g, has_request_context
+from config import (
+    DB_CONFIG, DB_POOL_CONFIG, DB_PIPELINE, DB_PREPARED_STATEMENTS,
+    SHARD_ROUTING, SHARD_DB_CONFIGS, METADATA_SHARD
+)
+
+logger = logging.getLogger(__name__)
+
+_pools = {}  # node -> pool (see route)
+_pool_lock = threading.Lock()
+
+# Statements prepared on each pooled connection, for the hit/miss counters
+_prepared = weakref.WeakKeyDictionary()
+_prepare_stats = {'hits': 0, 'misses': 0}
+_prepare_lock = threading.Lock()
+
+def configure_connection(conn):
+    """Dump every Python int as int8 so a statement keeps one parameter
+    signature (psycopg otherwise picks int2/int4/int8 by value, and each
+    signature is a separate prepared statement)
+    """
+    conn.adapters.register_dumper(int, Int8Dumper)
+    conn.adapters.register_dumper(int, Int8BinaryDumper)
+
+def _check_connection(conn):
+    """Health check run on every checkout; a broken connection is discarded"""
+    conn.autocommit = True
     try:
-        cursor.execute(query, params)
-        
-        if fetch_one:
-            result = cursor.fetchone()
-        elif fetch_all:
-            result = cursor.fetchall()
+        conn.execute("SELECT 1")
+    finally:
+        conn.autocommit = False
+
+# ============ SHARD ROUTING ============
+# SHARD_ROUTING='proxy': every statement goes to ShardingSphere, which parses
+# it and routes it to ds_N. SHARD_ROUTING='direct': the caller names the shard
+# (shard=message_shard(room_id) for messages statements, None for the
+# users/rooms/room_members tables on the metadata node) and the statement goes
+# straight to that shard's pool, with no proxy hop and no proxy parse
+
+def route(shard=None):
+    """Get the node a statement for `shard` runs on: 'proxy', or a shard index
+    (None = the metadata node)
+    """
+    if SHARD_ROUTING != 'direct':
+        return 'proxy'
+    return METADATA_SHARD if shard is None else shard
+
+def connection_kwargs(node):
+    """psycopg connection arguments of a node"""
+    config = DB_CONFIG if node == 'proxy' else SHARD_DB_CONFIGS[node]
+    return {
+        'host': config['host'],
+        'port': config['port'],
+        'dbname': config['database'],
+        'user': config['user'],
+        'password': config['password']
+    }
+
+def get_pool(shard=None):
+    """Get the process-wide connection pool of a shard's node, opening it on first use"""
+    node = route(shard)
+    pool = _pools.get(node)
+    if pool is None:
+        with _pool_lock:
+            pool = _pools.get(node)
+            if pool is None:
+                if not _pools:
+                    atexit.register(close_pool)
+                pool = _pools[node] = ConnectionPool(
+                    kwargs=connection_kwargs(node),
+                    min_size=DB_POOL_CONFIG['min_size'],
+                    max_size=DB_POOL_CONFIG['max_size'],
+                    max_idle=DB_POOL_CONFIG['max_idle'],
+                    timeout=DB_POOL_CONFIG['timeout'],
+                    configure=configure_connection,
+                    check=_check_connection,
+                    name='chat_pool' if node == 'proxy' else f'chat_pool_ds_{node}',
+                    open=True
+                )
+    return pool
+
+def close_pool():
+    """Close every connection pool (e.g. on shutdown)"""
+    with _pool_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+def get_pool_stats():
+    """Get connection pool usage (the metadata node's pool in direct mode),
+    with the usage of each shard's pool under 'shards' in direct mode
+    """
+    stats = pool_stats(get_pool())
+    if SHARD_ROUTING == 'direct':
+        stats['shards'] = {f'ds_{node}': pool_stats(pool) for node, pool in sorted(list(_pools.items()))}
+    return stats
+
+def pool_stats(pool):
+    """Get one pool's usage: size, in use, waiting and checkout wait time"""
+    stats = pool.get_stats()
+    requests_num = stats.get('requests_num', 0)
+    wait_ms = stats.get('requests_wait_ms', 0)
+    return {
+        'min_size': stats.get('pool_min', 0),
+        'max_size': stats.get('pool_max', 0),
+        'size': stats.get('pool_size', 0),
+        'available': stats.get('pool_available', 0),
+        'in_use': stats.get('pool_size', 0) - stats.get('pool_available', 0),
+        'waiting': stats.get('requests_waiting', 0),
+        'checkouts': requests_num,
+        'checkout_errors': stats.get('requests_errors', 0),
+        'checkout_wait_ms_total': wait_ms,
+        'checkout_wait_ms_avg': round(wait_ms / requests_num, 3) if requests_num else 0,
+        'connections_lost': stats.get('connections_lost', 0)
+    }
+
+# ============ PREPARED STATEMENTS ============
+
+def prepare_flag(conn, query, prepare):
+    """Get the psycopg prepare= argument for a statement and count hits/misses
+
+    Hot statements (prepare=True) are kept as named server-side prepared
+    statements on each pooled connection, so they are parsed and planned once
+    per connection instead of once per call. Other statements keep psycopg's
+    default (auto-prepare after a few executions).
+    """
+    if not prepare or not DB_PREPARED_STATEMENTS:
+        return None
+    with _prepare_lock:
+        seen = _prepared.setdefault(conn, set())
+        if query in seen:
+            _prepare_stats['hits'] += 1
         else:
-            result = None
-            
+            _prepare_stats['misses'] += 1
+            seen.add(query)
+    return True
+
+def get_prepare_stats():
+    """Get prepared statement reuse: hits, misses and hit rate"""
+    with _prepare_lock:
+        hits = _prepare_stats['hits']
+        misses = _prepare_stats['misses']
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / total, 4) if total else 0
+    }
+
+# ============ REQUEST-SCOPED UNIT OF WORK ============
+
+def init_app(app):
+    """Give every HTTP request one connection and one transaction"""
+    app.after_request(_finish_request_transaction)
+    app.teardown_request(_release_request_connection)
+
+def read_only(f):
+    """Decorator for routes that never write: the request transaction is not committed"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.db_read_only = True
+        return f(*args, **kwargs)
+    return decorated_function
+
+def _get_request_connection(shard=None):
+    """Get the connection bound to the current request on a shard's node,
+    checking one out on first use
+    """
+    node = route(shard)
+    conns = g.setdefault('db_conns', {})
+    conn = conns.get(node)
+    if conn is None:
+        conn = conns[node] = get_pool(shard).getconn()
+    return conn
+
+def on_commit(callback):
+    """Run callback() once the request transaction has committed (dropped on rollback)
+    Outside a request the work is already committed, so it runs immediately
+    """
+    if has_request_context():
+        g.setdefault('db_on_commit', []).append(callback)
+    else:
+        callback()
+
+def _finish_request_transaction(response):
+    """Commit the request transaction once; roll back error responses and read-only routes
+    In direct mode each node the request wrote to commits in turn (like the
+    proxy's LOCAL transactions, this is not atomic across shards)
+    """
+    conns = g.get('db_conns', {})
+    callbacks = g.pop('db_on_commit', [])
+    if g.get('db_read_only') or response.status_code >= 400:
+        for conn in conns.values():
+            conn.rollback()
+        return response
+    for conn in conns.values():
         conn.commit()
-        return result
-    except Exception as e:
-        conn.rollback()
-        raise e
-    finally:
-        cursor.close()
-        conn.close()
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception:
+            # already committed: an error response would make the client retry
+            # (and e.g. send its message twice), so a failed callback is only logged
+            logger.exception('on_commit callback %r failed', callback)
+    return response
+
+def _release_request_connection(exc=None):
+    """Return the request connections to their pools, rolling back anything left open"""
+    for node, conn in g.pop('db_conns', {}).items():
+        try:
+            if conn.info.transaction_status != TransactionStatus.IDLE:
+                conn.rollback()
+        except psycopg.Error:
+            pass  # broken connection: the pool discards it on return
+        finally:
+            _pools[node].putconn(conn)
+
+@contextmanager
+def get_connection(shard=None):
+    """Get a connection to a shard's node for the current unit of work
+
+    Inside a request this is the request-scoped connection and the commit is
+    deferred to the end of the request. Outside a request (scripts, background
+    threads) a connection is borrowed from the pool and committed on exit.
+    """
+    if has_request_context():
+        yield _get_request_connection(shard)
+    else:
+        with get_pool(shard).connection() as conn:
+            yield conn
+
+def execute_query(query, params=None, fetch_one=False, fetch_all=False, prepare=False, shard=None):
+    """Execute a query and optionally fetch results (prepare=True for hot statements)
+    shard: the shard that owns the rows (messages), None for metadata tables
+    """
+    with get_connection(shard) as conn:
+        with conn.cursor(row_factory=dict_row) as cursor:
+            cursor.execute(query, params, prepare=prepare_flag(conn, query, prepare))
+
+            if fetch_one:
+                return cursor.fetchone()
+            elif fetch_all:
+                return cursor.fetchall()
+            return None
 
-def execute_insert(query, params=None):
+def execute_detached(query, params=None, fetch_one=False, fetch_all=False, shard=None):
+    """Execute one statement in its own short transaction, outside the unit of
+    work of the current request (committed at once, e.g. reserving an id block)
+    """
+    with get_pool(shard).connection() as conn:
+        with conn.cursor(row_factory=dict_row) as cursor:
+            cursor.execute(query, params)
+            if fetch_one:
+                return cursor.fetchone()
+            if fetch_all:
+                return cursor.fetchall()
+            return None
+
+def execute_insert(query, params=None, prepare=False, shard=None):
     """Execute insert and return the inserted id using RETURNING"""
-    conn = get_connection()
-    cursor = conn.cursor(row_factory=dict_row)
-    
-    try:
-        cursor.execute(query + " RETURNING id", params)
-        result = cursor.fetchone()
-        conn.commit()
-        return result['id'] if result else None
-    except Exception as e:
-        conn.rollback()
-        raise e
-    finally:
-        cursor.close()
-        conn.close()
+    with get_connection(shard) as conn:
+        with conn.cursor(row_factory=dict_row) as cursor:
+            query = query + " RETURNING id"
+            cursor.execute(query, params, prepare=prepare_flag(conn, query, prepare))
+            result = cursor.fetchone()
+            return result['id'] if result else None
+
+def execute_batch(statements, prepare=False, detached=False, shard=None):
+    """Execute several independent statements with a single network flush
+
+    statements: list of (query, params, fetch) tuples where fetch is 'one',
+    'all' or None. Statements are sent back-to-back in psycopg pipeline mode
+    and the results are returned in the same order once the pipeline syncs.
+    Falls back to sequential execution when pipelining is unavailable.
+    prepare=True keeps every statement of the batch prepared on the connection.
+    detached=True runs on a connection of its own, outside the request's unit
+    of work (reads that run in parallel, one per shard).
+    Every statement goes to the node of `shard` (see execute_routed for
+    statements on different shards).
+    """
+    with get_pool(shard).connection() if detached else get_connection(shard) as conn:
+        use_pipeline = DB_PIPELINE and psycopg.Pipeline.is_supported()
+        cursors = []
+        try:
+            with conn.pipeline() if use_pipeline else nullcontext():
+                for query, params, fetch in statements:
+                    cursor = conn.cursor(row_factory=dict_row)
+                    cursors.append(cursor)
+                    cursor.execute(query, params, prepare=prepare_flag(conn, query, prepare))
+
+            results = []
+            for cursor, (_, _, fetch) in zip(cursors, statements):
+                if fetch == 'one':
+                    results.append(cursor.fetchone())
+                elif fetch == 'all':
+                    results.append(cursor.fetchall())
+                else:
+                    results.append(None)
+            return results
+        finally:
+            for cursor in cursors:
+                cursor.close()
+
+def execute_routed(statements, prepare=False):
+    """execute_batch for statements that may live on different shards
+
+    statements: list of (query, params, fetch, shard) tuples. Statements on
+    the same node share one pipelined batch (through the proxy that is all of
+    them: one round trip); results are returned in statement order.
+    """
+    by_node = {}
+    for index, (query, params, fetch, shard) in enumerate(statements):
+        by_node.setdefault(route(shard), (shard, []))[1].append((index, (query, params, fetch)))
+    results = [None] * len(statements)
+    for shard, indexed in by_node.values():
+        batch = execute_batch([statement for _, statement in indexed], prepare=prepare, shard=shard)
+        for (index, _), result in zip(indexed, batch):
+            results[index] = result
+    return results
@@ -0,0 +1,264 @@
+# Compare the copies of users and rooms on every shard with ds_0 (DIRECTORY_REPLICATION)
+#   python directory_check.py            # report differences (exit 1 if any)
+#   python directory_check.py --repair   # make the copies match ds_0
+# ds_0 is the source of truth. Each table is compared in buckets (id % --buckets):
+# one query per node returns the row count and a checksum of every bucket, and
+# only the rows of buckets that differ are read and compared. A difference is
+# only reported if it is still there --recheck-seconds later (a write reaches
+# ds_0 and the copies in separate commits). --repair deletes rows ds_0 does not
+# have, then inserts or overwrites the missing and different ones. Run it with
+# --repair once when turning replication on (or adding a shard) to fill the copies.
+# With MEMBER_SHARDING it also checks member_rooms against room_members (see
+# check_members), and --repair moves room_members rows to their room's shard
+# (e.g. every row still on ds_0 when MEMBER_SHARDING is turned on)
+import argparse
+import contextlib
+import sys
+import time
+
+import psycopg
+from psycopg import sql
+from psycopg.rows import dict_row
+from config import SHARD_DB_CONFIGS, METADATA_SHARD, MESSAGE_SHARDS, MEMBER_SHARDING
+from db import connection_kwargs
+from placement import shard_of
+from shard_routes import ROUTES_SQL, route_of
+
+# Replicated tables and the columns that must match
+TABLES = {
+    'users': ('id', 'username', 'created_at'),
+    'rooms': ('id', 'codename', 'type', 'created_at')
+}
+
+# Order-independent: the sum of a 60-bit hash of every row (as in reshard.py)
+BUCKETS_SQL = """
+    SELECT t.id % {buckets} AS bucket, count(*) AS rows,
+           sum(('x' || left(md5(t::text), 15))::bit(60)::bigint) AS checksum
+    FROM (SELECT {columns} FROM {table}) t
+    GROUP BY 1
+"""
+ROWS_SQL = "SELECT {columns} FROM {table} WHERE id %% {buckets} = ANY(%s)"
+ROWS_BY_ID_SQL = "SELECT {columns} FROM {table} WHERE id = ANY(%s)"
+DELETE_SQL = "DELETE FROM {table} WHERE id = ANY(%s)"
+UPSERT_SQL = """
+    INSERT INTO {table} ({columns}) VALUES ({values})
+    ON CONFLICT (id) DO UPDATE SET {updates}
+"""
+
+def connect(shard):
+    """A connection of its own to a shard"""
+    return psycopg.connect(**connection_kwargs(shard), row_factory=dict_row)
+
+def compose(query, table, buckets=None):
+    """Fill a query template for one table"""
+    columns = TABLES[table]
+    return sql.SQL(query).format(
+        table=sql.Identifier(table),
+        columns=sql.SQL(', ').join(map(sql.Identifier, columns)),
+        values=sql.SQL(', ').join([sql.Placeholder()] * len(columns)),
+        updates=sql.SQL(', ').join(
+            sql.SQL('{0} = EXCLUDED.{0}').format(sql.Identifier(column)) for column in columns[1:]
+        ),
+        buckets=sql.Literal(buckets)
+    )
+
+def bucket_sums(conn, table, buckets):
+    """{bucket: (rows, checksum)} of a table on one node"""
+    rows = conn.execute(compose(BUCKETS_SQL, table, buckets)).fetchall()
+    return {row['bucket']: (row['rows'], row['checksum']) for row in rows}
+
+def rows_by_id(conn, query, table, buckets, keys):
+    """{id: row} of the rows a ROWS_SQL / ROWS_BY_ID_SQL query selects"""
+    return {row['id']: row for row in conn.execute(compose(query, table, buckets), (keys,)).fetchall()}
+
+def diff_rows(source, copy):
+    """Ids missing from the copy, different in it, and only in it"""
+    missing = [row_id for row_id in source if row_id not in copy]
+    different = [row_id for row_id in source if row_id in copy and copy[row_id] != source[row_id]]
+    extra = [row_id for row_id in copy if row_id not in source]
+    return missing, different, extra
+
+def check_table(meta, replica, table, buckets, recheck_seconds):
+    """Compare one table of a copy with ds_0; returns (missing, different, extra) ids"""
+    source_sums, copy_sums = bucket_sums(meta, table, buckets), bucket_sums(replica, table, buckets)
+    bad = [bucket for bucket in set(source_sums) | set(copy_sums) if source_sums.get(bucket) != copy_sums.get(bucket)]
+    if not bad:
+        return [], [], []
+    missing, different, extra = diff_rows(
+        rows_by_id(meta, ROWS_SQL, table, buckets, bad), rows_by_id(replica, ROWS_SQL, table, buckets, bad)
+    )
+    suspects = missing + different + extra
+    if not suspects or not recheck_seconds:
+        return missing, different, extra
+    time.sleep(recheck_seconds)  # let writes that were still committing land on both sides
+    return diff_rows(
+        rows_by_id(meta, ROWS_BY_ID_SQL, table, buckets, suspects),
+        rows_by_id(replica, ROWS_BY_ID_SQL, table, buckets, suspects)
+    )
+
+def repair_table(meta, replica, table, missing, different, extra):
+    """Make a copy match ds_0 for the ids check_table found (one transaction)"""
+    rows = rows_by_id(meta, ROWS_BY_ID_SQL, table, None, missing + different)
+    with replica.transaction():
+        if extra:
+            replica.execute(compose(DELETE_SQL, table), (extra,))
+        if rows:
+            with replica.cursor() as cursor:
+                # rows that differ first: one may hold a username or codename a missing row needs
+                ordered = [rows[row_id] for row_id in different + missing if row_id in rows]
+                cursor.executemany(compose(UPSERT_SQL, table), [tuple(row.values()) for row in ordered])
+
+# ============ MEMBERSHIP COPIES (MEMBER_SHARDING) ============
+# room_members rows count on their room's read shard only: a moving room's
+# second copy is reshard.py's to check, and rows on any other shard are
+# misplaced. member_rooms rows count on their user's shard. Both sides are
+# summed per bucket ((room_id + user_id) % buckets) over all shards, and only
+# the pairs of differing buckets are compared
+
+ROOM_IDS_SQL = "SELECT DISTINCT room_id FROM room_members"
+PAIR_CHECKSUM = "sum(('x' || left(md5(room_id || ':' || user_id), 15))::bit(60)::bigint)"
+BY_ROOM_BUCKETS_SQL = f"""
+    SELECT (room_id + user_id) %% %s AS bucket, count(*) AS rows, {PAIR_CHECKSUM} AS checksum
+    FROM room_members WHERE NOT (room_id = ANY(%s))
+    GROUP BY 1
+"""
+BY_USER_BUCKETS_SQL = f"""
+    SELECT (room_id + user_id) %% %s AS bucket, count(*) AS rows, {PAIR_CHECKSUM} AS checksum
+    FROM member_rooms WHERE user_id %% {MESSAGE_SHARDS} = %s
+    GROUP BY 1
+"""
+BY_ROOM_PAIRS_SQL = """
+    SELECT room_id, user_id FROM room_members
+    WHERE (room_id + user_id) %% %s = ANY(%s) AND NOT (room_id = ANY(%s))
+"""
+BY_USER_PAIRS_SQL = f"""
+    SELECT room_id, user_id FROM member_rooms
+    WHERE (room_id + user_id) %% %s = ANY(%s) AND user_id %% {MESSAGE_SHARDS} = %s
+"""
+ROOM_ROWS_SQL = "SELECT room_id, user_id, slot FROM room_members WHERE room_id = ANY(%s)"
+MOVE_ROOM_ROW_SQL = "INSERT INTO room_members (room_id, user_id, slot) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING"
+DELETE_ROOM_ROWS_SQL = "DELETE FROM room_members WHERE room_id = ANY(%s)"
+ADD_PAIR_SQL = "INSERT INTO member_rooms (user_id, room_id) VALUES (%s, %s) ON CONFLICT DO NOTHING"
+DELETE_PAIR_SQL = "DELETE FROM member_rooms WHERE user_id = %s AND room_id = %s"
+
+def room_placement(meta):
+    """(read shard, write shards) of a room, from room_shards and placement.py"""
+    routes = {row['room_id']: route_of(row) for row in meta.execute(ROUTES_SQL).fetchall()}
+    return lambda room_id: routes.get(room_id) or (shard_of(room_id), (shard_of(room_id),))
+
+def not_read_here(conns, placement):
+    """{shard: room ids whose room_members rows there do not count}, and the
+    misplaced ones among them {shard: room ids}
+    """
+    skipped, misplaced = {}, {}
+    for shard, conn in conns.items():
+        rooms = [row['room_id'] for row in conn.execute(ROOM_IDS_SQL).fetchall()]
+        skipped[shard] = [room_id for room_id in rooms if placement(room_id)[0] != shard]
+        misplaced[shard] = [room_id for room_id in skipped[shard] if shard not in placement(room_id)[1]]
+    return skipped, misplaced
+
+def move_misplaced(conns, placement, misplaced):
+    """Move misplaced room_members rows to their room's read shard"""
+    for shard, room_ids in misplaced.items():
+        if not room_ids:
+            continue
+        rows = conns[shard].execute(ROOM_ROWS_SQL, (room_ids,)).fetchall()
+        for row in rows:
+            conns[placement(row['room_id'])[0]].execute(MOVE_ROOM_ROW_SQL, (row['room_id'], row['user_id'], row['slot']))
+        conns[shard].execute(DELETE_ROOM_ROWS_SQL, (room_ids,))
+
+def member_sums(conns, skipped, buckets):
+    """{bucket: [rows, checksum]} of both sides, summed over the shards"""
+    by_room, by_user = {}, {}
+    for shard, conn in conns.items():
+        sides = [(by_room, conn.execute(BY_ROOM_BUCKETS_SQL, (buckets, skipped[shard])))]
+        if shard < MESSAGE_SHARDS:
+            sides.append((by_user, conn.execute(BY_USER_BUCKETS_SQL, (buckets, shard))))
+        for sums, cursor in sides:
+            for row in cursor.fetchall():
+                total = sums.setdefault(row['bucket'], [0, 0])
+                total[0] += row['rows']
+                total[1] += row['checksum']
+    return by_room, by_user
+
+def member_pairs(conns, skipped, buckets, bad):
+    """The (room_id, user_id) pairs of some buckets on both sides"""
+    by_room, by_user = set(), set()
+    for shard, conn in conns.items():
+        by_room.update((row['room_id'], row['user_id']) for row in conn.execute(BY_ROOM_PAIRS_SQL, (buckets, bad, skipped[shard])))
+        if shard < MESSAGE_SHARDS:
+            by_user.update((row['room_id'], row['user_id']) for row in conn.execute(BY_USER_PAIRS_SQL, (buckets, bad, shard)))
+    return by_room, by_user
+
+def check_members(conns, meta, buckets, recheck_seconds, repair):
+    """Compare member_rooms with room_members; returns (misplaced rooms,
+    missing pairs, extra pairs) as found before any repair
+    """
+    placement = room_placement(meta)
+    skipped, misplaced = not_read_here(conns, placement)
+    misplaced_rooms = sum(len(room_ids) for room_ids in misplaced.values())
+    if misplaced_rooms and repair:
+        move_misplaced(conns, placement, misplaced)
+        skipped, _ = not_read_here(conns, placement)
+    by_room, by_user = member_sums(conns, skipped, buckets)
+    bad = [bucket for bucket in set(by_room) | set(by_user) if by_room.get(bucket) != by_user.get(bucket)]
+    if not bad:
+        return misplaced_rooms, [], []
+    rooms_side, users_side = member_pairs(conns, skipped, buckets, bad)
+    missing, extra = rooms_side - users_side, users_side - rooms_side
+    if (missing or extra) and recheck_seconds:
+        time.sleep(recheck_seconds)  # joins and leaves still committing their second copy
+        rooms_side, users_side = member_pairs(conns, skipped, buckets, bad)
+        missing &= rooms_side - users_side
+        extra &= users_side - rooms_side
+    if repair:
+        for room_id, user_id in missing:
+            conns[user_id % MESSAGE_SHARDS].execute(ADD_PAIR_SQL, (user_id, room_id))
+        for room_id, user_id in extra:
+            conns[user_id % MESSAGE_SHARDS].execute(DELETE_PAIR_SQL, (user_id, room_id))
+    return misplaced_rooms, sorted(missing), sorted(extra)
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the users and rooms copies on every shard against ds_0')
+    parser.add_argument('--repair', action='store_true', help='Make the copies match ds_0')
+    parser.add_argument('--shards', help='Comma-separated shard indexes (default: every shard but ds_0)')
+    parser.add_argument('--buckets', type=int, default=256, help='Checksum buckets per table')
+    parser.add_argument('--recheck-seconds', type=float, default=2, help='Wait before confirming a difference (0 = no recheck)')
+    args = parser.parse_args()
+
+    shards = [int(shard) for shard in args.shards.split(',')] if args.shards else [
+        shard for shard in range(len(SHARD_DB_CONFIGS)) if shard != METADATA_SHARD
+    ]
+
+    print(f"\n{'Copy':<8} {'Table':<8} {'Missing':>10} {'Different':>10} {'Extra':>10}")
+    print("-"*50)
+    differences = 0
+    with contextlib.ExitStack() as stack:
+        conns = {shard: stack.enter_context(connect(shard)) for shard in range(len(SHARD_DB_CONFIGS))}
+        for conn in conns.values():
+            conn.autocommit = True
+        meta = conns[METADATA_SHARD]
+        for shard in shards:
+            for table in TABLES:
+                missing, different, extra = check_table(meta, conns[shard], table, args.buckets, args.recheck_seconds)
+                print(f"{f'ds_{shard}':<8} {table:<8} {len(missing):>10} {len(different):>10} {len(extra):>10}")
+                found = len(missing) + len(different) + len(extra)
+                if found and args.repair:
+                    repair_table(meta, conns[shard], table, missing, different, extra)
+                    print(f"         repaired {found} rows")
+                elif found:
+                    differences += found
+        if MEMBER_SHARDING:
+            misplaced, missing, extra = check_members(conns, meta, args.buckets, args.recheck_seconds, args.repair)
+            print(f"{'all':<8} {'members':<8} {len(missing):>10} {'-':>10} {len(extra):>10}")
+            print(f"         {misplaced} rooms with room_members rows off their shard")
+            if args.repair:
+                print(f"         repaired {misplaced} rooms and {len(missing) + len(extra)} member_rooms rows")
+            else:
+                differences += misplaced + len(missing) + len(extra)
+    print("-"*50)
+    print('Copies match ds_0' if not differences else f'{differences} rows differ (run with --repair)')
+    return 1 if differences else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
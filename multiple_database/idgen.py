@@ -0,0 +1,63 @@
+# Id allocation without a round trip per insert (hi/lo)
+# Each worker reserves a block of ID_BLOCK_SIZE ids at a time from the
+# id_blocks table, in a short transaction of its own so the counter row is
+# never locked for the length of a request, and hands them out in process.
+# Ids stay unique across workers; the unused rest of a block is skipped
+# when the process exits
+import threading
+from db import execute_detached
+from config import ID_BLOCK_SIZE
+
+RESERVE_BLOCK_SQL = """
+    UPDATE id_blocks SET next_id = next_id + %s
+    WHERE name = %s
+    RETURNING next_id - %s AS first_id
+"""
+
+# Tables that also insert with a SERIAL default take their blocks from the
+# same sequence instead, so both kinds of insert get unique ids (none here:
+# every table on the proxy is BIGINT without a default)
+SEQUENCES = {}
+
+RESERVE_SEQUENCE_SQL = "SELECT nextval(%s) AS id FROM generate_series(1, %s)"
+
+_blocks = {}  # name -> iterator over the rest of the current block
+_lock = threading.Lock()
+_stats = {'ids': 0, 'blocks': 0}
+
+def reserve_block_statement(name):
+    """Get the (query, params) that reserves the next block of ids"""
+    if name in SEQUENCES:
+        return RESERVE_SEQUENCE_SQL, (SEQUENCES[name], ID_BLOCK_SIZE)
+    return RESERVE_BLOCK_SQL, (ID_BLOCK_SIZE, name, ID_BLOCK_SIZE)
+
+def take_id(name):
+    """Hand out the next id of the current block, or None if it is used up (lock held)"""
+    new_id = next(_blocks.get(name, iter(())), None)
+    if new_id is not None:
+        _stats['ids'] += 1
+    return new_id
+
+def add_block(name, rows):
+    """Start handing out a block reserved with reserve_block_statement (lock held)"""
+    if not rows:
+        raise LookupError(f"id_blocks has no row for '{name}'")
+    if 'first_id' in rows[0]:
+        _blocks[name] = iter(range(rows[0]['first_id'], rows[0]['first_id'] + ID_BLOCK_SIZE))
+    else:
+        _blocks[name] = iter([row['id'] for row in rows])
+    _stats['blocks'] += 1
+
+def next_id(name):
+    """Get a new id for table `name`"""
+    with _lock:
+        new_id = take_id(name)
+        if new_id is None:
+            add_block(name, execute_detached(*reserve_block_statement(name), fetch_all=True))
+            new_id = take_id(name)
+        return new_id
+
+def get_idgen_stats():
+    """Get ids handed out and blocks reserved by this worker"""
+    with _lock:
+        return {'block_size': ID_BLOCK_SIZE, **_stats}
@@ -17,7 +17,17 @@ CREATE TABLE IF NOT EXISTS rooms (
 CREATE TABLE IF NOT EXISTS room_members (
     room_id BIGINT NOT NULL,
     user_id BIGINT NOT NULL,
-    PRIMARY KEY (room_id, user_id)
+    slot SMALLINT, -- 1 or 2 in DM rooms (at most 2 members), NULL in groups
+    PRIMARY KEY (room_id, user_id),
+    UNIQUE (room_id, slot)
+);
+
+-- By-user copy of room_members (MEMBER_SHARDING): a user's rows live on shard
+-- user_id % 4, room_members rows on the room's message shard
+CREATE TABLE IF NOT EXISTS member_rooms (
+    user_id BIGINT NOT NULL,
+    room_id BIGINT NOT NULL,
+    PRIMARY KEY (user_id, room_id)
 );
 
 CREATE TABLE IF NOT EXISTS messages (
@@ -28,11 +38,43 @@ CREATE TABLE IF NOT EXISTS messages (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Next free id per table, reserved in blocks by idgen.py (shard 0 only)
+CREATE TABLE IF NOT EXISTS id_blocks (
+    name VARCHAR(50) PRIMARY KEY,
+    next_id BIGINT NOT NULL
+);
+INSERT INTO id_blocks (name, next_id) VALUES ('rooms', 1), ('messages', 1) ON CONFLICT (name) DO NOTHING;
+-- users starts after the existing rows (user ids were not from id_blocks before)
+INSERT INTO id_blocks (name, next_id) SELECT 'users', COALESCE(MAX(id), 0) + 1 FROM users ON CONFLICT (name) DO NOTHING;
+
+-- Worker ids leased by app processes for message ids (snowflake.py, shard 0 only)
+-- last_ms: last millisecond the holder used, the next holder starts after it
+CREATE TABLE IF NOT EXISTS id_workers (
+    worker_id SMALLINT PRIMARY KEY,
+    owner VARCHAR(64),
+    lease_until TIMESTAMP NOT NULL DEFAULT '1970-01-01',
+    last_ms BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO id_workers (worker_id) SELECT generate_series(0, 127) ON CONFLICT (worker_id) DO NOTHING;
+
+-- Rooms whose messages moved off their placement shard (reshard.py, shard 0 only)
+-- dual: read from_shard, write both; flipped: read to_shard, write both;
+-- cleanup/done: to_shard only (cleanup: from_shard rows still being deleted)
+CREATE TABLE IF NOT EXISTS room_shards (
+    room_id BIGINT PRIMARY KEY,
+    from_shard SMALLINT NOT NULL,
+    to_shard SMALLINT NOT NULL,
+    state VARCHAR(16) NOT NULL,
+    copied_up_to BIGINT NOT NULL DEFAULT 0, -- last message id copied to to_shard
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
 -- Indexes
 CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);
 CREATE INDEX IF NOT EXISTS idx_rooms_codename ON rooms(codename);
 CREATE INDEX IF NOT EXISTS idx_room_members_room_id ON room_members(room_id);
 CREATE INDEX IF NOT EXISTS idx_room_members_user_id ON room_members(user_id);
-CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages(room_id);
+-- (room_id, id) backs keyset pagination of room history (and room_id lookups)
+CREATE INDEX IF NOT EXISTS idx_messages_room_id_id ON messages(room_id, id);
 CREATE INDEX IF NOT EXISTS idx_messages_sender_id ON messages(sender_id);
 CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages(created_at);
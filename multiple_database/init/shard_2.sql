@@ -1,14 +1,16 @@
 -- Shard 2 Schema (Messages only)
+-- users and rooms are copies of ds_0's with DIRECTORY_REPLICATION (same keys,
+-- so broadcast writes with ON CONFLICT (username) work on every shard)
 
 CREATE TABLE IF NOT EXISTS users (
     id BIGINT PRIMARY KEY,
-    username VARCHAR(255) NOT NULL,
+    username VARCHAR(255) NOT NULL UNIQUE,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
 CREATE TABLE IF NOT EXISTS rooms (
     id BIGINT PRIMARY KEY,
-    codename VARCHAR(8) NOT NULL,
+    codename VARCHAR(8) NOT NULL UNIQUE,
     type VARCHAR(50) NOT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
@@ -16,7 +18,17 @@ CREATE TABLE IF NOT EXISTS rooms (
 CREATE TABLE IF NOT EXISTS room_members (
     room_id BIGINT NOT NULL,
     user_id BIGINT NOT NULL,
-    PRIMARY KEY (room_id, user_id)
+    slot SMALLINT, -- 1 or 2 in DM rooms (at most 2 members), NULL in groups
+    PRIMARY KEY (room_id, user_id),
+    UNIQUE (room_id, slot)
+);
+
+-- By-user copy of room_members (MEMBER_SHARDING): a user's rows live on shard
+-- user_id % 4, room_members rows on the room's message shard
+CREATE TABLE IF NOT EXISTS member_rooms (
+    user_id BIGINT NOT NULL,
+    room_id BIGINT NOT NULL,
+    PRIMARY KEY (user_id, room_id)
 );
 
 CREATE TABLE IF NOT EXISTS messages (
@@ -28,6 +40,7 @@ CREATE TABLE IF NOT EXISTS messages (
 );
 
 -- Indexes
-CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages(room_id);
+-- (room_id, id) backs keyset pagination of room history (and room_id lookups)
+CREATE INDEX IF NOT EXISTS idx_messages_room_id_id ON messages(room_id, id);
 CREATE INDEX IF NOT EXISTS idx_messages_sender_id ON messages(sender_id);
 CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages(created_at);
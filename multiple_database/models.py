@@ -1,69 +1,207 @@
 # User functions (Functional style - no OOP)
-from db import execute_query, execute_insert
+from db import execute_query, execute_insert, execute_batch, execute_detached, execute_routed, on_commit
+from notify import notify_message, notify_messages
+from config import (
+    DB_NOTIFY, ROOM_BUFFER_SIZE, CODENAME_LEGACY_LOOKUP, MESSAGE_SHARDS, DIRECTORY_REPLICATION,
+    MEMBER_SHARDING, SHARD_ROUTING, SHARD_DB_CONFIGS, METADATA_SHARD
+)
+from singleflight import coalesced
+from codename import encode_codename, decode_codename
+from placement import shard_of
+from shard_routes import get_route
+import cache
+import shared_cache
+import idgen
+import snowflake
+import ingest
 import random
-import string
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
-# ============ HELPER FUNCTIONS ============
+# ============ DIRECTORY REPLICAS ============
+# With DIRECTORY_REPLICATION every shard holds a copy of users and rooms
 
-def generate_codename():
-    """Generate a random 8-character codename"""
-    chars = string.ascii_uppercase + string.digits
-    return ''.join(random.choices(chars, k=8))
+def directory_shard(room_id=None):
+    """Node to read users and rooms from: ds_0 (None), or with
+    DIRECTORY_REPLICATION the room's own shard, else any shard
+    """
+    if not DIRECTORY_REPLICATION:
+        return None
+    return message_shard(room_id) if room_id is not None else random.randrange(MESSAGE_SHARDS)
+
+def replica_shards():
+    """Nodes the app copies users and rooms writes to besides ds_0 (direct
+    routing only: through the proxy the BROADCAST rule writes every shard)
+    """
+    if not DIRECTORY_REPLICATION or SHARD_ROUTING != 'direct':
+        return []
+    return [shard for shard in range(len(SHARD_DB_CONFIGS)) if shard != METADATA_SHARD]
+
+def replicate_statements(query, params):
+    """execute_routed statements running one write on every copy"""
+    return [(query, params, None, shard) for shard in replica_shards()]
+
+# With MEMBER_SHARDING room_members lives on each room's message shard (moved
+# with it by reshard.py) and member_rooms on the user's shard; both joins of
+# the membership reads need the users and rooms copies there
+if MEMBER_SHARDING and not DIRECTORY_REPLICATION:
+    raise ValueError('MEMBER_SHARDING needs DIRECTORY_REPLICATION')
+
+def member_shard(user_id):
+    """Node of a user's member_rooms rows (ds_0 without MEMBER_SHARDING)"""
+    return user_id % MESSAGE_SHARDS if MEMBER_SHARDING else None
+
+def members_shard(room_id):
+    """Node a room's room_members rows are read from"""
+    return message_shard(room_id) if MEMBER_SHARDING else None
+
+def members_write_shards(room_id):
+    """Nodes a room's room_members rows are written to, the one they are read from first"""
+    return message_write_shards(room_id) if MEMBER_SHARDING else (None,)
 
 # ============ USER FUNCTIONS ============
 
+# A taken username inserts nothing (no separate username_exists check, no race)
+CREATE_USER_SQL = "INSERT INTO users (id, username, created_at) VALUES (%s, %s, %s) ON CONFLICT (username) DO NOTHING"
+
+# The row ds_0 stored, copied to the other shards; a copy that is already there
+# (or conflicts) is left for directory_check.py
+COPY_USER_SQL = "INSERT INTO users (id, username, created_at) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING"
+
 def create_user(username):
-    """Create a new user (SERIAL ID)"""
-    query = "INSERT INTO users (username) VALUES (%s)"
-    return execute_insert(query, (username,))
+    """Create a new user; returns None if the username is taken
+    The id (idgen.py) and created_at come from the app in every routing mode,
+    so the copies written by the proxy's BROADCAST rule or by replica_shards()
+    are the same row as ds_0's
+    """
+    user = (idgen.next_id('users'), username, datetime.now())
+    if execute_insert(CREATE_USER_SQL, user) is None:
+        return None
+    execute_routed(replicate_statements(COPY_USER_SQL, user))
+    return user[0]
+
+USER_BY_ID_SQL = "SELECT * FROM users WHERE id = %s"
+
+USERS_BY_IDS_SQL = "SELECT * FROM users WHERE id = ANY(%s)"
+
+def get_users_by_ids(user_ids):
+    """Get {user_id: user row, or None if deleted} for many users in at most one query
+    Only the ids missing from the user directory cache are fetched, from the
+    shared cache first, then from the database
+    """
+    users, missing = cache.get_cached_users(user_ids)
+    if missing:
+        shared = shared_cache.get_many(users=missing)[0]
+        users.update(restore_users(shared))
+        missing = [user_id for user_id in missing if user_id not in shared]
+    if missing:
+        rows = execute_query(USERS_BY_IDS_SQL, (missing,), fetch_all=True, prepare=True, shard=directory_shard())
+        fetched = cache.set_users(rows, missing)
+        shared_cache.set_users(fetched)
+        users.update(fetched)
+    return users
+
+def restore_users(shared):
+    """Put users read from the shared cache in the user directory cache"""
+    return cache.set_users([user for user in shared.values() if user], shared)
 
 def get_user_by_id(user_id):
-    """Get user by ID"""
-    query = "SELECT * FROM users WHERE id = %s"
-    return execute_query(query, (user_id,), fetch_one=True)
+    """Get user by ID (user directory cache)"""
+    return get_users_by_ids([user_id])[user_id]
+
+USER_BY_USERNAME_SQL = "SELECT * FROM users WHERE username = %s"
 
 def get_user_by_username(username):
     """Get user by username"""
-    query = "SELECT * FROM users WHERE username = %s"
-    return execute_query(query, (username,), fetch_one=True)
+    return execute_query(USER_BY_USERNAME_SQL, (username,), fetch_one=True, shard=directory_shard())
 
 def username_exists(username):
     """Check if username already exists"""
     user = get_user_by_username(username)
     return user is not None
 
+DELETE_USER_SQL = "DELETE FROM users WHERE id = %s"
+
 def delete_user(user_id):
     """Delete a user"""
-    query = "DELETE FROM users WHERE id = %s"
-    execute_query(query, (user_id,))
+    rooms = execute_query(MEMBER_ROOM_IDS_SQL, (user_id,), fetch_all=True, shard=member_shard(user_id)) if shared_cache.enabled() else []
+    execute_routed([(DELETE_USER_SQL, (user_id,), None, None), *replicate_statements(DELETE_USER_SQL, (user_id,))])
+    forget_member_rooms(user_id)
+    cache.invalidate_user(user_id)
+    on_commit(lambda: cache.set_users([], [user_id]))  # remember it as deleted
+    on_commit(cache.clear_room_buffers)  # their messages were deleted with them
+    on_commit(lambda: shared_cache.drop_member_rooms(user_id, deleted_user_commands(user_id, rooms)))
+
+def deleted_user_commands(user_id, rooms):
+    """Shared cache writes after deleting a user: a negative entry, and the
+    recent messages of their rooms dropped (rooms they had left keep them until the TTL)
+    """
+    return [
+        *shared_cache.set_users_commands({user_id: None}),
+        ('delete', shared_cache.member_rooms_key(user_id)),
+        *(command for row in rooms or [] for command in shared_cache.delete_recent_messages_commands(row['room_id']))
+    ]
 
 # ============ ROOM FUNCTIONS ============
 
+# created_at comes from the app, not each node's default, so every copy of a
+# replicated room (BROADCAST through the proxy or replica_shards()) is the same row
+CREATE_ROOM_SQL = "INSERT INTO rooms (id, codename, type, created_at) VALUES (%s, %s, %s, %s)"
+
+COPY_ROOM_SQL = "INSERT INTO rooms (id, codename, type, created_at) VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING"
+
+def create_room_statements(room_id, codename, room_type, creator_id):
+    """execute_routed statements creating a room on ds_0 (and its copies on
+    the other shards) with its creator as the first member
+    """
+    row = (room_id, codename, room_type, datetime.now())
+    room, copies = (CREATE_ROOM_SQL, row, None, None), replicate_statements(COPY_ROOM_SQL, row)
+    member = (room_id, creator_id, 1 if room_type == 'dm' else None)
+    members = [(ADD_ROOM_MEMBER_SQL, member, None, shard) for shard in members_write_shards(room_id)]
+    if MEMBER_SHARDING:
+        members.append((ADD_MEMBER_ROOM_SQL, (creator_id, room_id), None, member_shard(creator_id)))
+    return [room, *copies, *members]
+
 def create_room(room_type, creator_id):
-    """Create a new room and add creator as member"""
-    # Generate unique codename
-    codename = generate_codename()
-    while get_room_by_codename(codename):  # Ensure unique
-        codename = generate_codename()
-    
-    # Create room (SERIAL ID)
-    query = "INSERT INTO rooms (codename, type) VALUES (%s, %s)"
-    room_id = execute_insert(query, (codename, room_type))
-    
-    # Add creator as member
-    add_room_member(room_id, creator_id)
-    
+    """Create a new room and add creator as member, in one round trip
+    The id is handed out in process by idgen.py (hi/lo: now and then a block
+    of ID_BLOCK_SIZE ids is reserved from id_blocks in a short transaction of
+    its own, execute_detached, never in this one) and the codename is derived
+    from it, so there is nothing to look up and nothing that can collide
+    """
+    room_id = idgen.next_id('rooms')
+    codename = encode_codename(room_id)
+    execute_routed(create_room_statements(room_id, codename, room_type, creator_id), prepare=True)
+    forget_member_rooms(creator_id)
+    on_commit(lambda: shared_cache.add_member_room(creator_id, room_id))
     return room_id, codename
 
+ROOM_BY_ID_SQL = "SELECT * FROM rooms WHERE id = %s"
+
+@coalesced
 def get_room_by_id(room_id):
-    """Get room by ID"""
-    query = "SELECT * FROM rooms WHERE id = %s"
-    return execute_query(query, (room_id,), fetch_one=True)
+    """Get room by ID (shared cache first: rooms never change)"""
+    room = shared_cache.get_many(rooms=[room_id])[1].get(room_id)
+    if room is None:
+        room = execute_query(ROOM_BY_ID_SQL, (room_id,), fetch_one=True, shard=directory_shard(room_id))
+        shared_cache.set_room(room)
+    return room
+
+ROOM_BY_CODENAME_SQL = "SELECT * FROM rooms WHERE codename = %s"
 
 def get_room_by_codename(codename):
-    """Get room by codename"""
-    query = "SELECT * FROM rooms WHERE codename = %s"
-    return execute_query(query, (codename.upper(),), fetch_one=True)
+    """Get room by codename: decoded to its room id and read by primary key
+    (cached); rooms created before derived codenames are looked up by codename
+    """
+    codename = codename.upper()
+    room_id = decode_codename(codename)
+    if room_id is not None:
+        room = get_room_by_id(room_id)
+        if room and room['codename'] == codename:
+            return room
+    if not CODENAME_LEGACY_LOOKUP:
+        return None
+    return execute_query(ROOM_BY_CODENAME_SQL, (codename,), fetch_one=True, shard=directory_shard())
 
 def room_exists(room_id):
     """Check if room exists"""
@@ -72,102 +210,709 @@ def room_exists(room_id):
 
 # ============ ROOM MEMBER FUNCTIONS ============
 
-def add_room_member(room_id, user_id):
-    """Add user to room"""
-    # Check if already member first
-    if not is_room_member(room_id, user_id):
-        query = "INSERT INTO room_members (room_id, user_id) VALUES (%s, %s)"
-        execute_query(query, (room_id, user_id))
+ADD_ROOM_MEMBER_SQL = "INSERT INTO room_members (room_id, user_id, slot) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING"
+
+# The by-user copy of a membership (MEMBER_SHARDING), written after room_members
+ADD_MEMBER_ROOM_SQL = "INSERT INTO member_rooms (user_id, room_id) VALUES (%s, %s) ON CONFLICT DO NOTHING"
+REMOVE_MEMBER_ROOM_SQL = "DELETE FROM member_rooms WHERE user_id = %s AND room_id = %s"
+
+# Joining by codename in one statement: the room lookup (by the id the
+# codename decodes to, a primary key read; the codename must match), the
+# membership check, the DM limit and the insert. A DM member takes a free slot (1 or 2) and
+# UNIQUE (room_id, slot) turns a concurrent join into a conflict, so two users
+# can never both become the second member. status says which rule applied:
+# 'joined', 'member' (already a member) or 'full' (DM room); no row: no such room
+# (rooms and room_members both live on ds_0, so the proxy routes it there whole;
+# with MEMBER_SHARDING it runs on the room's shard, which has both too)
+JOIN_ROOM_SQL = """
+    WITH room AS (
+        SELECT * FROM rooms WHERE id = %s AND codename = %s
+    ), member AS (
+        SELECT rm.room_id FROM room_members rm, room
+        WHERE rm.room_id = room.id AND rm.user_id = %s
+    ), free_slot AS (
+        SELECT MIN(s.slot) AS slot FROM room, (VALUES (1), (2)) AS s(slot)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM room_members rm WHERE rm.room_id = room.id AND rm.slot = s.slot
+        )
+    ), joined AS (
+        INSERT INTO room_members (room_id, user_id, slot)
+        SELECT room.id, %s, CASE WHEN room.type = 'dm' THEN free_slot.slot END
+        FROM room, free_slot
+        WHERE NOT EXISTS (SELECT 1 FROM member)
+          AND (room.type <> 'dm' OR free_slot.slot IS NOT NULL)
+        ON CONFLICT DO NOTHING
+        RETURNING room_id, slot
+    )
+    SELECT room.*, (SELECT slot FROM joined) AS slot, CASE
+        WHEN EXISTS (SELECT 1 FROM joined) THEN 'joined'
+        WHEN room.type = 'dm' AND NOT EXISTS (SELECT 1 FROM member) THEN 'full'
+        ELSE 'member'
+    END AS status
+    FROM room
+"""
+
+# Same join for rooms whose codename does not decode to their id (made before
+# codename.py): the room is found by the codename column (CODENAME_LEGACY_LOOKUP)
+JOIN_LEGACY_ROOM_SQL = JOIN_ROOM_SQL.replace('WHERE id = %s AND codename = %s', 'WHERE codename = %s')
+
+def join_room_statements(codename, user_id):
+    """The (query, params) of a join to try in turn until one finds the room:
+    by the id the codename decodes to, then by the codename column for rooms
+    made before codename.py (only with CODENAME_LEGACY_LOOKUP)
+    """
+    codename = codename.upper()
+    room_id = decode_codename(codename)
+    statements = []
+    if room_id is not None:
+        statements.append((JOIN_ROOM_SQL, (room_id, codename, user_id, user_id)))
+    if CODENAME_LEGACY_LOOKUP:
+        statements.append((JOIN_LEGACY_ROOM_SQL, (codename, user_id, user_id)))
+    return statements
+
+def join_room(codename, user_id):
+    """Join a room by codename; returns the room row with its status, or None
+    if there is no such room
+    With MEMBER_SHARDING the statement runs on the room's shard (found from
+    the codename, usually without a query) and the copies follow
+    """
+    shard, mirrors, statements = None, (), join_room_statements(codename, user_id)
+    if MEMBER_SHARDING:
+        found = get_room_by_codename(codename)
+        if found is None:
+            return None
+        shard, *mirrors = members_write_shards(found['id'])
+        statements = [(JOIN_ROOM_SQL, (found['id'], found['codename'], user_id, user_id))]
+    room = None
+    for query, params in statements:
+        room = execute_query(query, params, fetch_one=True, prepare=True, shard=shard)
+        if room:
+            break
+    if room and room['status'] == 'joined':
+        if MEMBER_SHARDING:
+            execute_routed(join_copy_statements(room, user_id, mirrors))
+        forget_member_rooms(user_id)
+        on_commit(lambda: shared_cache.add_member_room(user_id, room['id']))
+    return room
+
+def join_copy_statements(room, user_id, mirrors):
+    """execute_routed statements copying a join: to the room's other shard
+    while reshard.py moves it, and to the user's member_rooms
+    """
+    statements = [(ADD_ROOM_MEMBER_SQL, (room['id'], user_id, room['slot']), None, mirror) for mirror in mirrors]
+    return statements + [(ADD_MEMBER_ROOM_SQL, (user_id, room['id']), None, member_shard(user_id))]
+
+def leave_copy_statements(room_id, user_id, mirrors):
+    """execute_routed statements copying a leave (see join_copy_statements)"""
+    statements = [(REMOVE_ROOM_MEMBER_SQL, (room_id, user_id), None, mirror) for mirror in mirrors]
+    if MEMBER_SHARDING:
+        statements.append((REMOVE_MEMBER_ROOM_SQL, (user_id, room_id), None, member_shard(user_id)))
+    return statements
+
+REMOVE_ROOM_MEMBER_SQL = "DELETE FROM room_members WHERE room_id = %s AND user_id = %s RETURNING room_id"
 
 def remove_room_member(room_id, user_id):
-    """Remove user from room"""
-    query = "DELETE FROM room_members WHERE room_id = %s AND user_id = %s"
-    execute_query(query, (room_id, user_id))
+    """Remove user from room; returns False if they were not a member"""
+    shard, *mirrors = members_write_shards(room_id)
+    if not execute_query(REMOVE_ROOM_MEMBER_SQL, (room_id, user_id), fetch_one=True, shard=shard):
+        return False
+    copies = leave_copy_statements(room_id, user_id, mirrors)
+    if copies:
+        execute_routed(copies)
+    forget_member_rooms(user_id)
+    on_commit(lambda: shared_cache.remove_member_room(user_id, room_id))
+    return True
+
+# room_members lives on ds_0 only, so every uncached check lands on that node:
+# the membership cache answers repeat checks in-process. With MEMBER_SHARDING
+# a user's rooms are one index range on the user's shard
+if MEMBER_SHARDING:
+    MEMBER_ROOM_IDS_SQL = "SELECT room_id FROM member_rooms WHERE user_id = %s"
+else:
+    MEMBER_ROOM_IDS_SQL = "SELECT room_id FROM room_members WHERE user_id = %s"
+
+def forget_member_rooms(user_id):
+    """Drop a user's cached rooms now and again once the change commits
+    (a concurrent request could re-cache the old rooms in between)
+    """
+    cache.invalidate_member(user_id)
+    on_commit(lambda: cache.invalidate_member(user_id))
+
+def remember_member_rooms(user_id, rows):
+    """Cache a user's room ids from MEMBER_ROOM_IDS_SQL rows; returns the set
+    (callers also write it to the shared cache)
+    """
+    return cache.set_member_rooms(user_id, (row['room_id'] for row in rows or []))
+
+def restore_member_rooms(user_id, room_id, shared):
+    """Check membership in room ids read from the shared cache, keeping them
+    in the membership cache when they contain the room
+    """
+    if room_id not in shared.get(user_id, ()):
+        return False
+    cache.set_member_rooms(user_id, shared[user_id])
+    return True
 
 def is_room_member(room_id, user_id):
-    """Check if user is member of room"""
-    query = "SELECT 1 FROM room_members WHERE room_id = %s AND user_id = %s"
-    result = execute_query(query, (room_id, user_id), fetch_one=True)
-    return result is not None
+    """Check if user is member of room (no query when the membership cache
+    or the shared cache says yes; the shared cache spares ds_0 across workers)
+    """
+    if cache.check_membership(user_id, room_id):
+        return True
+    if restore_member_rooms(user_id, room_id, shared_cache.get_many(member_rooms=[user_id])[2]):
+        return True
+    rows = execute_query(MEMBER_ROOM_IDS_SQL, (user_id,), fetch_all=True, prepare=True, shard=member_shard(user_id))
+    room_ids = remember_member_rooms(user_id, rows)
+    shared_cache.set_member_rooms(user_id, room_ids)
+    return room_id in room_ids
+
+def has_member(members, user_id):
+    """Check if user_id is in a ROOM_MEMBERS_SQL result"""
+    return any(member['id'] == user_id for member in members or [])
 
+ROOM_MEMBERS_SQL = """
+    SELECT u.id, u.username, u.created_at 
+    FROM room_members rm
+    JOIN users u ON rm.user_id = u.id
+    WHERE rm.room_id = %s
+"""
+
+@coalesced
 def get_room_members(room_id):
     """Get all members of a room with usernames"""
-    query = """
-        SELECT u.id, u.username, u.created_at 
-        FROM room_members rm
-        JOIN users u ON rm.user_id = u.id
-        WHERE rm.room_id = %s
-    """
-    return execute_query(query, (room_id,), fetch_all=True) or []
+    return execute_query(ROOM_MEMBERS_SQL, (room_id,), fetch_all=True, prepare=True, shard=members_shard(room_id)) or []
+
+ROOM_MEMBER_COUNT_SQL = "SELECT COUNT(*) as count FROM room_members WHERE room_id = %s"
 
 def get_room_member_count(room_id):
     """Get member count of a room"""
-    query = "SELECT COUNT(*) as count FROM room_members WHERE room_id = %s"
-    result = execute_query(query, (room_id,), fetch_one=True)
+    result = execute_query(ROOM_MEMBER_COUNT_SQL, (room_id,), fetch_one=True, shard=members_shard(room_id))
     return result['count'] if result else 0
 
 # ============ MESSAGE FUNCTIONS ============
 
-def create_message(room_id, sender_id, content):
-    """Create a new message (SERIAL ID) - SHARDED by room_id"""
-    query = "INSERT INTO messages (room_id, sender_id, content) VALUES (%s, %s, %s)"
-    return execute_insert(query, (room_id, sender_id, content))
+# messages.id has no default on the shards: ids come from snowflake.py
+CREATE_MESSAGE_SQL = "INSERT INTO messages (id, room_id, sender_id, content) VALUES (%s, %s, %s, %s) RETURNING *"
 
-def get_messages_by_room(room_id, limit=50):
-    """Get messages in a room - OPTIMIZED for sharding
-    Messages are sharded by room_id, users are not sharded
-    Using batch fetch for sender names instead of per-message query
+def create_message(room_id, sender_id, content, sender_name):
+    """Create a new message and return the inserted row - SHARDED by room_id
+    sender_name comes from the caller, so no users lookup is needed
     """
-    query = f"""
-        SELECT * FROM messages
-        WHERE room_id = %s
-        ORDER BY created_at ASC
-        LIMIT {int(limit)}
+    shard, *mirrors = message_write_shards(room_id)
+    params = (new_message_id(room_id, shard), room_id, sender_id, content)
+    message = dict(execute_query(CREATE_MESSAGE_SQL, params, fetch_one=True, prepare=True, shard=shard))
+    message['sender_name'] = sender_name
+    for mirror in mirrors:  # a room being moved (reshard.py) is written to both its shards
+        execute_query(*insert_messages_statement([message]), shard=mirror)
+    on_commit(lambda: cache.append_room_message(room_id, message))
+    on_commit(lambda: shared_cache.append_recent_message(room_id, message))
+    if DB_NOTIFY:
+        notify_message(room_id, message['id'])
+    return message
+
+# Messages built in process (batch send, write-behind ingestion, mirror
+# writes of a room being moved): insert_messages_statements splits them by
+# shard and each shard gets one multi-row INSERT. The ids already exist
+# (snowflake.py), so inserting the same rows again (a batch replayed after a
+# crash) is a no-op
+INSERT_MESSAGES_SQL = """
+    INSERT INTO messages (id, room_id, sender_id, content, created_at)
+    VALUES {rows}
+    ON CONFLICT (id) DO NOTHING
+"""
+
+# Write-behind ingestion (INGEST_QUEUE, see ingest.py): queued messages get
+# their ids when the flusher writes them, so they follow commit order like
+# create_message's. A message already on the shard (a batch retried after an
+# unknown outcome, or replayed from a spill file) is recognised by its room,
+# sender and accept time and skipped; RETURNING holds the ids written
+INGEST_MESSAGES_SQL = """
+    INSERT INTO messages (id, room_id, sender_id, content, created_at)
+    SELECT * FROM (VALUES {rows}) AS batch(id, room_id, sender_id, content, created_at)
+    WHERE NOT EXISTS (
+        SELECT 1 FROM messages m
+        WHERE m.created_at = batch.created_at AND m.room_id = batch.room_id AND m.sender_id = batch.sender_id
+    )
+    ON CONFLICT (id) DO NOTHING
+    RETURNING id
+"""
+
+MESSAGE_COLUMNS = ('id', 'room_id', 'sender_id', 'content', 'created_at')
+
+# One reader thread per shard for parallel multi-room reads
+_shard_readers = ThreadPoolExecutor(max_workers=MESSAGE_SHARDS, thread_name_prefix='shard-read')
+
+def message_shard(room_id):
+    """Index of the shard that stores a room's messages (placement.py, the same
+    table as the proxy's INLINE rule; the shard= of every messages statement)
+    A room moved by reshard.py is read from the shard its route names
+    """
+    route = get_route(room_id)
+    return shard_of(room_id) if route is None else route[0]
+
+def message_write_shards(room_id):
+    """Shards a room's new messages go to, the one it is read from first
+    (two while reshard.py moves the room)
+    """
+    route = get_route(room_id)
+    return (shard_of(room_id),) if route is None else route[1]
+
+def new_message_id(room_id, shard=None):
+    """A new id (snowflake.py) tagged with the room's write shard, after the
+    room's newest message buffered by this worker
+    """
+    if shard is None:
+        shard = message_write_shards(room_id)[0]
+    return snowflake.next_id(shard, cache.get_latest_message_id(room_id))
+
+def insert_messages_statements(messages, sql=INSERT_MESSAGES_SQL):
+    """Get one (query, params, shard) per shard that inserts a batch of messages"""
+    by_shard = {}
+    for message in messages:
+        for shard in message_write_shards(message['room_id']):
+            by_shard.setdefault(shard, []).append(message)
+    return [(*insert_messages_statement(shard_messages, sql), shard) for shard, shard_messages in by_shard.items()]
+
+def insert_messages_statement(messages, sql=INSERT_MESSAGES_SQL):
+    """Get the (query, params) that inserts messages into one shard"""
+    rows = ', '.join(['(%s, %s, %s, %s, %s)'] * len(messages))
+    params = tuple(message[column] for message in messages for column in MESSAGE_COLUMNS)
+    return sql.format(rows=rows), params
+
+def new_message(message_id, room_id, sender_id, content, sender_name):
+    """A message row built in process (inserted later by insert_messages_statements)"""
+    return {
+        'id': message_id,
+        'room_id': room_id,
+        'sender_id': sender_id,
+        'content': content,
+        'created_at': datetime.now(),
+        'sender_name': sender_name
+    }
+
+def create_messages(room_id, sender_id, contents, sender_name):
+    """Create several messages in a room with one statement (one room: one
+    shard); returns them in order
+    """
+    messages = [new_message(new_message_id(room_id), room_id, sender_id, content, sender_name) for content in contents]
+    for query, params, shard in insert_messages_statements(messages):
+        execute_query(query, params, shard=shard)
+    on_commit(lambda: remember_new_messages(messages))
+    if DB_NOTIFY:
+        on_commit(lambda: notify_messages(messages))
+    return messages
+
+def queue_message(room_id, sender_id, content, sender_name):
+    """Accept a message for write-behind ingestion; returns it (no id until the
+    flusher writes it), or None if this worker's queue is full
+    """
+    message = new_message(None, room_id, sender_id, content, sender_name)
+    return message if ingest.submit(message) else None
+
+def write_messages(messages):
+    """Ingest flusher: give one batch its ids and insert it (a short transaction
+    per shard); each shard's rows are added to the room caches and announced
+    to every worker as soon as that shard commits (a later shard failing
+    retries the batch, whose replay skips them); returns the messages written
+    """
+    messages = [{**message, 'id': new_message_id(message['room_id'])} for message in messages]
+    written = set()
+    for query, params, shard in insert_messages_statements(messages, INGEST_MESSAGES_SQL):
+        ids = {row['id'] for row in execute_detached(query, params, fetch_all=True, shard=shard)}
+        announce_new_messages([message for message in messages if message['id'] in ids - written])
+        written |= ids
+    return [message for message in messages if message['id'] in written]
+
+def announce_new_messages(messages):
+    """Add committed messages to the room caches and announce them to every worker"""
+    if not messages:
+        return
+    remember_new_messages(messages)
+    if DB_NOTIFY:
+        notify_messages(messages)
+
+def remember_new_messages(messages):
+    """Add committed messages to the room buffers and the shared cache (one pipeline)"""
+    commands = []
+    for message in messages:
+        cache.append_room_message(message['room_id'], message)
+        commands += shared_cache.append_recent_message_commands(message['room_id'], message)
+    shared_cache.write(commands)
+
+# Keyset pagination on the (room_id, id) index: every page is one index
+# range scan on the owning shard, whatever the size of the room history
+MESSAGES_LATEST_SQL = """
+    SELECT * FROM messages
+    WHERE room_id = %s
+    ORDER BY id DESC
+    LIMIT %s
+"""
+
+MESSAGES_BEFORE_SQL = """
+    SELECT * FROM messages
+    WHERE room_id = %s AND id < %s
+    ORDER BY id DESC
+    LIMIT %s
+"""
+
+MESSAGES_AFTER_SQL = """
+    SELECT * FROM messages
+    WHERE room_id = %s AND id > %s
+    ORDER BY id ASC
+    LIMIT %s
+"""
+
+# The same pages with their sender names (DIRECTORY_REPLICATION): every shard
+# has the users, so it is one JOIN on the owning shard and attach_sender_names
+# has nothing left to look up
+NAMED_MESSAGES_LATEST_SQL = """
+    SELECT m.*, COALESCE(u.username, 'Unknown') AS sender_name
+    FROM messages m LEFT JOIN users u ON u.id = m.sender_id
+    WHERE m.room_id = %s
+    ORDER BY m.id DESC
+    LIMIT %s
+"""
+
+NAMED_MESSAGES_BEFORE_SQL = """
+    SELECT m.*, COALESCE(u.username, 'Unknown') AS sender_name
+    FROM messages m LEFT JOIN users u ON u.id = m.sender_id
+    WHERE m.room_id = %s AND m.id < %s
+    ORDER BY m.id DESC
+    LIMIT %s
+"""
+
+NAMED_MESSAGES_AFTER_SQL = """
+    SELECT m.*, COALESCE(u.username, 'Unknown') AS sender_name
+    FROM messages m LEFT JOIN users u ON u.id = m.sender_id
+    WHERE m.room_id = %s AND m.id > %s
+    ORDER BY m.id ASC
+    LIMIT %s
+"""
+
+if DIRECTORY_REPLICATION:
+    PAGE_SQL = (NAMED_MESSAGES_LATEST_SQL, NAMED_MESSAGES_BEFORE_SQL, NAMED_MESSAGES_AFTER_SQL)
+else:
+    PAGE_SQL = (MESSAGES_LATEST_SQL, MESSAGES_BEFORE_SQL, MESSAGES_AFTER_SQL)
+
+def messages_page_statement(room_id, limit=50, before=None, after=None):
+    """Build the keyset query for one page of room history
+    Returns (query, params, newest_first)
+    """
+    latest_sql, before_sql, after_sql = PAGE_SQL
+    if after is not None:
+        return after_sql, (room_id, after, int(limit)), False
+    if before is not None:
+        return before_sql, (room_id, before, int(limit)), True
+    return latest_sql, (room_id, int(limit)), True
+
+def chronological(messages, newest_first):
+    """Put a fetched page in display order (oldest first)"""
+    messages = messages or []
+    return messages[::-1] if newest_first else messages
+
+def messages_read_statement(room_id, limit=50, before=None, after=None):
+    """messages_page_statement for a page the room buffer could not answer
+    A latest-page or sync read of an unbuffered room fetches the whole buffer
+    window instead, so the buffer can be filled (a sync read only while the
+    buffers follow every message, see cache.follows_messages)
+    Returns (query, params, newest_first, fills)
+    """
+    if before is None and limit <= ROOM_BUFFER_SIZE and not cache.has_room_buffer(room_id) and (
+        after is None or cache.follows_messages()
+    ):
+        return (*messages_page_statement(room_id, ROOM_BUFFER_SIZE), True)
+    return (*messages_page_statement(room_id, limit, before, after), False)
+
+def messages_read_result(room_id, limit, before, after, messages, newest_first, fills):
+    """Turn the rows of messages_read_statement into the requested page (oldest first)
+    None if the page is still not covered (a sync cursor older than the buffer)
+    """
+    messages = chronological(messages, newest_first)
+    if not fills:
+        return messages
+    cache.set_room_buffer(room_id, messages, complete=len(messages) < ROOM_BUFFER_SIZE)
+    return cache.peek_room_page(room_id, limit, before, after)
+
+def restore_room_buffer(room_id, recent, limit, before=None, after=None):
+    """Buffer a room's recent messages read from the shared cache, (messages,
+    complete) as shared_cache.recent_messages_result gives them
+    Returns the requested page, or None if there were none or they do not cover it
+    """
+    if recent is None:
+        return None
+    messages, complete = recent
+    cache.set_room_buffer(room_id, messages, complete=complete)
+    return cache.peek_room_page(room_id, limit, before, after)
+
+def share_room_buffer_commands(room_id, fills):
+    """Shared cache writes after messages_read_result: a filled buffer is shared"""
+    buffer = cache.get_room_buffer(room_id) if fills else None
+    return shared_cache.set_recent_messages_commands(room_id, *buffer) if buffer is not None else []
+
+def get_buffered_page(room_id, limit, before=None, after=None):
+    """Answer a page from the room buffer, loading it from the shared cache on a miss"""
+    page = cache.get_room_page(room_id, limit, before, after)
+    if page is None and not cache.has_room_buffer(room_id):
+        recent = shared_cache.get_many(recent_messages=[room_id])[3]
+        page = restore_room_buffer(room_id, recent.get(room_id), limit, before, after)
+    return page
+
+def fetch_messages_page(room_id, limit=50, before=None, after=None):
+    """Read one page straight from the owning shard (no buffer)"""
+    query, params, newest_first = messages_page_statement(room_id, limit, before, after)
+    return chronological(execute_query(query, params, fetch_all=True, prepare=True, shard=message_shard(room_id)), newest_first)
+
+@coalesced
+def get_messages_by_room(room_id, limit=50, before=None, after=None):
+    """Get one page of messages in a room - OPTIMIZED for sharding
+    Messages are sharded by room_id; with DIRECTORY_REPLICATION sender names
+    come from a JOIN on the owning shard, otherwise from one batch fetch
+    - no cursor: the latest `limit` messages
+    - before=<message_id>: the `limit` messages just older than it
+    - after=<message_id>: the `limit` messages just newer than it
+    Pages walk back from the newest message; rows in a page are oldest first
+    Pages inside the room's recent-messages buffer need no shard query
+    """
+    page = get_buffered_page(room_id, limit, before, after)
+    if page is None:
+        query, params, newest_first, fills = messages_read_statement(room_id, limit, before, after)
+        messages = execute_query(query, params, fetch_all=True, prepare=True, shard=message_shard(room_id))
+        page = messages_read_result(room_id, limit, before, after, messages, newest_first, fills)
+        shared_cache.write(share_room_buffer_commands(room_id, fills))
+    if page is None:
+        page = fetch_messages_page(room_id, limit, before, after)
+    return attach_sender_names(page)
+
+def attach_sender_names(messages, known_users=None):
+    """Add sender_name to each message that has none yet (a JOIN or the
+    sender already named it); senders that are not already in known_users
+    (list of user rows) come from the user directory cache, with one batch
+    query for the cache misses only
     """
-    messages = execute_query(query, (room_id,), fetch_all=True)
-    
     if not messages:
         return []
     
-    # Batch fetch: get all unique sender IDs at once
-    sender_ids = list(set(msg['sender_id'] for msg in messages))
+    sender_map = {u['id']: u['username'] for u in known_users or []}
     
-    # Single query to get all senders
+    # Batch lookup: all unique sender IDs at once, a warm cache needs no query
+    sender_ids = set(msg['sender_id'] for msg in messages if 'sender_name' not in msg) - set(sender_map)
     if sender_ids:
-        placeholders = ','.join(['%s'] * len(sender_ids))
-        users_query = f"SELECT id, username FROM users WHERE id IN ({placeholders})"
-        users = execute_query(users_query, tuple(sender_ids), fetch_all=True)
-        sender_map = {u['id']: u['username'] for u in users} if users else {}
-    else:
-        sender_map = {}
+        users = get_users_by_ids(sender_ids)
+        sender_map.update({user_id: u['username'] for user_id, u in users.items() if u})
     
     # Build result with sender names
     result = []
     for msg in messages:
         msg_dict = dict(msg)
-        msg_dict['sender_name'] = sender_map.get(msg['sender_id'], 'Unknown')
+        if 'sender_name' not in msg_dict:
+            msg_dict['sender_name'] = sender_map.get(msg['sender_id'], 'Unknown')
         result.append(msg_dict)
     
     return result
 
+def shard_room_ids(room_ids):
+    """Group room ids by the shard that stores their messages"""
+    by_shard = {}
+    for room_id in room_ids:
+        by_shard.setdefault(message_shard(room_id), []).append(room_id)
+    return by_shard
+
+def latest_messages_statements(room_ids, limit):
+    """execute_batch statements reading the latest messages of rooms on one shard"""
+    return [(PAGE_SQL[0], (room_id, limit), 'all') for room_id in room_ids]
+
+def read_shard_latest(room_ids, limit):
+    """Latest messages of rooms on one shard: one pipelined batch on a connection of its own"""
+    statements = latest_messages_statements(room_ids, limit)
+    results = execute_batch(statements, prepare=True, detached=True, shard=message_shard(room_ids[0]))
+    return {room_id: chronological(messages, True) for room_id, messages in zip(room_ids, results)}
+
+def get_latest_messages(room_ids, limit):
+    """Get {room_id: latest `limit` messages, oldest first} for many rooms
+    Room buffers answer first, then one shared cache multi-get; the rooms
+    still missing are read with one pipelined batch per shard, the shards in
+    parallel, and sender names are attached once for all of them
+    """
+    latest = {}
+    for room_id in room_ids:
+        page = cache.get_room_page(room_id, limit)
+        if page is not None:
+            latest[room_id] = page
+    missing = [room_id for room_id in room_ids if room_id not in latest]
+    if missing:
+        recent = shared_cache.get_many(recent_messages=missing)[3]
+        for room_id in missing:
+            page = restore_room_buffer(room_id, recent.get(room_id), limit)
+            if page is not None:
+                latest[room_id] = page
+        missing = [room_id for room_id in missing if room_id not in latest]
+    if missing:
+        fetched = {}
+        shards = list(shard_room_ids(missing).values())
+        for pages in _shard_readers.map(read_shard_latest, shards, [limit] * len(shards)):
+            fetched.update(pages)
+        named = iter(attach_sender_names([message for page in fetched.values() for message in page]))
+        latest.update({room_id: [next(named) for _ in page] for room_id, page in fetched.items()})
+    return latest
+
+def get_latest_messages_for_member(room_ids, user_id, limit):
+    """get_latest_messages for the rooms in room_ids that user_id is a member of"""
+    return get_latest_messages([room_id for room_id in room_ids if is_room_member(room_id, user_id)], limit)
+
+MESSAGE_BY_ID_SQL = "SELECT * FROM messages WHERE id = %s AND room_id = %s"
+
+NAMED_MESSAGE_BY_ID_SQL = """
+    SELECT m.*, COALESCE(u.username, 'Unknown') AS sender_name
+    FROM messages m LEFT JOIN users u ON u.id = m.sender_id
+    WHERE m.id = %s AND m.room_id = %s
+"""
+
+def message_by_id_statement(message_id, room_id):
+    """(query, params) reading one message (with its sender name under DIRECTORY_REPLICATION)"""
+    return NAMED_MESSAGE_BY_ID_SQL if DIRECTORY_REPLICATION else MESSAGE_BY_ID_SQL, (message_id, room_id)
+
 def get_message_by_id(message_id, room_id):
     """Get message by ID - need room_id for sharding"""
-    query = "SELECT * FROM messages WHERE id = %s AND room_id = %s"
-    msg = execute_query(query, (message_id, room_id), fetch_one=True)
+    msg = execute_query(*message_by_id_statement(message_id, room_id), fetch_one=True, shard=message_shard(room_id))
     
     if msg:
         msg_dict = dict(msg)
-        sender = get_user_by_id(msg['sender_id'])
-        msg_dict['sender_name'] = sender['username'] if sender else 'Unknown'
+        if 'sender_name' not in msg_dict:
+            sender = get_user_by_id(msg['sender_id'])
+            msg_dict['sender_name'] = sender['username'] if sender else 'Unknown'
         return msg_dict
     return None
 
-def get_rooms_by_user(user_id):
-    """Get all rooms for a user - can use JOIN since users/rooms/room_members not sharded"""
-    query = """
+ROOMS_BY_USER_SQL = """
+    SELECT r.* FROM rooms r
+    JOIN room_members rm ON r.id = rm.room_id
+    WHERE rm.user_id = %s
+    ORDER BY r.created_at DESC
+"""
+
+# MEMBER_SHARDING: the user's member_rooms joined with the rooms copy on the user's shard
+if MEMBER_SHARDING:
+    ROOMS_BY_USER_SQL = """
         SELECT r.* FROM rooms r
-        JOIN room_members rm ON r.id = rm.room_id
-        WHERE rm.user_id = %s
+        JOIN member_rooms mr ON r.id = mr.room_id
+        WHERE mr.user_id = %s
         ORDER BY r.created_at DESC
     """
-    return execute_query(query, (user_id,), fetch_all=True) or []
+
+def get_rooms_by_user(user_id):
+    """Get all rooms for a user - one JOIN on one node: ds_0, or the user's
+    shard with MEMBER_SHARDING. Also refreshes the membership cache
+    """
+    rooms = execute_query(ROOMS_BY_USER_SQL, (user_id,), fetch_all=True, shard=member_shard(user_id)) or []
+    shared_cache.set_member_rooms(user_id, cache.set_member_rooms(user_id, (room['id'] for room in rooms)))
+    return rooms
+
+# ============ BATCHED READS ============
+# Independent reads of one handler sent in a single pipeline flush
+# (ShardingSphere routes each statement on its own; in direct routing
+# execute_routed sends one flush per node the statements live on)
+
+def get_dashboard_context(user_id):
+    """Get user and their rooms in one round trip"""
+    user, rooms = execute_batch([
+        (USER_BY_ID_SQL, (user_id,), 'one'),
+        (ROOMS_BY_USER_SQL, (user_id,), 'all')
+    ], prepare=True, shard=member_shard(user_id))
+    shared_cache.set_member_rooms(user_id, cache.set_member_rooms(user_id, (room['id'] for room in rooms or [])))
+    return user, rooms or []
+
+def get_chat_room_context(room_id, user_id, limit=50):
+    """Get everything the chat page needs in one round trip
+    Sender names and membership are resolved from the member list; only
+    senders who have left the room need a second query; messages come from
+    the room buffer when it is warm, and the room, the user and the recent
+    messages from one shared cache multi-get
+    """
+    messages = cache.get_room_page(room_id, limit)
+    load_recent = messages is None and not cache.has_room_buffer(room_id)
+    users, rooms, _, recent = shared_cache.get_many(
+        users=[user_id], rooms=[room_id], recent_messages=[room_id] if load_recent else []
+    )
+    room, user = rooms.get(room_id), users.get(user_id)
+    if messages is None:
+        messages = restore_room_buffer(room_id, recent.get(room_id), limit)
+
+    statements = [(ROOM_MEMBERS_SQL, (room_id,), 'all', members_shard(room_id))]
+    if room is None:
+        statements.append((ROOM_BY_ID_SQL, (room_id,), 'one', directory_shard(room_id)))
+    if user is None:
+        statements.append((USER_BY_ID_SQL, (user_id,), 'one', directory_shard(room_id)))
+    if messages is None:
+        messages_query, messages_params, newest_first, fills = messages_read_statement(room_id, limit)
+        statements.append((messages_query, messages_params, 'all', message_shard(room_id)))
+    members, *rows = execute_routed(statements, prepare=True)
+
+    rows, writes = iter(rows), []
+    if room is None:
+        room = next(rows)
+        writes += shared_cache.set_room_commands(room)
+    if user is None:
+        user = next(rows)
+        writes += shared_cache.set_users_commands({user_id: user})
+    if messages is None:
+        messages = messages_read_result(room_id, limit, None, None, next(rows), newest_first, fills)
+        writes += share_room_buffer_commands(room_id, fills)
+    shared_cache.write(writes)
+    is_member = has_member(members, user_id)
+    cache.set_users(members)  # member rows are user rows: warm the directory for later pages
+    return {
+        'room': room,
+        'is_member': is_member,
+        'user': user,
+        'messages': attach_sender_names(messages, members) if is_member else [],
+        'members': members or []
+    }
+
+def get_messages_for_member(room_id, user_id, limit=50, before=None, after=None):
+    """Check membership and get a page of messages in one round trip (None if not a member)
+    A membership cache hit skips the check, so only the owning shard is queried,
+    and a room buffer hit skips that too; the page read is then coalesced with
+    concurrent readers of the same room and cursor
+    """
+    if cache.check_membership(user_id, room_id):
+        return get_messages_by_room(room_id, limit, before, after)  # coalesced with other readers of the room
+
+    # Membership not cached: one shared cache multi-get for what is missing
+    page = cache.get_room_page(room_id, limit, before, after)
+    load_recent = page is None and not cache.has_room_buffer(room_id)
+    _, _, member_rooms, recent = shared_cache.get_many(
+        member_rooms=[user_id], recent_messages=[room_id] if load_recent else []
+    )
+    is_member = restore_member_rooms(user_id, room_id, member_rooms)
+    if page is None:
+        page = restore_room_buffer(room_id, recent.get(room_id), limit, before, after)
+    if is_member and page is not None:
+        return attach_sender_names(page)
+
+    statements = []
+    if not is_member:
+        statements.append((MEMBER_ROOM_IDS_SQL, (user_id,), 'all', member_shard(user_id)))
+    if page is None:
+        messages_query, messages_params, newest_first, fills = messages_read_statement(room_id, limit, before, after)
+        statements.append((messages_query, messages_params, 'all', message_shard(room_id)))
+    results = execute_routed(statements, prepare=True)
+
+    writes = []
+    if not is_member:
+        room_ids = remember_member_rooms(user_id, results[0])
+        writes += shared_cache.set_member_rooms_commands(user_id, room_ids)
+        if room_id not in room_ids:
+            shared_cache.write(writes)
+            return None
+    if page is None:
+        page = messages_read_result(room_id, limit, before, after, results[-1], newest_first, fills)
+        writes += share_room_buffer_commands(room_id, fills)
+    shared_cache.write(writes)
+    if page is None:
+        page = fetch_messages_page(room_id, limit, before, after)
+    return attach_sender_names(page)
+
+def get_members_for_member(room_id, user_id):
+    """Get room members if the user is one of them (None if not a member)"""
+    members = get_room_members(room_id)  # coalesced with other members of the room
+    return members if has_member(members, user_id) else None
@@ -0,0 +1,143 @@
+# Cross-process fan-out over Postgres LISTEN/NOTIFY
+# ShardingSphere Proxy does not route LISTEN/NOTIFY, so both go straight to one
+# physical node (NOTIFY_DB_CONFIG, shard 0 by default). create_message sends a
+# compact '<room_id>:<message_id>' NOTIFY there after its transaction commits.
+# Every worker process runs one listener thread with one dedicated connection
+# for all rooms and hands each notification to the registered handlers
+# While the listener is connected the room buffers in cache.py see every new
+# message and may answer sync reads; each (re)connect drops them first
+import logging
+import threading
+import time
+
+import psycopg
+from psycopg import sql
+from psycopg_pool import ConnectionPool
+from config import NOTIFY_DB_CONFIG, NOTIFY_CHANNEL, NOTIFY_POOL_SIZE
+import cache
+from db import on_commit
+
+logger = logging.getLogger(__name__)
+
+# Any number of payloads in one statement
+NOTIFY_SQL = "SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload"
+
+_handlers = []
+_listener = None
+_listener_lock = threading.Lock()
+_stats = {'received': 0, 'handler_errors': 0, 'reconnects': 0}
+
+# Autocommit connections used to send NOTIFY (a small pool, so the worker's
+# threads do not wait for one another's sends)
+_notify_pool = None
+_notify_pool_lock = threading.Lock()
+
+def connection_kwargs():
+    """Connection arguments of an autocommit connection to the LISTEN/NOTIFY node"""
+    return {
+        'host': NOTIFY_DB_CONFIG['host'],
+        'port': NOTIFY_DB_CONFIG['port'],
+        'dbname': NOTIFY_DB_CONFIG['database'],
+        'user': NOTIFY_DB_CONFIG['user'],
+        'password': NOTIFY_DB_CONFIG['password'],
+        'autocommit': True
+    }
+
+def connect():
+    """Open an autocommit connection to the LISTEN/NOTIFY node"""
+    return psycopg.connect(**connection_kwargs())
+
+def get_notify_pool():
+    """Get the pool of NOTIFY connections, opening it on first use"""
+    global _notify_pool
+    if _notify_pool is None:
+        with _notify_pool_lock:
+            if _notify_pool is None:
+                _notify_pool = ConnectionPool(
+                    kwargs=connection_kwargs(),
+                    min_size=1,
+                    max_size=NOTIFY_POOL_SIZE,
+                    check=ConnectionPool.check_connection,
+                    name='notify_pool',
+                    open=True
+                )
+    return _notify_pool
+
+def format_payload(room_id, message_id):
+    """Encode a notification payload"""
+    return f'{room_id}:{message_id}'
+
+def parse_payload(payload):
+    """Decode a notification payload into (room_id, message_id)"""
+    room_id, message_id = payload.split(':')
+    return int(room_id), int(message_id)
+
+def listen_statement():
+    """LISTEN statement for the message channel"""
+    return sql.SQL("LISTEN {}").format(sql.Identifier(NOTIFY_CHANNEL))
+
+def _send_notify(payloads):
+    """Send NOTIFYs in one round trip on a pooled connection (checked on checkout,
+    so a lost connection is replaced instead of failing the send)
+    """
+    with get_notify_pool().connection() as conn:
+        conn.execute(NOTIFY_SQL, (NOTIFY_CHANNEL, payloads))
+
+def notify_message(room_id, message_id):
+    """Announce a new message to every worker once the current transaction commits"""
+    payloads = [format_payload(room_id, message_id)]
+    on_commit(lambda: _send_notify(payloads))
+
+def notify_messages(messages):
+    """Announce a batch of written messages (write-behind ingestion) in one NOTIFY round trip"""
+    _send_notify([format_payload(message['room_id'], message['id']) for message in messages])
+
+def add_handler(handler):
+    """Register handler(room_id, message_id); runs in the listener thread"""
+    _handlers.append(handler)
+
+def dispatch(payload):
+    """Pass one notification to every handler; a failing handler does not stop the others"""
+    room_id, message_id = parse_payload(payload)
+    _stats['received'] += 1
+    for handler in list(_handlers):
+        try:
+            handler(room_id, message_id)
+        except Exception:
+            _stats['handler_errors'] += 1
+            logger.exception('Notify handler %r failed for %s', handler, payload)
+
+def _listen_forever():
+    """Listener loop: LISTEN on a dedicated autocommit connection, reconnecting with backoff"""
+    delay = 1
+    while True:
+        try:
+            with connect() as conn:
+                conn.execute(listen_statement())
+                cache.follow_messages(True)
+                delay = 1
+                for notification in conn.notifies():
+                    dispatch(notification.payload)
+        except psycopg.Error as e:
+            logger.warning('Notify listener disconnected (%s), retrying in %ss', e, delay)
+        finally:
+            cache.follow_messages(False)
+        _stats['reconnects'] += 1
+        time.sleep(delay)
+        delay = min(delay * 2, 30)
+
+def start_listener():
+    """Start this worker's listener thread (once per process)"""
+    global _listener
+    with _listener_lock:
+        if _listener is None or not _listener.is_alive():
+            _listener = threading.Thread(target=_listen_forever, name='notify-listener', daemon=True)
+            _listener.start()
+
+def get_notify_stats():
+    """Get listener state: running, notifications received, handler errors and reconnects"""
+    return {
+        'listening': _listener is not None and _listener.is_alive(),
+        'handlers': len(_handlers),
+        **_stats
+    }
@@ -0,0 +1,182 @@
+# Message placement: which shard stores a room's messages
+# - SHARD_PLACEMENT='modulo': room_id % MESSAGE_SHARDS, the original
+#   ds_${room_id % 4} layout. Going from N to N+1 shards moves about N/(N+1)
+#   of all messages
+# - SHARD_PLACEMENT='ring': consistent hashing. A room belongs to bucket
+#   room_id % SHARD_BUCKETS, and every shard puts SHARD_VNODES * weight
+#   virtual nodes on a hash ring; a bucket goes to the first virtual node at
+#   or after its own hash. Adding a shard only takes buckets from the others
+#   (about 1/(N+1) of the data moves) and weights give bigger nodes more
+# The app routes with shard_of and ShardingSphere with sharding_expression,
+# both computed from the same table, so they always agree; after changing
+# the shards or weights regenerate the proxy config with
+#   python placement.py write-config shardingsphere/config-sharding.yaml
+# and run `python placement.py simulate` first to see what would move
+import argparse
+import bisect
+import hashlib
+import random
+import re
+from config import MESSAGE_SHARDS, SHARD_PLACEMENT, SHARD_WEIGHTS, SHARD_BUCKETS, SHARD_VNODES
+
+def ring_hash(key):
+    """Position of a key on the ring (64 bits of its MD5, stable across processes)"""
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+def ring_points(weights, vnodes=SHARD_VNODES):
+    """Sorted (position, shard) virtual nodes; shard i gets vnodes * weights[i] of them"""
+    points = []
+    for shard, weight in enumerate(weights):
+        for vnode in range(max(1, round(vnodes * weight))):
+            points.append((ring_hash(f'ds_{shard}#{vnode}'), shard))
+    return sorted(points)
+
+def ring_table(weights, buckets=SHARD_BUCKETS, vnodes=SHARD_VNODES):
+    """Shard of every bucket: the first virtual node at or after the bucket's hash"""
+    points = ring_points(weights, vnodes)
+    positions = [position for position, _ in points]
+    table = []
+    for bucket in range(buckets):
+        index = bisect.bisect_left(positions, ring_hash(f'bucket#{bucket}')) % len(points)
+        table.append(points[index][1])
+    return table
+
+def placement_table(placement=SHARD_PLACEMENT, weights=SHARD_WEIGHTS, buckets=SHARD_BUCKETS, vnodes=SHARD_VNODES):
+    """Bucket -> shard table of a placement (None for modulo, which needs none)"""
+    if placement == 'modulo':
+        return None
+    if placement == 'ring':
+        return ring_table(weights, buckets, vnodes)
+    raise ValueError(f"Unknown SHARD_PLACEMENT '{placement}'")
+
+def locate(room_id, shards, table):
+    """Shard of a room under a placement (table from placement_table)"""
+    if table is None:
+        return room_id % shards
+    return table[room_id % len(table)]
+
+if len(SHARD_WEIGHTS) != MESSAGE_SHARDS:
+    raise ValueError(f'SHARD_WEIGHTS has {len(SHARD_WEIGHTS)} weights for {MESSAGE_SHARDS} shards')
+
+_table = placement_table()
+
+def shard_of(room_id):
+    """Index of the shard that stores a room's messages"""
+    if _table is None:
+        return room_id % MESSAGE_SHARDS
+    return _table[room_id % SHARD_BUCKETS]
+
+# ============ SHARDINGSPHERE CONFIG ============
+
+def sharding_expression(shards=MESSAGE_SHARDS, table=_table):
+    """The messages_inline algorithm-expression (Groovy) matching shard_of"""
+    if table is None:
+        return f'ds_${{room_id % {shards}}}'
+    return f"ds_${{[{','.join(map(str, table))}][(int) (room_id % {len(table)})]}}"
+
+def write_sharding_config(path, shards=MESSAGE_SHARDS, table=_table):
+    """Rewrite the messages data nodes and algorithm-expression of config-sharding.yaml"""
+    with open(path) as config_file:
+        config = config_file.read()
+    config, nodes = re.subn(r'ds_\$\{0\.\.\d+\}\.messages', f'ds_${{0..{shards - 1}}}.messages', config)
+    config, expressions = re.subn(
+        r'(messages_inline:\s+type: INLINE\s+props:\s+algorithm-expression: ).*',
+        lambda match: match.group(1) + sharding_expression(shards, table), config
+    )
+    if nodes != 1 or expressions != 1:
+        raise ValueError(f'{path} has no messages data nodes or messages_inline expression to replace')
+    with open(path, 'w') as config_file:
+        config_file.write(config)
+
+# ============ SIMULATOR ============
+
+def simulate_rooms(rooms, seed=42):
+    """Messages per room for rooms 1..rooms: a few busy rooms, a long tail of quiet ones (Pareto)"""
+    rng = random.Random(seed)
+    return {room_id: int(rng.paretovariate(1.2) * 10) for room_id in range(1, rooms + 1)}
+
+def simulate(before, after, rooms, buckets=SHARD_BUCKETS, vnodes=SHARD_VNODES):
+    """Compare both placements for a change of shard weights (before/after: lists of weights)
+
+    For each placement returns the share of rooms and of messages that move,
+    the messages each shard holds afterwards, and the skew: the most loaded
+    shard's rooms (room_skew) or messages (skew) relative to its fair share by
+    weight (1.0 = perfect; a few very busy rooms skew messages whatever the placement)
+    """
+    results = {}
+    for placement in ('modulo', 'ring'):
+        old_table = placement_table(placement, before, buckets, vnodes)
+        new_table = placement_table(placement, after, buckets, vnodes)
+        load = [0] * len(after)
+        room_load = [0] * len(after)
+        moved_rooms = moved_messages = 0
+        for room_id, messages in rooms.items():
+            old_shard = locate(room_id, len(before), old_table)
+            new_shard = locate(room_id, len(after), new_table)
+            load[new_shard] += messages
+            room_load[new_shard] += 1
+            if old_shard != new_shard:
+                moved_rooms += 1
+                moved_messages += messages
+        total = sum(rooms.values())
+        fair = [weight / sum(after) for weight in after]
+        results[placement] = {
+            'moved_rooms': moved_rooms / len(rooms),
+            'moved_messages': moved_messages / total,
+            'load': load,
+            'room_skew': max(shard_rooms / (len(rooms) * share) for shard_rooms, share in zip(room_load, fair)),
+            'skew': max(shard_load / (total * share) for shard_load, share in zip(load, fair))
+        }
+    return results
+
+def print_simulation(before, after, results):
+    """Print the simulate() report"""
+    print(f"\n{'='*70}")
+    print(f"PLACEMENT SIMULATION: weights {before} -> {after}")
+    print(f"{'='*70}")
+    print(f"\n{'Metric':<25} {'modulo':>15} {'ring':>15}")
+    print("-"*70)
+    print(f"{'Rooms moved':<25} {results['modulo']['moved_rooms']:>15.1%} {results['ring']['moved_rooms']:>15.1%}")
+    print(f"{'Messages moved':<25} {results['modulo']['moved_messages']:>15.1%} {results['ring']['moved_messages']:>15.1%}")
+    print(f"{'Room skew (max/fair)':<25} {results['modulo']['room_skew']:>15.3f} {results['ring']['room_skew']:>15.3f}")
+    print(f"{'Message skew (max/fair)':<25} {results['modulo']['skew']:>15.3f} {results['ring']['skew']:>15.3f}")
+    for shard in range(len(after)):
+        print(f"{f'ds_{shard} messages':<25} {results['modulo']['load'][shard]:>15} {results['ring']['load'][shard]:>15}")
+    print(f"{'='*70}\n")
+
+def parse_weights(shards, weights):
+    """Weights from the command line: '2,1,1' or equal weights for `shards` shards"""
+    if weights:
+        return [float(weight) for weight in weights.split(',')]
+    return [1.0] * shards
+
+def main():
+    parser = argparse.ArgumentParser(description='Message placement: proxy config and resharding simulator')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('expression', help='Print the messages_inline algorithm-expression')
+    write_config = commands.add_parser('write-config', help='Rewrite config-sharding.yaml for the current placement')
+    write_config.add_argument('path')
+    sim = commands.add_parser('simulate', help='Report data movement and skew for a change in shards or weights')
+    sim.add_argument('--from-shards', type=int, default=MESSAGE_SHARDS)
+    sim.add_argument('--to-shards', type=int, default=MESSAGE_SHARDS + 1)
+    sim.add_argument('--from-weights', help='Comma-separated weights (default: equal)')
+    sim.add_argument('--to-weights', help='Comma-separated weights (default: equal)')
+    sim.add_argument('--rooms', type=int, default=100000)
+    sim.add_argument('--buckets', type=int, default=SHARD_BUCKETS)
+    sim.add_argument('--vnodes', type=int, default=SHARD_VNODES)
+    sim.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    if args.command == 'expression':
+        print(sharding_expression())
+    elif args.command == 'write-config':
+        write_sharding_config(args.path)
+        print(f'{args.path}: {SHARD_PLACEMENT} placement over {MESSAGE_SHARDS} shards')
+    else:
+        before = parse_weights(args.from_shards, args.from_weights)
+        after = parse_weights(args.to_shards, args.to_weights)
+        results = simulate(before, after, simulate_rooms(args.rooms, args.seed), args.buckets, args.vnodes)
+        print_simulation(before, after, results)
+
+if __name__ == '__main__':
+    main()
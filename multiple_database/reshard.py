@@ -0,0 +1,308 @@
+# Move rooms' messages from one shard to another while the app keeps running
+#   python reshard.py move --rooms 12,40,77 --to 4
+#   python reshard.py resume     # finish every unfinished move (e.g. after a crash)
+#   python reshard.py status
+# Each room goes through the states of its room_shards row (see shard_routes.py):
+# 1. dual: the app writes new messages to both shards. Once every worker has
+#    reloaded its routes the history is copied in batches of --batch-rows:
+#    COPY out of the old shard, COPY into a staging table on the new one, then
+#    INSERT ... ON CONFLICT DO NOTHING (dual-written messages are already there)
+# 2. row counts and checksums of both copies are compared up to the last id
+#    the copy reached (later messages are dual-written, so new writes never
+#    keep the comparison from settling); a mismatch copies the room once more
+#    from the start before giving up
+# 3. flipped: one UPDATE of the row moves reads to the new shard, while
+#    writes still go to both until every worker has the new route
+# 4. cleanup: writes stop on the old shard; messages after the verified ids
+#    are copied once more (ON CONFLICT DO NOTHING), then the old copy is
+#    deleted in batches
+# 5. done: the row stays as the room's route
+# With MEMBER_SHARDING the room's room_members rows move with its messages:
+# the app writes them to both shards as well, they are copied after the
+# history, compared in step 2 and deleted in step 4.
+# State and copy progress live in the row, so `resume` continues a crashed
+# run where it stopped. Copying and deleting are throttled to --max-rows-per-sec.
+# A dual write is two commits, one per shard, with no atomicity between them:
+# a request that fails between the two leaves a message on one shard only.
+# Up to the verified ids the comparison catches it (and copies again); after
+# them the copy in step 4 brings messages only the old shard has to the new
+# one, and one only the new shard has stays there. Membership writes are not
+# reconciled after step 2 (a failed join or leave is retried by the user).
+# Needs SHARD_ROUTING=direct: the proxy's INLINE rule does not read
+# room_shards, so an app running through the proxy refuses moved rooms
+import argparse
+import sys
+import time
+
+import psycopg
+from psycopg import sql
+from psycopg.rows import dict_row
+from config import SHARD_ROUTING, SHARD_ROUTES_TTL, SHARD_DB_CONFIGS, METADATA_SHARD, MEMBER_SHARDING
+from db import connection_kwargs
+from placement import shard_of
+
+# Long enough for every worker to reload its routes and finish requests started before
+GRACE_SECONDS = SHARD_ROUTES_TTL * 2 + 5
+# Messages up to the verified id can still be committing on one shard (ids from
+# different workers commit out of order); none are made any more, so retries settle
+VERIFY_ATTEMPTS = 5
+
+ROUTE_SQL = "SELECT * FROM room_shards WHERE room_id = %s"
+JOBS_SQL = "SELECT * FROM room_shards WHERE state <> 'done' ORDER BY updated_at, room_id"
+ROUTE_AGE_SQL = "SELECT EXTRACT(EPOCH FROM now() - updated_at) AS age FROM room_shards WHERE room_id = %s"
+STATE_COUNTS_SQL = "SELECT state, count(*) AS rooms FROM room_shards GROUP BY state ORDER BY state"
+
+# A room that is already moving is left alone (None); a moved room can move again
+START_MOVE_SQL = """
+    INSERT INTO room_shards (room_id, from_shard, to_shard, state)
+    VALUES (%s, %s, %s, 'dual')
+    ON CONFLICT (room_id) DO UPDATE
+    SET from_shard = EXCLUDED.from_shard, to_shard = EXCLUDED.to_shard,
+        state = 'dual', copied_up_to = 0, updated_at = now()
+    WHERE room_shards.state = 'done'
+    RETURNING *
+"""
+
+SET_STATE_SQL = "UPDATE room_shards SET state = %s, updated_at = now() WHERE room_id = %s AND state = %s RETURNING *"
+SET_PROGRESS_SQL = "UPDATE room_shards SET copied_up_to = %s WHERE room_id = %s"
+
+COPY_OUT_SQL = """
+    COPY (
+        SELECT id, room_id, sender_id, content, created_at FROM messages
+        WHERE room_id = {room_id} AND id > {after}
+        ORDER BY id
+        LIMIT {limit}
+    ) TO STDOUT
+"""
+STAGING_SQL = "CREATE TEMP TABLE IF NOT EXISTS reshard_staging (LIKE messages) ON COMMIT DELETE ROWS"
+COPY_IN_SQL = "COPY reshard_staging (id, room_id, sender_id, content, created_at) FROM STDIN"
+STAGED_SQL = "SELECT count(*) AS rows, max(id) AS last_id FROM reshard_staging"
+MERGE_STAGING_SQL = """
+    INSERT INTO messages (id, room_id, sender_id, content, created_at)
+    SELECT id, room_id, sender_id, content, created_at FROM reshard_staging
+    ON CONFLICT (id) DO NOTHING
+"""
+
+ROWS_SQL = "SELECT count(*) AS rows FROM messages WHERE room_id = %s"
+
+# Order-independent: the sum of a 60-bit hash of every row up to an id
+CHECKSUM_SQL = """
+    SELECT count(*) AS rows,
+           coalesce(sum(('x' || left(md5(id || ':' || sender_id || ':' || content || ':' || created_at), 15))::bit(60)::bigint), 0) AS checksum
+    FROM messages
+    WHERE room_id = %s AND id <= %s
+"""
+
+DELETE_BATCH_SQL = "DELETE FROM messages WHERE id IN (SELECT id FROM messages WHERE room_id = %s LIMIT %s)"
+
+# A room's members (MEMBER_SHARDING) are few: copied whole, in one transaction
+MEMBERS_SQL = "SELECT room_id, user_id, slot FROM room_members WHERE room_id = %s ORDER BY user_id"
+CLEAR_MEMBERS_SQL = "DELETE FROM room_members WHERE room_id = %s"
+ADD_MEMBER_SQL = "INSERT INTO room_members (room_id, user_id, slot) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING"
+
+class ReshardError(Exception):
+    """A room could not be moved (its route is left as it was)"""
+
+class Throttle:
+    """Sleep between batches so no more than max_rows_per_sec rows are moved per second"""
+
+    def __init__(self, max_rows_per_sec):
+        self.max_rows_per_sec = max_rows_per_sec
+        self.started = time.monotonic()
+        self.rows = 0
+
+    def wait(self, rows):
+        self.rows += rows
+        if self.max_rows_per_sec:
+            delay = self.rows / self.max_rows_per_sec - (time.monotonic() - self.started)
+            if delay > 0:
+                time.sleep(delay)
+
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return self.rows / elapsed if elapsed else 0
+
+def connect(shard, autocommit=False):
+    """A connection of its own to a shard (metadata: METADATA_SHARD)"""
+    return psycopg.connect(**connection_kwargs(shard), autocommit=autocommit, row_factory=dict_row)
+
+# ============ STEPS ============
+
+def start_move(meta, room_id, to_shard):
+    """Put a room in dual mode; returns its row, or None if it is already moving or already there"""
+    route = meta.execute(ROUTE_SQL, (room_id,)).fetchone()
+    from_shard = route['to_shard'] if route else shard_of(room_id)
+    if from_shard == to_shard:
+        return None
+    return meta.execute(START_MOVE_SQL, (room_id, from_shard, to_shard)).fetchone()
+
+def set_state(meta, job, state):
+    """Move a room's row to the next state (only from the state this run saw)"""
+    row = meta.execute(SET_STATE_SQL, (state, job['room_id'], job['state'])).fetchone()
+    if row is None:
+        raise ReshardError(f"room {job['room_id']} left state {job['state']} (another reshard run?)")
+    return row
+
+def wait_for_workers(meta, room_id):
+    """Wait until GRACE_SECONDS have passed since the room's route last changed"""
+    age = float(meta.execute(ROUTE_AGE_SQL, (room_id,)).fetchone()['age'])
+    if age < GRACE_SECONDS:
+        time.sleep(GRACE_SECONDS - age)
+
+def copy_history(meta, source, target, job, batch_rows, throttle):
+    """Copy a room's messages after copied_up_to in id order, one batch per transaction"""
+    room_id, copied_up_to = job['room_id'], job['copied_up_to']
+    total = source.execute(ROWS_SQL, (room_id,)).fetchone()['rows']
+    copied = source.execute(CHECKSUM_SQL, (room_id, copied_up_to)).fetchone()['rows']
+    source.commit()
+    target.execute(STAGING_SQL)
+    while True:
+        copy_out = sql.SQL(COPY_OUT_SQL).format(
+            room_id=sql.Literal(room_id), after=sql.Literal(copied_up_to), limit=sql.Literal(batch_rows)
+        )
+        with source.cursor().copy(copy_out) as rows_out, target.cursor().copy(COPY_IN_SQL) as rows_in:
+            for data in rows_out:
+                rows_in.write(data)
+        source.commit()
+        staged = target.execute(STAGED_SQL).fetchone()
+        if not staged['rows']:
+            target.commit()
+            break
+        target.execute(MERGE_STAGING_SQL)
+        target.commit()
+        copied_up_to = staged['last_id']
+        meta.execute(SET_PROGRESS_SQL, (copied_up_to, room_id))
+        copied += staged['rows']
+        throttle.wait(staged['rows'])
+        print(f"   room {room_id} ds_{job['from_shard']} -> ds_{job['to_shard']}: "
+              f"{copied}/{total} rows ({copied / max(total, 1):.1%}), {throttle.rate():.0f} rows/s")
+    job['copied_up_to'] = copied_up_to
+
+def copy_members(source, target, room_id):
+    """Make the room's room_members rows on the new shard those of the old one"""
+    members = source.execute(MEMBERS_SQL, (room_id,)).fetchall()
+    source.commit()
+    target.execute(CLEAR_MEMBERS_SQL, (room_id,))
+    with target.cursor() as cursor:
+        cursor.executemany(ADD_MEMBER_SQL, [(row['room_id'], row['user_id'], row['slot']) for row in members])
+    target.commit()
+    print(f"   room {room_id}: copied {len(members)} members")
+
+def verify(source, target, room_id, up_to):
+    """Compare row counts and checksums of both copies up to id `up_to` (and
+    the members with MEMBER_SHARDING), retrying while writes before it land
+    """
+    for _ in range(VERIFY_ATTEMPTS):
+        old = source.execute(CHECKSUM_SQL, (room_id, up_to)).fetchone()
+        new = target.execute(CHECKSUM_SQL, (room_id, up_to)).fetchone()
+        same_members = not MEMBER_SHARDING or (
+            source.execute(MEMBERS_SQL, (room_id,)).fetchall() == target.execute(MEMBERS_SQL, (room_id,)).fetchall()
+        )
+        source.commit()
+        target.commit()
+        if old['rows'] == new['rows'] and old['checksum'] == new['checksum'] and same_members:
+            print(f"   room {room_id}: verified {new['rows']} rows up to id {up_to}")
+            return True
+        time.sleep(1)
+    print(f"   room {room_id}: {old['rows']} rows on the old shard, {new['rows']} on the new one, "
+          f"checksums {'match' if old['checksum'] == new['checksum'] else 'differ'}, "
+          f"members {'match' if same_members else 'differ'}")
+    return False
+
+def delete_old_copy(source, room_id, batch_rows, throttle):
+    """Delete a room's messages from the shard it left, one batch per transaction"""
+    deleted = 0
+    while True:
+        rows = source.execute(DELETE_BATCH_SQL, (room_id, batch_rows)).rowcount
+        source.commit()
+        if not rows:
+            break
+        deleted += rows
+        throttle.wait(rows)
+    if MEMBER_SHARDING:
+        source.execute(CLEAR_MEMBERS_SQL, (room_id,))
+        source.commit()
+    print(f"   room {room_id}: deleted {deleted} rows from the old shard")
+
+def run_move(meta, job, batch_rows, throttle):
+    """Take one room from its current state to done (each step is safe to repeat)"""
+    room_id = job['room_id']
+    print(f"Room {room_id}: ds_{job['from_shard']} -> ds_{job['to_shard']} ({job['state']})")
+    if job['state'] == 'dual':
+        wait_for_workers(meta, room_id)
+        with connect(job['from_shard']) as source, connect(job['to_shard']) as target:
+            copy_history(meta, source, target, job, batch_rows, throttle)
+            if MEMBER_SHARDING:
+                copy_members(source, target, room_id)
+            if not verify(source, target, room_id, job['copied_up_to']):
+                print(f"   room {room_id}: copying again from the start")
+                job['copied_up_to'] = 0
+                meta.execute(SET_PROGRESS_SQL, (0, room_id))
+                copy_history(meta, source, target, job, batch_rows, throttle)
+                if MEMBER_SHARDING:
+                    copy_members(source, target, room_id)
+                if not verify(source, target, room_id, job['copied_up_to']):
+                    raise ReshardError(f'room {room_id}: copies still differ, reads stay on ds_{job["from_shard"]}')
+        job = set_state(meta, job, 'flipped')
+        print(f"   room {room_id}: reads flipped to ds_{job['to_shard']}")
+    if job['state'] == 'flipped':
+        wait_for_workers(meta, room_id)
+        job = set_state(meta, job, 'cleanup')
+    if job['state'] == 'cleanup':
+        wait_for_workers(meta, room_id)
+        with connect(job['from_shard']) as source, connect(job['to_shard']) as target:
+            copy_history(meta, source, target, job, batch_rows, throttle)  # dual writes that missed the new shard
+            delete_old_copy(source, room_id, batch_rows, throttle)
+        set_state(meta, job, 'done')
+    print(f"   room {room_id}: done")
+
+def run_moves(meta, batch_rows, max_rows_per_sec):
+    """Run every unfinished move; returns the number of rooms that failed"""
+    throttle = Throttle(max_rows_per_sec)
+    failed = 0
+    for job in meta.execute(JOBS_SQL).fetchall():
+        try:
+            run_move(meta, job, batch_rows, throttle)
+        except ReshardError as e:
+            failed += 1
+            print(f"   FAILED: {e}")
+    return failed
+
+def print_status(meta):
+    """Print rooms per state and every unfinished move"""
+    for row in meta.execute(STATE_COUNTS_SQL).fetchall():
+        print(f"{row['state']:<10} {row['rooms']} rooms")
+    for job in meta.execute(JOBS_SQL).fetchall():
+        print(f"room {job['room_id']}: ds_{job['from_shard']} -> ds_{job['to_shard']} "
+              f"{job['state']}, copied up to id {job['copied_up_to']}, since {job['updated_at']}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Move rooms between message shards without downtime')
+    commands = parser.add_subparsers(dest='command', required=True)
+    move = commands.add_parser('move', help='Move rooms to a shard')
+    move.add_argument('--rooms', required=True, help='Comma-separated room ids')
+    move.add_argument('--to', type=int, required=True, help='Target shard index')
+    resume = commands.add_parser('resume', help='Finish every unfinished move')
+    for command in (move, resume):
+        command.add_argument('--batch-rows', type=int, default=1000, help='Rows per COPY / DELETE batch')
+        command.add_argument('--max-rows-per-sec', type=int, default=5000, help='Throttle (0 = unlimited)')
+    commands.add_parser('status', help='Show unfinished moves')
+    args = parser.parse_args()
+
+    if SHARD_ROUTING != 'direct':
+        parser.error('the app must run with SHARD_ROUTING=direct (the proxy does not read room_shards)')
+
+    with connect(METADATA_SHARD, autocommit=True) as meta:
+        if args.command == 'status':
+            print_status(meta)
+            return 0
+        if args.command == 'move':
+            if not 0 <= args.to < len(SHARD_DB_CONFIGS):
+                parser.error(f'shard {args.to} is not configured (SHARD_NODES={len(SHARD_DB_CONFIGS)})')
+            for room_id in (int(room_id) for room_id in args.rooms.split(',')):
+                if start_move(meta, room_id, args.to) is None:
+                    print(f'Room {room_id}: already on ds_{args.to} or being moved')
+        return 1 if run_moves(meta, args.batch_rows, args.max_rows_per_sec) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+# Per-room shard routes written by reshard.py (room_shards on the metadata node)
+# A room without a row lives on its placement shard (placement.py). While a
+# room moves, its row says where to read and where to write:
+# - dual: reads from from_shard, new messages go to both shards
+# - flipped: reads from to_shard, new messages still go to both shards
+# - cleanup, done: to_shard only
+# Every worker reloads the whole table every SHARD_ROUTES_TTL seconds in a
+# background thread (with the sync pool, under asgi.py too); reshard.py waits
+# longer than that between steps, so no worker is more than one step behind.
+# Only followed with SHARD_ROUTING='direct': the proxy routes by its INLINE
+# rule, which does not read room_shards. Through the proxy the table is read
+# once, at startup, and the app refuses to start while any room has a route
+# (check_routing); nothing polls it after that, since reshard.py refuses to
+# move rooms unless the app runs with SHARD_ROUTING='direct'
+import logging
+import threading
+import time
+from db import execute_detached
+from config import SHARD_ROUTING, SHARD_ROUTES_TTL
+
+logger = logging.getLogger(__name__)
+
+ROUTES_SQL = "SELECT room_id, from_shard, to_shard, state FROM room_shards"
+
+_routes = {}  # room_id -> (read shard, write shards)
+_loader = None
+_loader_lock = threading.Lock()
+_stats = {'rooms': 0, 'moving': 0, 'reloads': 0, 'reload_errors': 0}
+
+def route_of(row):
+    """(read shard, write shards) of a room_shards row"""
+    if row['state'] == 'dual':
+        return row['from_shard'], (row['from_shard'], row['to_shard'])
+    if row['state'] == 'flipped':
+        return row['to_shard'], (row['to_shard'], row['from_shard'])
+    return row['to_shard'], (row['to_shard'],)
+
+def reload_routes():
+    """Replace the routes with the current room_shards table"""
+    global _routes
+    rows = execute_detached(ROUTES_SQL, fetch_all=True)
+    _routes = {row['room_id']: route_of(row) for row in rows}
+    _stats['rooms'] = len(_routes)
+    _stats['moving'] = sum(1 for _, write_shards in _routes.values() if len(write_shards) > 1)
+    _stats['reloads'] += 1
+
+def _reload_forever():
+    while True:
+        time.sleep(SHARD_ROUTES_TTL)
+        try:
+            reload_routes()
+        except Exception:
+            _stats['reload_errors'] += 1
+            logger.exception('Reloading room_shards failed, keeping the previous routes')
+
+def _load_routes():
+    """Load the routes once, keeping none if that fails"""
+    try:
+        reload_routes()
+    except Exception:
+        _stats['reload_errors'] += 1
+        logger.exception('Loading room_shards failed, rooms use their placement shard')
+
+def _start_loader():
+    """Load the routes once and keep them fresh (once per process, direct routing only)"""
+    global _loader
+    with _loader_lock:
+        if _loader is None:
+            _load_routes()
+            _loader = threading.Thread(target=_reload_forever, name='shard-routes', daemon=True)
+            _loader.start()
+
+def check_routing():
+    """Load the routes at startup (so no request waits for them, e.g. on the
+    asgi.py event loop) and refuse to run through the proxy once reshard.py
+    has given a room a route
+    """
+    if SHARD_ROUTING == 'direct':
+        _start_loader()
+        return
+    _load_routes()
+    if _routes:
+        raise ValueError(f'{len(_routes)} rooms have a route in room_shards (reshard.py): run with SHARD_ROUTING=direct')
+
+def get_route(room_id):
+    """(read shard, write shards) of a room that has moved or is moving, else None"""
+    if SHARD_ROUTING == 'direct' and _loader is None:
+        _start_loader()
+    route = _routes.get(room_id)
+    if route is not None and SHARD_ROUTING != 'direct':
+        raise ValueError(f'Room {room_id} has a route in room_shards (reshard.py) the proxy does not follow: run with SHARD_ROUTING=direct')
+    return route
+
+def get_shard_routes_stats():
+    """Get rooms with a route, rooms being moved and reloads"""
+    return {'enabled': SHARD_ROUTING == 'direct', **_stats}
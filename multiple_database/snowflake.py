@@ -0,0 +1,184 @@
+# Message ids made in process (Snowflake layout): no round trip, no shared counter
+#   | 41 bits: ms since EPOCH_MS | 5 bits: shard | 7 bits: worker | 10 bits: sequence |
+# - a worker's ids only grow: the time part never goes back (a clock stepped
+#   back keeps the last time) and a used-up sequence borrows the next
+#   millisecond instead of sleeping, so 1024 ids/ms is a pace, not a limit
+# - across workers, ids follow the clocks: a worker whose clock lags another's
+#   by d ms can sort a new message before ones the other sent up to d ms
+#   earlier (NTP keeps d to a few ms). The room's newest id in this worker's
+#   buffer is a floor (next_id), which closes that gap only for rooms this
+#   worker buffers; a cold buffer has no floor and no round trip is spent
+#   finding one
+# - the shard is the room's write shard when the id was made (decode_id).
+#   reshard.py moves rooms without changing ids, so a route (shard_routes.py)
+#   wins over the shard in the id
+# - ids are above 2^53, past what a JavaScript number holds exactly: the
+#   JSON API, SSE and the chat page send them as strings (message_to_dict)
+# Worker ids are leased from id_workers on the metadata node and renewed every
+# SNOWFLAKE_WORKER_LEASE / 3 seconds in a background thread; a worker that
+# could not renew in time leases another id before its next message
+# (aio_snowflake.py leases through the async pool under asgi.py). A lease
+# records the last millisecond used, so the next holder starts after it.
+# Ids from id_blocks (before this) are far below MIN_ID and sort first
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from db import execute_detached
+from config import MESSAGE_SHARDS, SHARD_DB_CONFIGS, SNOWFLAKE_WORKER_LEASE
+
+logger = logging.getLogger(__name__)
+
+EPOCH_MS = 1735689600000  # 2025-01-01 UTC; never change it once ids exist
+SHARD_BITS = 5
+WORKER_BITS = 7
+SEQUENCE_BITS = 10
+WORKER_SHIFT = SEQUENCE_BITS
+SHARD_SHIFT = WORKER_SHIFT + WORKER_BITS
+TIME_SHIFT = SHARD_SHIFT + SHARD_BITS
+MAX_SHARDS = 1 << SHARD_BITS
+MAX_WORKERS = 1 << WORKER_BITS
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+MIN_ID = 1 << (TIME_SHIFT + 32)  # every id made 50 days or more after EPOCH_MS
+
+if max(MESSAGE_SHARDS, len(SHARD_DB_CONFIGS)) > MAX_SHARDS:
+    raise ValueError(f'Message ids have room for {MAX_SHARDS} shards')
+
+# The oldest expired lease, skipping one another process is taking right now
+CLAIM_WORKER_SQL = """
+    UPDATE id_workers SET owner = %s, lease_until = CURRENT_TIMESTAMP + %s * INTERVAL '1 second'
+    WHERE worker_id = (
+        SELECT worker_id FROM id_workers WHERE lease_until < CURRENT_TIMESTAMP
+        ORDER BY lease_until LIMIT 1 FOR UPDATE SKIP LOCKED
+    )
+    RETURNING worker_id, last_ms
+"""
+
+RENEW_WORKER_SQL = """
+    UPDATE id_workers SET lease_until = CURRENT_TIMESTAMP + %s * INTERVAL '1 second', last_ms = %s
+    WHERE worker_id = %s AND owner = %s
+    RETURNING worker_id
+"""
+
+_lock = threading.Lock()
+_worker = None  # (worker_id, owner) of the current lease
+_lease_deadline = 0.0  # time.monotonic() after which the lease may be someone else's
+_last_ms = 0
+_sequence = 0
+_renewer = None
+_stats = {'ids': 0, 'borrowed_ms': 0, 'floor_raises': 0, 'leases': 0, 'renew_errors': 0}
+
+def make_id(ms, shard, worker_id, sequence):
+    """Pack the parts of a message id"""
+    return (ms << TIME_SHIFT) | (shard << SHARD_SHIFT) | (worker_id << WORKER_SHIFT) | sequence
+
+def decode_id(message_id):
+    """Split a message id into its parts, or None for an id from before snowflake.py"""
+    if message_id < MIN_ID:
+        return None
+    ms = message_id >> TIME_SHIFT
+    return {
+        'created_at': datetime.fromtimestamp((ms + EPOCH_MS) / 1000, timezone.utc),
+        'shard': (message_id >> SHARD_SHIFT) & (MAX_SHARDS - 1),
+        'worker_id': (message_id >> WORKER_SHIFT) & (MAX_WORKERS - 1),
+        'sequence': message_id & MAX_SEQUENCE
+    }
+
+def message_id_shard(message_id):
+    """Shard a message was written to first, from its id alone (None for old ids)"""
+    parts = decode_id(message_id)
+    return None if parts is None else parts['shard']
+
+def now_ms():
+    return int(time.time() * 1000) - EPOCH_MS
+
+def lease_expired():
+    """True if the next id needs a new worker id lease first (lock held)"""
+    return _worker is None or time.monotonic() >= _lease_deadline
+
+def claim_statement():
+    """Get the (query, params, owner) that leases a free worker id"""
+    owner = uuid.uuid4().hex
+    return CLAIM_WORKER_SQL, (owner, SNOWFLAKE_WORKER_LEASE), owner
+
+def add_lease(row, owner, started):
+    """Start using a worker id leased with claim_statement at time.monotonic()
+    `started` (lock held); the next id starts after its last millisecond
+    """
+    global _worker, _lease_deadline, _last_ms, _sequence
+    if row is None:
+        raise LookupError(f'All {MAX_WORKERS} id_workers are leased')
+    _worker = (row['worker_id'], owner)
+    _lease_deadline = started + SNOWFLAKE_WORKER_LEASE
+    _last_ms, _sequence = max(_last_ms, row['last_ms']), MAX_SEQUENCE
+    _stats['leases'] += 1
+    _start_renewer()
+
+def claim_worker():
+    """Lease a free worker id (lock held)"""
+    started = time.monotonic()
+    query, params, owner = claim_statement()
+    add_lease(execute_detached(query, params, fetch_one=True), owner, started)
+
+def _renew_forever():
+    global _worker, _lease_deadline
+    while True:
+        time.sleep(SNOWFLAKE_WORKER_LEASE / 3)
+        with _lock:
+            worker, last_ms = _worker, _last_ms
+        if worker is None:
+            continue
+        started = time.monotonic()
+        try:
+            row = execute_detached(RENEW_WORKER_SQL, (SNOWFLAKE_WORKER_LEASE, last_ms, *worker), fetch_one=True)
+        except Exception:
+            _stats['renew_errors'] += 1
+            logger.exception('Renewing worker id %s failed', worker[0])
+            continue
+        with _lock:
+            if _worker == worker:
+                if row is None:
+                    _worker = None  # taken over after it expired: lease another
+                else:
+                    _lease_deadline = started + SNOWFLAKE_WORKER_LEASE
+
+def _start_renewer():
+    """Keep the lease (once per process, lock held)"""
+    global _renewer
+    if _renewer is None:
+        _renewer = threading.Thread(target=_renew_forever, name='snowflake-lease', daemon=True)
+        _renewer.start()
+
+def take_id(shard, floor=None):
+    """Make the next id with the current lease (lock held, lease not expired)"""
+    global _last_ms, _sequence
+    ms, sequence = max(now_ms(), _last_ms), 0
+    if ms == _last_ms:
+        sequence = _sequence + 1
+        if sequence > MAX_SEQUENCE:
+            ms, sequence = ms + 1, 0
+            _stats['borrowed_ms'] += 1
+    new_id = make_id(ms, shard, _worker[0], sequence)
+    if floor is not None and new_id <= floor:
+        # floor is from a worker whose clock runs ahead: continue after it
+        ms, sequence = (floor >> TIME_SHIFT) + 1, 0
+        new_id = make_id(ms, shard, _worker[0], sequence)
+        _stats['floor_raises'] += 1
+    _last_ms, _sequence = ms, sequence
+    _stats['ids'] += 1
+    return new_id
+
+def next_id(shard, floor=None):
+    """Get a new message id for a message written to `shard`, greater than
+    `floor` (the room's newest id known here, if any)
+    """
+    with _lock:
+        if lease_expired():
+            claim_worker()
+        return take_id(shard, floor)
+
+def get_snowflake_stats():
+    """Get this worker's leased worker id, ids made and clock adjustments"""
+    with _lock:
+        return {'worker_id': _worker[0] if _worker else None, 'lease_seconds': SNOWFLAKE_WORKER_LEASE, **_stats}
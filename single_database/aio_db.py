@@ -0,0 +1,220 @@
+# Async counterpart of db.py for the ASGI entry point (asgi.py)
+import inspect
+import logging
+from contextlib import asynccontextmanager, nullcontext
+from functools import wraps
+
+import psycopg
+from psycopg import AsyncConnection
+from psycopg.pq import TransactionStatus
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from quart import g, has_request_context
+from config import DB_CONFIG, DB_POOL_CONFIG, DB_PIPELINE
+from db import prepare_flag, get_prepare_stats, configure_connection
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+
+async def _configure_connection(conn):
+    """Same adapter setup as the sync pool (stable int8 parameter types)"""
+    configure_connection(conn)
+
+async def _check_connection(conn):
+    """Health check run on every checkout; a broken connection is discarded"""
+    await conn.set_autocommit(True)
+    try:
+        await conn.execute("SELECT 1")
+    finally:
+        await conn.set_autocommit(False)
+
+async def open_pool():
+    """Open the async connection pool (must run inside the event loop)"""
+    global _pool
+    if _pool is None:
+        _pool = AsyncConnectionPool(
+            kwargs={
+                'host': DB_CONFIG['host'],
+                'port': DB_CONFIG['port'],
+                'dbname': DB_CONFIG['database'],
+                'user': DB_CONFIG['user'],
+                'password': DB_CONFIG['password']
+            },
+            connection_class=AsyncConnection,
+            min_size=DB_POOL_CONFIG['min_size'],
+            max_size=DB_POOL_CONFIG['max_size'],
+            max_idle=DB_POOL_CONFIG['max_idle'],
+            timeout=DB_POOL_CONFIG['timeout'],
+            configure=_configure_connection,
+            check=_check_connection,
+            name='chat_async_pool',
+            open=False
+        )
+        await _pool.open()
+    return _pool
+
+async def close_pool():
+    """Close the async connection pool"""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+def get_pool():
+    """Get the async pool opened by open_pool()"""
+    if _pool is None:
+        raise RuntimeError('Async pool is not open; call open_pool() first')
+    return _pool
+
+def get_pool_stats():
+    """Get connection pool usage: size, in use, waiting and checkout wait time"""
+    stats = get_pool().get_stats()
+    requests_num = stats.get('requests_num', 0)
+    wait_ms = stats.get('requests_wait_ms', 0)
+    return {
+        'min_size': stats.get('pool_min', 0),
+        'max_size': stats.get('pool_max', 0),
+        'size': stats.get('pool_size', 0),
+        'available': stats.get('pool_available', 0),
+        'in_use': stats.get('pool_size', 0) - stats.get('pool_available', 0),
+        'waiting': stats.get('requests_waiting', 0),
+        'checkouts': requests_num,
+        'checkout_errors': stats.get('requests_errors', 0),
+        'checkout_wait_ms_total': wait_ms,
+        'checkout_wait_ms_avg': round(wait_ms / requests_num, 3) if requests_num else 0,
+        'connections_lost': stats.get('connections_lost', 0)
+    }
+
+# ============ REQUEST-SCOPED UNIT OF WORK ============
+
+def init_app(app):
+    """Open the pool with the server and give every request one connection and transaction"""
+    app.before_serving(open_pool)
+    app.after_serving(close_pool)
+    app.after_request(_finish_request_transaction)
+    app.teardown_request(_release_request_connection)
+
+def read_only(f):
+    """Decorator for routes that never write: the request transaction is not committed"""
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        g.db_read_only = True
+        return await f(*args, **kwargs)
+    return decorated_function
+
+async def _get_request_connection():
+    """Get the connection bound to the current request, checking one out on first use"""
+    conn = g.get('db_conn')
+    if conn is None:
+        conn = await get_pool().getconn()
+        g.db_conn = conn
+    return conn
+
+def on_commit(callback):
+    """Run callback() once the request transaction has committed (see db.on_commit)
+    A callback may return an awaitable; it is awaited before the response is sent
+    """
+    if has_request_context():
+        g.setdefault('db_on_commit', []).append(callback)
+    else:
+        callback()
+
+async def _finish_request_transaction(response):
+    """Commit the request transaction once; roll back error responses and read-only routes"""
+    conn = g.get('db_conn')
+    callbacks = g.pop('db_on_commit', [])
+    if g.get('db_read_only') or response.status_code >= 400:
+        if conn is not None:
+            await conn.rollback()
+        return response
+    if conn is not None:
+        await conn.commit()
+    for callback in callbacks:
+        try:
+            result = callback()
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            # already committed: the response stays a success (see db._finish_request_transaction)
+            logger.exception('on_commit callback %r failed', callback)
+    return response
+
+async def _release_request_connection(exc=None):
+    """Return the request connection to the pool, rolling back anything left open"""
+    conn = g.pop('db_conn', None)
+    if conn is None:
+        return
+    try:
+        if conn.info.transaction_status != TransactionStatus.IDLE:
+            await conn.rollback()
+    except psycopg.Error:
+        pass  # broken connection: the pool discards it on return
+    finally:
+        await get_pool().putconn(conn)
+
+@asynccontextmanager
+async def get_connection():
+    """Get a connection for the current unit of work (see db.get_connection)"""
+    if has_request_context():
+        yield await _get_request_connection()
+    else:
+        async with get_pool().connection() as conn:
+            yield conn
+
+async def execute_query(query, params=None, fetch_one=False, fetch_all=False, prepare=False):
+    """Execute a query and optionally fetch results (prepare=True for hot statements)"""
+    async with get_connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute(query, params, prepare=prepare_flag(conn, query, prepare))
+
+            if fetch_one:
+                return await cursor.fetchone()
+            elif fetch_all:
+                return await cursor.fetchall()
+            return None
+
+async def execute_detached(query, params=None, fetch_one=False, fetch_all=False):
+    """Execute one statement in its own short transaction (see db.execute_detached)"""
+    async with get_pool().connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute(query, params)
+            if fetch_one:
+                return await cursor.fetchone()
+            if fetch_all:
+                return await cursor.fetchall()
+            return None
+
+async def execute_insert(query, params=None, prepare=False):
+    """Execute insert and return the inserted id"""
+    async with get_connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cursor:
+            query = query + " RETURNING id"
+            await cursor.execute(query, params, prepare=prepare_flag(conn, query, prepare))
+            result = await cursor.fetchone()
+            return result['id'] if result else None
+
+async def execute_batch(statements, prepare=False):
+    """Execute several independent statements with a single network flush (see db.execute_batch)"""
+    async with get_connection() as conn:
+        use_pipeline = DB_PIPELINE and psycopg.AsyncPipeline.is_supported()
+        cursors = []
+        try:
+            async with conn.pipeline() if use_pipeline else nullcontext():
+                for query, params, fetch in statements:
+                    cursor = conn.cursor(row_factory=dict_row)
+                    cursors.append(cursor)
+                    await cursor.execute(query, params, prepare=prepare_flag(conn, query, prepare))
+
+            results = []
+            for cursor, (_, _, fetch) in zip(cursors, statements):
+                if fetch == 'one':
+                    results.append(await cursor.fetchone())
+                elif fetch == 'all':
+                    results.append(await cursor.fetchall())
+                else:
+                    results.append(None)
+            return results
+        finally:
+            for cursor in cursors:
+                await cursor.close()
@@ -0,0 +1,104 @@
+# Async counterpart of ingest.py for the ASGI entry point (asgi.py)
+# Same queue, spill files and stats; the flusher is a task on the event loop
+# and whatever takes the queue lock (which also guards the spill files: appends,
+# deletes, the wait for a group fsync) runs in a thread, off the event loop
+import asyncio
+import logging
+import psycopg
+from config import INGEST_BATCH_ROWS, INGEST_FLUSH_MS
+from ingest import enqueue, queued, take_batch, batch_done, count_write_error, dead_letter, recover, get_ingest_stats
+
+logger = logging.getLogger(__name__)
+
+_handlers = []
+_flusher = None
+_wakeup = None  # set when a message is queued
+
+async def submit(message):
+    """Accept a message for the flusher; False if the queue is full"""
+    if not await asyncio.to_thread(enqueue, message):
+        return False
+    if _wakeup is not None:
+        _wakeup.set()
+    return True
+
+def add_handler(handler):
+    """Register async handler(messages); runs in the flusher task after each
+    batch is written, with the messages written (ids set)
+    """
+    _handlers.append(handler)
+
+async def _write_retrying(messages, write):
+    """await write(messages), retried with backoff while the database is unreachable (see ingest._write_retrying)"""
+    delay = 0.1
+    while True:
+        try:
+            return await write(messages)
+        except psycopg.OperationalError:
+            await asyncio.to_thread(count_write_error)
+            logger.exception('Writing %s queued messages failed, retrying in %ss', len(messages), delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+async def _write(batch, write):
+    """Write one batch, row by row if it fails otherwise, dead-lettering the rows
+    that fail again (see ingest._write)
+    """
+    try:
+        written = await _write_retrying(batch, write)
+    except Exception:
+        await asyncio.to_thread(count_write_error)
+        logger.exception('Writing %s queued messages failed, writing them one by one', len(batch))
+        written = []
+        for message in batch:
+            try:
+                written += await _write_retrying([message], write)
+            except Exception as e:
+                await asyncio.to_thread(dead_letter, message, e)
+    await asyncio.to_thread(batch_done, batch, written)
+    for handler in list(_handlers):
+        try:
+            await handler(written)
+        except Exception:
+            logger.exception('Ingest handler %r failed', handler)
+
+async def _flush_forever(write):
+    """Flusher loop: wait for a full batch or INGEST_FLUSH_MS, then write until the queue is empty"""
+    while True:
+        await _wakeup.wait()
+        _wakeup.clear()
+        if queued() < INGEST_BATCH_ROWS:
+            await asyncio.sleep(INGEST_FLUSH_MS / 1000)
+        while batch := await asyncio.to_thread(take_batch):
+            await _write(batch, write)
+
+async def start_flusher(write):
+    """Replay dead workers' spill files and start this worker's flusher task
+    (once per process); await write(messages) inserts one batch and returns
+    the messages it wrote
+    """
+    global _flusher, _wakeup
+    if _flusher is None or _flusher.done():
+        _wakeup = asyncio.Event()
+        if await asyncio.to_thread(recover):
+            _wakeup.set()
+        _flusher = asyncio.create_task(_flush_forever(write))
+
+async def stop_flusher():
+    """Cancel the flusher task (what is still queued stays in the spill files)"""
+    global _flusher
+    if _flusher is not None:
+        _flusher.cancel()
+        try:
+            await _flusher
+        except asyncio.CancelledError:
+            pass
+        _flusher = None
+
+def init_app(app, write):
+    """Run the flusher for as long as the server is serving"""
+    async def start():
+        await start_flusher(write)
+
+    app.before_serving(start)
+    app.after_serving(stop_flusher)
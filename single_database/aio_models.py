@@ -0,0 +1,340 @@
+# Async counterpart of models.py for the ASGI entry point (asgi.py)
+# Same functions and SQL (imported from models.py), awaiting aio_db instead of db
+from aio_db import execute_query, execute_insert, execute_batch, execute_detached, on_commit
+from config import CODENAME_LEGACY_LOOKUP
+from models import (
+    CREATE_USER_SQL, USERS_BY_IDS_SQL, USER_BY_ID_SQL, USER_BY_USERNAME_SQL, DELETE_USER_SQL,
+    CREATE_ROOM_SQL, ROOM_BY_ID_SQL, ROOM_BY_CODENAME_SQL, ROOMS_BY_USER_SQL,
+    ADD_ROOM_MEMBER_SQL, join_room_statements, REMOVE_ROOM_MEMBER_SQL, MEMBER_ROOM_IDS_SQL,
+    ROOM_MEMBERS_SQL, ROOM_MEMBER_COUNT_SQL,
+    MESSAGE_BY_ID_SQL, create_message_statement, create_messages_statement, insert_messages_statement, written_messages, new_message, LATEST_BY_ROOMS_SQL,
+    messages_page_statement, chronological, remember_member_rooms, has_member,
+    messages_read_statement, messages_read_result, restore_users, deleted_user_commands,
+    restore_member_rooms, restore_room_buffer, share_room_buffer_commands
+)
+from aio_singleflight import coalesced
+from codename import encode_codename, decode_codename
+import aio_shared_cache as shared_cache
+import aio_idgen as idgen
+import aio_ingest as ingest
+import cache
+
+# ============ USER FUNCTIONS ============
+
+async def create_user(username):
+    """Create a new user; returns None if the username is taken"""
+    return await execute_insert(CREATE_USER_SQL, (username,))
+
+async def get_users_by_ids(user_ids):
+    """Get {user_id: user row, or None if deleted} for many users (see models.get_users_by_ids)"""
+    users, missing = cache.get_cached_users(user_ids)
+    if missing:
+        shared = (await shared_cache.get_many(users=missing))[0]
+        users.update(restore_users(shared))
+        missing = [user_id for user_id in missing if user_id not in shared]
+    if missing:
+        rows = await execute_query(USERS_BY_IDS_SQL, (missing,), fetch_all=True, prepare=True)
+        fetched = cache.set_users(rows, missing)
+        await shared_cache.set_users(fetched)
+        users.update(fetched)
+    return users
+
+async def get_user_by_id(user_id):
+    """Get user by ID (user directory cache)"""
+    return (await get_users_by_ids([user_id]))[user_id]
+
+async def get_user_by_username(username):
+    """Get user by username"""
+    return await execute_query(USER_BY_USERNAME_SQL, (username,), fetch_one=True)
+
+async def username_exists(username):
+    """Check if username already exists"""
+    user = await get_user_by_username(username)
+    return user is not None
+
+async def delete_user(user_id):
+    """Delete a user"""
+    rooms = await execute_query(MEMBER_ROOM_IDS_SQL, (user_id,), fetch_all=True) if shared_cache.enabled() else []
+    await execute_query(DELETE_USER_SQL, (user_id,))
+    forget_member_rooms(user_id)
+    cache.invalidate_user(user_id)
+    on_commit(lambda: cache.set_users([], [user_id]))  # remember it as deleted
+    on_commit(cache.clear_room_buffers)  # their messages were deleted with them
+    on_commit(lambda: shared_cache.drop_member_rooms(user_id, deleted_user_commands(user_id, rooms)))
+
+# ============ ROOM FUNCTIONS ============
+
+async def create_room(room_type, creator_id):
+    """Create a new room and add creator as member, in one round trip (see models.create_room)"""
+    room_id = await idgen.next_id('rooms')
+    codename = encode_codename(room_id)
+    await execute_batch([
+        (CREATE_ROOM_SQL, (room_id, codename, room_type), None),
+        (ADD_ROOM_MEMBER_SQL, (room_id, creator_id, 1 if room_type == 'dm' else None), None)
+    ], prepare=True)
+    forget_member_rooms(creator_id)
+    on_commit(lambda: shared_cache.add_member_room(creator_id, room_id))
+    return room_id, codename
+
+@coalesced
+async def get_room_by_id(room_id):
+    """Get room by ID (shared cache first: rooms never change)"""
+    room = (await shared_cache.get_many(rooms=[room_id]))[1].get(room_id)
+    if room is None:
+        room = await execute_query(ROOM_BY_ID_SQL, (room_id,), fetch_one=True)
+        await shared_cache.set_room(room)
+    return room
+
+async def get_room_by_codename(codename):
+    """Get room by codename (see models.get_room_by_codename)"""
+    codename = codename.upper()
+    room_id = decode_codename(codename)
+    if room_id is not None:
+        room = await get_room_by_id(room_id)
+        if room and room['codename'] == codename:
+            return room
+    if not CODENAME_LEGACY_LOOKUP:
+        return None
+    return await execute_query(ROOM_BY_CODENAME_SQL, (codename,), fetch_one=True)
+
+async def get_rooms_by_user(user_id):
+    """Get all rooms for a user (also refreshes the membership cache)"""
+    rooms = await execute_query(ROOMS_BY_USER_SQL, (user_id,), fetch_all=True)
+    await shared_cache.set_member_rooms(user_id, cache.set_member_rooms(user_id, (room['id'] for room in rooms or [])))
+    return rooms
+
+# ============ ROOM MEMBER FUNCTIONS ============
+
+async def join_room(codename, user_id):
+    """Join a room by codename in one statement (see models.join_room)"""
+    room = None
+    for query, params in join_room_statements(codename, user_id):
+        room = await execute_query(query, params, fetch_one=True, prepare=True)
+        if room:
+            break
+    if room and room['status'] == 'joined':
+        forget_member_rooms(user_id)
+        on_commit(lambda: shared_cache.add_member_room(user_id, room['id']))
+    return room
+
+async def remove_room_member(room_id, user_id):
+    """Remove user from room; returns False if they were not a member"""
+    if not await execute_query(REMOVE_ROOM_MEMBER_SQL, (room_id, user_id), fetch_one=True):
+        return False
+    forget_member_rooms(user_id)
+    on_commit(lambda: shared_cache.remove_member_room(user_id, room_id))
+    return True
+
+def forget_member_rooms(user_id):
+    """Drop a user's cached rooms now and again once the change commits"""
+    cache.invalidate_member(user_id)
+    on_commit(lambda: cache.invalidate_member(user_id))
+
+async def is_room_member(room_id, user_id):
+    """Check if user is member of room (see models.is_room_member)"""
+    if cache.check_membership(user_id, room_id):
+        return True
+    if restore_member_rooms(user_id, room_id, (await shared_cache.get_many(member_rooms=[user_id]))[2]):
+        return True
+    rows = await execute_query(MEMBER_ROOM_IDS_SQL, (user_id,), fetch_all=True, prepare=True)
+    room_ids = remember_member_rooms(user_id, rows)
+    await shared_cache.set_member_rooms(user_id, room_ids)
+    return room_id in room_ids
+
+@coalesced
+async def get_room_members(room_id):
+    """Get all members of a room"""
+    return await execute_query(ROOM_MEMBERS_SQL, (room_id,), fetch_all=True, prepare=True)
+
+async def get_room_member_count(room_id):
+    """Get member count of a room"""
+    result = await execute_query(ROOM_MEMBER_COUNT_SQL, (room_id,), fetch_one=True)
+    return result['count'] if result else 0
+
+# ============ MESSAGE FUNCTIONS ============
+
+async def create_message(room_id, sender_id, content, sender_name):
+    """Create a new message and return the inserted row (sender_name from the caller)"""
+    query, params = create_message_statement(room_id, sender_id, content)
+    message = dict(await execute_query(query, params, fetch_one=True, prepare=True))
+    message['sender_name'] = sender_name
+    on_commit(lambda: cache.append_room_message(room_id, message))
+    on_commit(lambda: shared_cache.append_recent_message(room_id, message))
+    return message
+
+async def create_messages(room_id, sender_id, contents, sender_name):
+    """Create several messages in a room with one statement (see models.create_messages)"""
+    rows = await execute_query(*create_messages_statement(room_id, sender_id, contents), fetch_all=True, prepare=True)
+    messages = sorted(({**row, 'sender_name': sender_name} for row in rows), key=lambda message: message['id'])
+    on_commit(lambda: remember_new_messages(messages))
+    return messages
+
+async def queue_message(room_id, sender_id, content, sender_name):
+    """Accept a message for write-behind ingestion (see models.queue_message)"""
+    message = new_message(None, room_id, sender_id, content, sender_name)
+    return message if await ingest.submit(message) else None
+
+async def write_messages(messages):
+    """Ingest flusher: insert one batch, then add it to the room caches (see models.write_messages)"""
+    rows = await execute_detached(*insert_messages_statement(messages), fetch_all=True)
+    messages = written_messages(messages, rows)
+    await remember_new_messages(messages)
+    return messages
+
+async def remember_new_messages(messages):
+    """Add committed messages to the room buffers and the shared cache (one pipeline)"""
+    commands = []
+    for message in messages:
+        cache.append_room_message(message['room_id'], message)
+        commands += shared_cache.append_recent_message_commands(message['room_id'], message)
+    await shared_cache.write(commands)
+
+async def get_buffered_page(room_id, limit, before=None, after=None):
+    """Answer a page from the room buffer, loading it from the shared cache on a miss"""
+    page = cache.get_room_page(room_id, limit, before, after)
+    if page is None and not cache.has_room_buffer(room_id):
+        recent = (await shared_cache.get_many(recent_messages=[room_id]))[3]
+        page = restore_room_buffer(room_id, recent.get(room_id), limit, before, after)
+    return page
+
+async def fetch_messages_page(room_id, limit=50, before=None, after=None):
+    """Read one page straight from the database (no buffer)"""
+    query, params, newest_first = messages_page_statement(room_id, limit, before, after)
+    return chronological(await execute_query(query, params, fetch_all=True, prepare=True), newest_first)
+
+@coalesced
+async def get_messages_by_room(room_id, limit=50, before=None, after=None):
+    """Get one page of messages in a room (see models.get_messages_by_room)"""
+    page = await get_buffered_page(room_id, limit, before, after)
+    if page is None:
+        query, params, newest_first, fills = messages_read_statement(room_id, limit, before, after)
+        messages = await execute_query(query, params, fetch_all=True, prepare=True)
+        page = messages_read_result(room_id, limit, before, after, messages, newest_first, fills)
+        await shared_cache.write(share_room_buffer_commands(room_id, fills))
+    if page is None:
+        page = await fetch_messages_page(room_id, limit, before, after)
+    return page
+
+async def get_latest_messages(room_ids, limit):
+    """Get {room_id: latest `limit` messages} for many rooms (see models.get_latest_messages)"""
+    latest = {}
+    for room_id in room_ids:
+        page = cache.get_room_page(room_id, limit)
+        if page is not None:
+            latest[room_id] = page
+    missing = [room_id for room_id in room_ids if room_id not in latest]
+    if missing:
+        recent = (await shared_cache.get_many(recent_messages=missing))[3]
+        for room_id in missing:
+            page = restore_room_buffer(room_id, recent.get(room_id), limit)
+            if page is not None:
+                latest[room_id] = page
+        missing = [room_id for room_id in missing if room_id not in latest]
+    if missing:
+        latest.update({room_id: [] for room_id in missing})
+        for message in await execute_query(LATEST_BY_ROOMS_SQL, (missing, limit), fetch_all=True, prepare=True):
+            latest[message['room_id']].append(message)
+    return latest
+
+async def get_latest_messages_for_member(room_ids, user_id, limit):
+    """get_latest_messages for the rooms in room_ids that user_id is a member of"""
+    return await get_latest_messages([room_id for room_id in room_ids if await is_room_member(room_id, user_id)], limit)
+
+async def get_message_by_id(message_id):
+    """Get message by ID"""
+    return await execute_query(MESSAGE_BY_ID_SQL, (message_id,), fetch_one=True)
+
+# ============ BATCHED READS ============
+
+async def get_dashboard_context(user_id):
+    """Get user and their rooms in one round trip"""
+    user, rooms = await execute_batch([
+        (USER_BY_ID_SQL, (user_id,), 'one'),
+        (ROOMS_BY_USER_SQL, (user_id,), 'all')
+    ], prepare=True)
+    await shared_cache.set_member_rooms(user_id, cache.set_member_rooms(user_id, (room['id'] for room in rooms or [])))
+    return user, rooms
+
+async def get_chat_room_context(room_id, user_id, limit=50):
+    """Get everything the chat page needs in one round trip (see models.get_chat_room_context)"""
+    messages = cache.get_room_page(room_id, limit)
+    load_recent = messages is None and not cache.has_room_buffer(room_id)
+    users, rooms, _, recent = await shared_cache.get_many(
+        users=[user_id], rooms=[room_id], recent_messages=[room_id] if load_recent else []
+    )
+    room, user = rooms.get(room_id), users.get(user_id)
+    if messages is None:
+        messages = restore_room_buffer(room_id, recent.get(room_id), limit)
+
+    statements = [(ROOM_MEMBERS_SQL, (room_id,), 'all')]
+    if room is None:
+        statements.append((ROOM_BY_ID_SQL, (room_id,), 'one'))
+    if user is None:
+        statements.append((USER_BY_ID_SQL, (user_id,), 'one'))
+    if messages is None:
+        messages_query, messages_params, newest_first, fills = messages_read_statement(room_id, limit)
+        statements.append((messages_query, messages_params, 'all'))
+    members, *rows = await execute_batch(statements, prepare=True)
+
+    rows, writes = iter(rows), []
+    if room is None:
+        room = next(rows)
+        writes += shared_cache.set_room_commands(room)
+    if user is None:
+        user = next(rows)
+        writes += shared_cache.set_users_commands({user_id: user})
+    if messages is None:
+        messages = messages_read_result(room_id, limit, None, None, next(rows), newest_first, fills)
+        writes += share_room_buffer_commands(room_id, fills)
+    await shared_cache.write(writes)
+    return {
+        'room': room,
+        'is_member': has_member(members, user_id),
+        'user': user,
+        'messages': messages,
+        'members': members
+    }
+
+async def get_messages_for_member(room_id, user_id, limit=50, before=None, after=None):
+    """Check membership and get a page of messages in one round trip (None if not a member)"""
+    if cache.check_membership(user_id, room_id):
+        return await get_messages_by_room(room_id, limit, before, after)  # coalesced with other readers of the room
+
+    page = cache.get_room_page(room_id, limit, before, after)
+    load_recent = page is None and not cache.has_room_buffer(room_id)
+    _, _, member_rooms, recent = await shared_cache.get_many(
+        member_rooms=[user_id], recent_messages=[room_id] if load_recent else []
+    )
+    is_member = restore_member_rooms(user_id, room_id, member_rooms)
+    if page is None:
+        page = restore_room_buffer(room_id, recent.get(room_id), limit, before, after)
+    if is_member and page is not None:
+        return page
+
+    statements = []
+    if not is_member:
+        statements.append((MEMBER_ROOM_IDS_SQL, (user_id,), 'all'))
+    if page is None:
+        messages_query, messages_params, newest_first, fills = messages_read_statement(room_id, limit, before, after)
+        statements.append((messages_query, messages_params, 'all'))
+    results = await execute_batch(statements, prepare=True)
+
+    writes = []
+    if not is_member:
+        room_ids = remember_member_rooms(user_id, results[0])
+        writes += shared_cache.set_member_rooms_commands(user_id, room_ids)
+        if room_id not in room_ids:
+            await shared_cache.write(writes)
+            return None
+    if page is None:
+        page = messages_read_result(room_id, limit, before, after, results[-1], newest_first, fills)
+        writes += share_room_buffer_commands(room_id, fills)
+    await shared_cache.write(writes)
+    if page is None:
+        page = await fetch_messages_page(room_id, limit, before, after)
+    return page
+
+async def get_members_for_member(room_id, user_id):
+    """Get room members if the user is one of them (None if not a member)"""
+    members = await get_room_members(room_id)  # coalesced with other members of the room
+    return members if has_member(members, user_id) else None
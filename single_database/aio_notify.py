@@ -0,0 +1,87 @@
+# Async counterpart of notify.py for the ASGI entry point (asgi.py)
+# One listener task per worker process instead of a thread; same channel and payload
+import asyncio
+import logging
+
+import psycopg
+from psycopg import AsyncConnection
+from config import DB_CONFIG, NOTIFY_CHANNEL
+import cache
+from notify import parse_payload, listen_statement
+
+logger = logging.getLogger(__name__)
+
+_handlers = []
+_listener = None
+_stats = {'received': 0, 'handler_errors': 0, 'reconnects': 0}
+
+def add_handler(handler):
+    """Register async handler(room_id, message_id); runs in the listener task"""
+    _handlers.append(handler)
+
+async def dispatch(payload):
+    """Pass one notification to every handler; a failing handler does not stop the others"""
+    room_id, message_id = parse_payload(payload)
+    _stats['received'] += 1
+    for handler in list(_handlers):
+        try:
+            await handler(room_id, message_id)
+        except Exception:
+            _stats['handler_errors'] += 1
+            logger.exception('Notify handler %r failed for %s', handler, payload)
+
+async def _listen_forever():
+    """Listener loop: LISTEN on a dedicated autocommit connection, reconnecting with backoff"""
+    delay = 1
+    while True:
+        try:
+            async with await AsyncConnection.connect(
+                host=DB_CONFIG['host'],
+                port=DB_CONFIG['port'],
+                dbname=DB_CONFIG['database'],
+                user=DB_CONFIG['user'],
+                password=DB_CONFIG['password'],
+                autocommit=True
+            ) as conn:
+                await conn.execute(listen_statement())
+                cache.follow_messages(True)
+                delay = 1
+                async for notification in conn.notifies():
+                    await dispatch(notification.payload)
+        except psycopg.Error as e:
+            logger.warning('Notify listener disconnected (%s), retrying in %ss', e, delay)
+        finally:
+            cache.follow_messages(False)
+        _stats['reconnects'] += 1
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 30)
+
+async def start_listener():
+    """Start this worker's listener task (once per process)"""
+    global _listener
+    if _listener is None or _listener.done():
+        _listener = asyncio.create_task(_listen_forever())
+
+async def stop_listener():
+    """Cancel the listener task"""
+    global _listener
+    if _listener is not None:
+        _listener.cancel()
+        try:
+            await _listener
+        except asyncio.CancelledError:
+            pass
+        _listener = None
+
+def init_app(app):
+    """Run the listener for as long as the server is serving"""
+    app.before_serving(start_listener)
+    app.after_serving(stop_listener)
+
+def get_notify_stats():
+    """Get listener state: running, notifications received, handler errors and reconnects"""
+    return {
+        'listening': _listener is not None and not _listener.done(),
+        'handlers': len(_handlers),
+        **_stats
+    }
@@ -0,0 +1,113 @@
+# Async counterpart of shared_cache.py for the ASGI entry point (asgi.py)
+# Same keys, encoding and commands (imported from shared_cache.py), sent with
+# redis.asyncio, or an async wrapper around the in-process stand-in. A failed
+# membership drop is retried by shared_cache.py's thread, with the sync client
+import threading
+
+from config import SHARED_CACHE_URL
+from shared_cache import (
+    MemoryClient, MemoryPipeline, enabled, _stats, _failed, member_rooms_key, retry_drop,
+    get_many_commands, get_many_result, set_users_commands, set_room_commands,
+    set_member_rooms_commands, add_member_room_commands, remove_member_room_commands,
+    set_recent_messages_commands, append_recent_message_commands, get_shared_cache_stats
+)
+
+class AsyncMemoryClient:
+    """MemoryClient behind the redis.asyncio pipeline interface"""
+
+    def __init__(self):
+        self.client = MemoryClient()
+
+    def pipeline(self, transaction=True):
+        return AsyncMemoryPipeline(self.client)
+
+class AsyncMemoryPipeline(MemoryPipeline):
+    """MemoryPipeline with an awaitable execute()"""
+
+    async def execute(self):
+        return MemoryPipeline.execute(self)
+
+def connect(url):
+    """Create the async client for SHARED_CACHE_URL"""
+    if url.startswith('memory://'):
+        return AsyncMemoryClient()
+    import redis.asyncio  # optional dependency, only needed for redis:// URLs
+    return redis.asyncio.Redis.from_url(url)
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Get this process's async client (created on first use)"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = connect(SHARED_CACHE_URL)
+        return _client
+
+async def execute(commands, transaction=False):
+    """Run commands in one pipeline round trip; returns their results (see shared_cache.execute)"""
+    pipe = get_client().pipeline(transaction=transaction)
+    for command, *args in commands:
+        getattr(pipe, command)(*args)
+    return await pipe.execute()
+
+async def get_many(users=(), rooms=(), member_rooms=(), recent_messages=()):
+    """Pipelined multi-get of any mix of entries (see shared_cache.get_many_result)"""
+    commands, targets = get_many_commands(users, rooms, member_rooms, recent_messages)
+    if not enabled() or not commands:
+        return {}, {}, {}, {}
+    _stats['reads'] += 1
+    try:
+        raw = await execute(commands)
+    except Exception:
+        _failed('read')
+        return {}, {}, {}, {}
+    return get_many_result(targets, raw)
+
+async def write(commands):
+    """Run write commands in one pipeline round trip (no-op when disabled)"""
+    if not enabled() or not commands:
+        return
+    _stats['writes'] += 1
+    try:
+        await execute(commands, transaction=True)
+    except Exception:
+        _failed('write')
+
+async def drop_member_rooms(user_id, commands):
+    """Run write commands that delete a user's rooms, retried until they land
+    (see shared_cache.drop_member_rooms)
+    """
+    if not enabled():
+        return
+    _stats['writes'] += 1
+    try:
+        await execute(commands, transaction=True)
+    except Exception:
+        _failed('write')
+        retry_drop(user_id, commands)
+
+async def set_users(users):
+    await write(set_users_commands(users))
+
+async def set_room(room):
+    await write(set_room_commands(room))
+
+async def set_member_rooms(user_id, room_ids):
+    await write(set_member_rooms_commands(user_id, room_ids))
+
+async def add_member_room(user_id, room_id):
+    await write(add_member_room_commands(user_id, room_id))
+
+async def remove_member_room(user_id, room_id):
+    await drop_member_rooms(user_id, remove_member_room_commands(user_id, room_id))
+
+async def delete_member_rooms(user_id):
+    await write([('delete', member_rooms_key(user_id))])
+
+async def set_recent_messages(room_id, messages, complete=False):
+    await write(set_recent_messages_commands(room_id, messages, complete))
+
+async def append_recent_message(room_id, message):
+    await write(append_recent_message_commands(room_id, message))
@@ -0,0 +1,44 @@
+# Async counterpart of singleflight.py for the ASGI entry point (asgi.py)
+# Waiters await the first caller's future instead of a thread event; calls are
+# counted in the same stats as singleflight.py
+import asyncio
+import functools
+from config import SINGLE_FLIGHT
+from singleflight import call_key, count_call, _lock, get_single_flight_stats
+
+_calls = {}  # (function name, args) -> future of the in-flight call
+_ABANDONED = object()  # the first caller was cancelled: waiters run the call themselves
+
+def coalesced(func):
+    """Decorator: concurrent identical calls of an async function share one execution"""
+    if not SINGLE_FLIGHT:
+        return func
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        key = call_key(name, args, kwargs)
+        future = _calls.get(key)
+        with _lock:
+            count_call(name, future is not None)
+
+        if future is not None:
+            result = await asyncio.shield(future)
+            return await func(*args, **kwargs) if result is _ABANDONED else result
+
+        future = _calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await func(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.set_result(_ABANDONED)  # e.g. the client went away
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # retrieved: no "never retrieved" warning without waiters
+            raise
+        finally:
+            del _calls[key]
+
+    return wrapper
@@ -1,10 +1,23 @@
-from flask import Flask, request, jsonify, session, redirect, url_for, render_template
+from flask import Flask, Response, request, jsonify, session, redirect, url_for, render_template
 from functools import wraps
-from config import SECRET_KEY
+import hmac
+import json
+import queue
+import threading
+from config import SECRET_KEY, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, MAX_BATCH_MESSAGES, MAX_LATEST_ROOMS, SSE_KEEPALIVE_SECONDS, SSE_QUEUE_SIZE, DB_NOTIFY, INGEST_QUEUE, STATS_TOKEN
 import models
+import db
+import notify
+import broker
+import cache
+import singleflight
+import idgen
+import ingest
+import shared_cache
 
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
+db.init_app(app)
 
 # ============ HELPER FUNCTIONS ============
 
@@ -18,6 +31,16 @@ def json_response(success, message, data=None, status=200):
         response['data'] = data
     return jsonify(response), status
 
+def message_to_dict(msg):
+    """Convert a message row to a JSON-serializable dict"""
+    msg_dict = dict(msg)
+    msg_dict['created_at'] = msg_dict['created_at'].isoformat() if msg_dict['created_at'] else None
+    return msg_dict
+
+def sse_event(msg_dict):
+    """Format a message as a Server-Sent Event (id lets the browser resume via Last-Event-ID)"""
+    return f"id: {msg_dict['id']}\nevent: message\ndata: {json.dumps(msg_dict)}\n\n"
+
 def login_required(f):
     """Decorator to check if user is logged in"""
     @wraps(f)
@@ -29,6 +52,18 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def stats_token_required(f):
+    """Decorator to allow only requests carrying STATS_TOKEN (404 while it is unset)"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not STATS_TOKEN:
+            return json_response(False, 'Not found', status=404)
+        token = request.headers.get('X-Stats-Token', '')
+        if not hmac.compare_digest(token.encode(), STATS_TOKEN.encode()):
+            return json_response(False, 'Stats token required', status=401)
+        return f(*args, **kwargs)
+    return decorated_function
+
 def get_current_user():
     """Get current logged in user"""
     if 'user_id' in session:
@@ -46,30 +81,26 @@ def index():
 
 @app.route('/dashboard')
 @login_required
+@db.read_only
 def dashboard():
     """Dashboard page"""
-    user = get_current_user()
-    rooms = models.get_rooms_by_user(session['user_id'])
+    user, rooms = models.get_dashboard_context(session['user_id'])
     return render_template('dashboard.html', user=user, rooms=rooms)
 
 @app.route('/room/<int:room_id>')
 @login_required
+@db.read_only
 def chat_room(room_id):
     """Chat room page"""
-    # Check if room exists
-    room = models.get_room_by_id(room_id)
-    if not room:
-        return redirect(url_for('dashboard'))
+    # Room, membership, user, messages and members in one round trip
+    context = models.get_chat_room_context(room_id, session['user_id'])
     
-    # Check if user is member
-    if not models.is_room_member(room_id, session['user_id']):
+    # Check if room exists and user is member
+    if not context['room'] or not context['is_member']:
         return redirect(url_for('dashboard'))
     
-    user = get_current_user()
-    messages = models.get_messages_by_room(room_id)
-    members = models.get_room_members(room_id)
-    
-    return render_template('chat.html', user=user, room=room, messages=messages, members=members)
+    return render_template('chat.html', user=context['user'], room=context['room'],
+                           messages=context['messages'], members=context['members'])
 
 # ============ AUTH API ============
 
@@ -86,11 +117,10 @@ def api_register():
     if len(username) < 3:
         return json_response(False, 'Username must be at least 3 characters', status=400)
     
-    if models.username_exists(username):
-        return json_response(False, 'Username already exists', status=400)
-    
     try:
         user_id = models.create_user(username)
+        if user_id is None:
+            return json_response(False, 'Username already exists', status=400)
         session['user_id'] = user_id
         session['username'] = username
         
@@ -139,6 +169,7 @@ def logout():
 
 @app.route('/api/rooms', methods=['GET'])
 @login_required
+@db.read_only
 def api_get_my_rooms():
     """Get rooms for current user"""
     rooms = models.get_rooms_by_user(session['user_id'])
@@ -178,53 +209,46 @@ def api_join_room():
     
     codename = data['codename'].strip().upper()
     
-    # Check if room exists by codename
-    room = models.get_room_by_codename(codename)
+    # One statement finds the room, checks membership and the DM limit and joins
+    try:
+        room = models.join_room(codename, session['user_id'])
+    except Exception as e:
+        return json_response(False, str(e), status=500)
+    
     if not room:
         return json_response(False, 'Room not found', status=404)
     
-    room_id = room['id']
-    
-    # Check if already member
-    if models.is_room_member(room_id, session['user_id']):
+    if room['status'] == 'member':
         return json_response(False, 'Already a member of this room', status=400)
     
-    # Check DM room limit
-    if room['type'] == 'dm':
-        member_count = models.get_room_member_count(room_id)
-        if member_count >= 2:
-            return json_response(False, 'DM room is full (max 2 members)', status=400)
+    if room['status'] == 'full':
+        return json_response(False, 'DM room is full (max 2 members)', status=400)
     
-    try:
-        models.add_room_member(room_id, session['user_id'])
-        return json_response(True, 'Joined room successfully', {
-            'room_id': room_id,
-            'codename': room['codename']
-        })
-    except Exception as e:
-        return json_response(False, str(e), status=500)
+    return json_response(True, 'Joined room successfully', {
+        'room_id': room['id'],
+        'codename': room['codename']
+    })
 
 @app.route('/api/rooms/<int:room_id>/leave', methods=['POST'])
 @login_required
 def api_leave_room(room_id):
     """Leave a room"""
-    if not models.is_room_member(room_id, session['user_id']):
-        return json_response(False, 'Not a member of this room', status=400)
-    
     try:
-        models.remove_room_member(room_id, session['user_id'])
+        if not models.remove_room_member(room_id, session['user_id']):
+            return json_response(False, 'Not a member of this room', status=400)
         return json_response(True, 'Left room successfully')
     except Exception as e:
         return json_response(False, str(e), status=500)
 
 @app.route('/api/rooms/<int:room_id>/members', methods=['GET'])
 @login_required
+@db.read_only
 def api_get_room_members(room_id):
     """Get room members"""
-    if not models.is_room_member(room_id, session['user_id']):
+    members = models.get_members_for_member(room_id, session['user_id'])
+    if members is None:
         return json_response(False, 'Not a member of this room', status=403)
     
-    members = models.get_room_members(room_id)
     members_list = [dict(m) for m in members] if members else []
     return json_response(True, 'Members fetched', members_list)
 
@@ -232,22 +256,102 @@ def api_get_room_members(room_id):
 
 @app.route('/api/rooms/<int:room_id>/messages', methods=['GET'])
 @login_required
+@db.read_only
 def api_get_messages(room_id):
-    """Get messages in a room"""
-    if not models.is_room_member(room_id, session['user_id']):
-        return json_response(False, 'Not a member of this room', status=403)
+    """Get a page of messages in a room
+    Query params: before=<message_id> or after=<message_id>, limit (1-{MAX_PAGE_SIZE})
+    """
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    
+    if before is not None and after is not None:
+        return json_response(False, 'Use either before or after, not both', status=400)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return json_response(False, f'Limit must be between 1 and {MAX_PAGE_SIZE}', status=400)
     
-    messages = models.get_messages_by_room(room_id)
+    messages = models.get_messages_for_member(room_id, session['user_id'], limit, before, after)
+    if messages is None:
+        return json_response(False, 'Not a member of this room', status=403)
     
     # Convert datetime to string for JSON
-    messages_list = []
-    for msg in messages:
-        msg_dict = dict(msg)
-        msg_dict['created_at'] = msg_dict['created_at'].isoformat() if msg_dict['created_at'] else None
-        messages_list.append(msg_dict)
+    messages_list = [message_to_dict(msg) for msg in messages]
     
     return json_response(True, 'Messages fetched', messages_list)
 
+@app.route('/api/rooms/<int:room_id>/messages/since/<int:message_id>', methods=['GET'])
+@login_required
+@db.read_only
+def api_sync_messages(room_id, message_id):
+    """Get only the messages newer than message_id (incremental sync for polling)
+    Returns 204 with an empty body when nothing is new
+    """
+    messages = models.get_messages_for_member(room_id, session['user_id'], MAX_PAGE_SIZE, after=message_id)
+    if messages is None:
+        return json_response(False, 'Not a member of this room', status=403)
+    
+    if not messages:
+        return '', 204
+    
+    return json_response(True, 'Messages fetched', [message_to_dict(msg) for msg in messages])
+
+@app.route('/api/rooms/<int:room_id>/stream', methods=['GET'])
+@login_required
+@db.read_only
+def api_stream_messages(room_id):
+    """Stream new messages in a room as Server-Sent Events
+    Resumes after Last-Event-ID (or ?after=<message_id>) by sending the missed messages first
+    """
+    user_id = session['user_id']
+    last_id = request.headers.get('Last-Event-ID', type=int) or request.args.get('after', 0, type=int)
+    
+    events = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+    overflow = threading.Event()
+    
+    def deliver(event):
+        try:
+            events.put_nowait(event)
+        except queue.Full:
+            overflow.set()  # slow client: end the stream, it resumes from Last-Event-ID
+    
+    # Subscribe before reading the backlog so nothing committed in between is lost
+    broker.subscribe(room_id, deliver)
+    try:
+        if last_id:
+            backlog = models.get_messages_for_member(room_id, user_id, MAX_PAGE_SIZE, after=last_id)
+        else:
+            backlog = [] if models.is_room_member(room_id, user_id) else None
+    except Exception:
+        broker.unsubscribe(room_id, deliver)
+        raise
+    
+    if backlog is None:
+        broker.unsubscribe(room_id, deliver)
+        return json_response(False, 'Not a member of this room', status=403)
+    
+    backlog = [message_to_dict(msg) for msg in backlog]
+    
+    # Runs after the request has ended and its connection is back in the pool
+    def stream():
+        sent_ids = set()
+        try:
+            for msg_dict in backlog:
+                sent_ids.add(msg_dict['id'])
+                yield sse_event(msg_dict)
+            while not overflow.is_set():
+                try:
+                    msg_dict = events.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ': ping\n\n'
+                    continue
+                if msg_dict['id'] not in sent_ids:
+                    yield sse_event(msg_dict)
+        finally:
+            broker.unsubscribe(room_id, deliver)
+    
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/rooms/<int:room_id>/messages', methods=['POST'])
 @login_required
 def api_send_message(room_id):
@@ -265,20 +369,86 @@ def api_send_message(room_id):
         return json_response(False, 'Message cannot be empty', status=400)
     
     try:
-        message_id = models.create_message(room_id, session['user_id'], content)
-        message = models.get_message_by_id(message_id)
+        if INGEST_QUEUE:
+            # Queued for the flusher; its id is given when the batch is written
+            message = models.queue_message(room_id, session['user_id'], content, session['username'])
+            if message is None:
+                return json_response(False, 'Too many messages, try again shortly', status=429)
+            return json_response(True, 'Message accepted', message_to_dict(message), status=202)
+        
+        # One INSERT ... RETURNING *, sender name from the session
+        message = models.create_message(room_id, session['user_id'], content, session['username'])
+        message_dict = message_to_dict(message)
+        
+        # Without the NOTIFY listener, push to this worker's subscribers once committed
+        if not DB_NOTIFY:
+            db.on_commit(lambda: broker.publish(room_id, message_dict))
+        
+        return json_response(True, 'Message sent', message_dict)
+    except Exception as e:
+        return json_response(False, str(e), status=500)
+
+@app.route('/api/rooms/<int:room_id>/messages/batch', methods=['POST'])
+@login_required
+def api_send_messages(room_id):
+    """Send several messages to a room with one insert
+    Body: {"messages": [{"content": "..."}, ...]} (1-{MAX_BATCH_MESSAGES} messages)
+    """
+    if not models.is_room_member(room_id, session['user_id']):
+        return json_response(False, 'Not a member of this room', status=403)
+    
+    data = request.get_json()
+    items = data.get('messages') if isinstance(data, dict) else None
+    
+    if not isinstance(items, list) or not 1 <= len(items) <= MAX_BATCH_MESSAGES:
+        return json_response(False, f'Between 1 and {MAX_BATCH_MESSAGES} messages are required', status=400)
+    
+    contents = [item.get('content', '').strip() if isinstance(item, dict) else '' for item in items]
+    if not all(contents):
+        return json_response(False, 'Message cannot be empty', status=400)
+    
+    try:
+        messages = models.create_messages(room_id, session['user_id'], contents, session['username'])
+        messages_list = [message_to_dict(message) for message in messages]
         
-        msg_dict = dict(message)
-        msg_dict['created_at'] = msg_dict['created_at'].isoformat() if msg_dict['created_at'] else None
+        # Without the NOTIFY listener, push to this worker's subscribers once committed
+        if not DB_NOTIFY:
+            db.on_commit(lambda: publish_written_messages(messages))
         
-        return json_response(True, 'Message sent', msg_dict)
+        return json_response(True, 'Messages sent', messages_list)
     except Exception as e:
         return json_response(False, str(e), status=500)
 
+@app.route('/api/messages/latest', methods=['GET'])
+@login_required
+@db.read_only
+def api_get_latest_messages():
+    """Get the latest messages of several rooms (e.g. dashboard previews)
+    Query params: room_ids=<id>,<id>,... (1-{MAX_LATEST_ROOMS}), limit (1-{MAX_PAGE_SIZE}, default 1)
+    Rooms the user is not a member of are left out
+    """
+    try:
+        room_ids = list(dict.fromkeys(int(room_id) for room_id in request.args.get('room_ids', '').split(',') if room_id))
+    except ValueError:
+        return json_response(False, 'room_ids must be a comma-separated list of ids', status=400)
+    limit = request.args.get('limit', 1, type=int)
+    
+    if not 1 <= len(room_ids) <= MAX_LATEST_ROOMS:
+        return json_response(False, f'Between 1 and {MAX_LATEST_ROOMS} room ids are required', status=400)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return json_response(False, f'Limit must be between 1 and {MAX_PAGE_SIZE}', status=400)
+    
+    latest = models.get_latest_messages_for_member(room_ids, session['user_id'], limit)
+    return json_response(True, 'Messages fetched', [
+        {'room_id': room_id, 'messages': [message_to_dict(msg) for msg in latest[room_id]]}
+        for room_id in room_ids if room_id in latest
+    ])
+
 # ============ USER API ============
 
 @app.route('/api/user', methods=['GET'])
 @login_required
+@db.read_only
 def api_get_current_user():
     """Get current user info"""
     user = get_current_user()
@@ -299,6 +469,53 @@ def api_delete_account():
     except Exception as e:
         return json_response(False, str(e), status=500)
 
+# ============ MESSAGE FAN-OUT ============
+
+def push_committed_message(room_id, message_id):
+    """NOTIFY handler: add a message committed on any worker to this worker's
+    room buffer and push it to this worker's stream subscribers
+    """
+    streaming = broker.has_subscribers(room_id)
+    message = cache.get_buffered_message(room_id, message_id)  # sent from this worker
+    if message is None and (streaming or cache.has_room_buffer(room_id)):
+        message = models.get_message_by_id(message_id)
+        if message:
+            cache.append_room_message(room_id, message)
+    if message and streaming:
+        broker.publish(room_id, message_to_dict(message))
+
+if DB_NOTIFY:
+    notify.add_handler(push_committed_message)
+    notify.start_listener()
+
+def publish_written_messages(messages):
+    """Without NOTIFY: push written messages (a batch send or an ingest batch) to this worker's stream subscribers"""
+    for message in messages:
+        broker.publish(message['room_id'], message_to_dict(message))
+
+if INGEST_QUEUE:
+    if not DB_NOTIFY:
+        ingest.add_handler(publish_written_messages)
+    ingest.start_flusher(models.write_messages)
+
+# ============ STATS API ============
+
+@app.route('/api/stats', methods=['GET'])
+@stats_token_required
+def api_get_stats():
+    """Get runtime stats (connection pool, prepared statements, message fan-out, caches, shared cache, single-flight, id blocks, ingest queue)"""
+    return json_response(True, 'Stats fetched', {
+        'pool': db.get_pool_stats(),
+        'prepared_statements': db.get_prepare_stats(),
+        'broker': broker.get_broker_stats(),
+        'notify': notify.get_notify_stats(),
+        'cache': cache.get_cache_stats(),
+        'shared_cache': shared_cache.get_shared_cache_stats(),
+        'single_flight': singleflight.get_single_flight_stats(),
+        'ids': idgen.get_idgen_stats(),
+        'ingest': ingest.get_ingest_stats()
+    })
+
 # ============ RUN APP ============
 
 if __name__ == '__main__':
@@ -0,0 +1,47 @@
+# In-process pub/sub: fans new room messages out to streaming (SSE) subscribers
+# One broker per worker process; subscribers only see messages published by
+# the same process
+import threading
+
+_subscribers = {}  # room_id -> set of deliver callbacks
+_lock = threading.Lock()
+_stats = {'published': 0, 'delivered': 0}
+
+def subscribe(room_id, deliver):
+    """Register deliver(event) for a room; it must not block (e.g. queue.put_nowait)"""
+    with _lock:
+        _subscribers.setdefault(room_id, set()).add(deliver)
+
+def unsubscribe(room_id, deliver):
+    """Remove a subscriber registered with subscribe()"""
+    with _lock:
+        room_subscribers = _subscribers.get(room_id)
+        if room_subscribers is not None:
+            room_subscribers.discard(deliver)
+            if not room_subscribers:
+                del _subscribers[room_id]
+
+def has_subscribers(room_id):
+    """Check if anyone in this process is streaming a room"""
+    with _lock:
+        return room_id in _subscribers
+
+def publish(room_id, event):
+    """Deliver an event to every subscriber of a room; returns the number of subscribers"""
+    with _lock:
+        targets = list(_subscribers.get(room_id, ()))
+        _stats['published'] += 1
+        _stats['delivered'] += len(targets)
+    for deliver in targets:
+        deliver(event)
+    return len(targets)
+
+def get_broker_stats():
+    """Get broker usage: rooms and subscribers streaming, events published and delivered"""
+    with _lock:
+        return {
+            'rooms': len(_subscribers),
+            'subscribers': sum(len(s) for s in _subscribers.values()),
+            'published': _stats['published'],
+            'delivered': _stats['delivered']
+        }
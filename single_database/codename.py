@@ -0,0 +1,67 @@
+# Room codenames derived from room ids
+# codename = base36(permute(room_id)) in 8 characters, where permute is a
+# keyed Feistel permutation of [0, 36**8): every room id has exactly one
+# codename, consecutive ids get unrelated codenames and a codename decodes back
+# to its room id without a lookup. CODENAME_KEY must not change once rooms
+# exist (their stored codenames would no longer decode to them)
+import hashlib
+import hmac
+import string
+from config import CODENAME_KEY
+
+ALPHABET = string.digits + string.ascii_uppercase
+LENGTH = 8
+SPACE = len(ALPHABET) ** LENGTH  # 36**8 codenames
+
+# Feistel network over 42 bits (2**42 > 36**8); values that land outside
+# SPACE are permuted again (cycle walking) until they are back inside
+_HALF_BITS = 21
+_HALF_MASK = (1 << _HALF_BITS) - 1
+_ROUNDS = 4
+_KEY = CODENAME_KEY.encode()
+
+def _round_function(round_number, half):
+    """Keyed pseudo-random function of one Feistel half"""
+    digest = hmac.new(_KEY, f'{round_number}:{half}'.encode(), hashlib.sha256).digest()
+    return int.from_bytes(digest[:4], 'big') & _HALF_MASK
+
+def _feistel(value):
+    left, right = value >> _HALF_BITS, value & _HALF_MASK
+    for round_number in range(_ROUNDS):
+        left, right = right, left ^ _round_function(round_number, right)
+    return (left << _HALF_BITS) | right
+
+def _feistel_inverse(value):
+    left, right = value >> _HALF_BITS, value & _HALF_MASK
+    for round_number in reversed(range(_ROUNDS)):
+        left, right = right ^ _round_function(round_number, left), left
+    return (left << _HALF_BITS) | right
+
+def _walk(value, step):
+    value = step(value)
+    while value >= SPACE:
+        value = step(value)
+    return value
+
+def encode_codename(room_id):
+    """Get the codename of a room id (0 <= room_id < 36**8)"""
+    if not 0 <= room_id < SPACE:
+        raise ValueError(f'Room id {room_id} has no codename')
+    value = _walk(room_id, _feistel)
+    chars = []
+    for _ in range(LENGTH):
+        value, digit = divmod(value, len(ALPHABET))
+        chars.append(ALPHABET[digit])
+    return ''.join(reversed(chars))
+
+def decode_codename(codename):
+    """Get the room id a codename was derived from, or None if it is malformed
+    (any well-formed codename decodes: the room may still not exist)
+    """
+    codename = codename.upper()
+    if len(codename) != LENGTH or any(char not in ALPHABET for char in codename):
+        return None
+    value = 0
+    for char in codename:
+        value = value * len(ALPHABET) + ALPHABET.index(char)
+    return _walk(value, _feistel_inverse)
@@ -9,5 +9,79 @@ DB_CONFIG = {
     'password': os.getenv('DB_PASSWORD', 'dio')
 }
 
+# Connection Pool Configuration
+DB_POOL_CONFIG = {
+    'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '2')),
+    'max_size': int(os.getenv('DB_POOL_MAX_SIZE', '20')),
+    'max_idle': float(os.getenv('DB_POOL_MAX_IDLE', '300')),  # seconds before an idle connection is closed
+    'timeout': float(os.getenv('DB_POOL_TIMEOUT', '30'))  # seconds to wait for a free connection
+}
+
+# Send independent statements of a handler in one psycopg pipeline flush
+DB_PIPELINE = os.getenv('DB_PIPELINE', 'true').lower() == 'true'
+
+# Keep hot statements as named server-side prepared statements per connection
+# (disable behind a transaction-pooling proxy that cannot track them)
+DB_PREPARED_STATEMENTS = os.getenv('DB_PREPARED_STATEMENTS', 'true').lower() == 'true'
+
+# Message history page size for GET /api/rooms/<id>/messages
+DEFAULT_PAGE_SIZE = int(os.getenv('DEFAULT_PAGE_SIZE', '50'))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', '100'))
+
+# Bulk message API: messages per POST /api/rooms/<id>/messages/batch,
+# rooms per GET /api/messages/latest
+MAX_BATCH_MESSAGES = int(os.getenv('MAX_BATCH_MESSAGES', '100'))
+MAX_LATEST_ROOMS = int(os.getenv('MAX_LATEST_ROOMS', '50'))
+
+# Server-Sent Events stream (GET /api/rooms/<id>/stream)
+SSE_KEEPALIVE_SECONDS = float(os.getenv('SSE_KEEPALIVE_SECONDS', '15'))  # comment ping interval
+SSE_QUEUE_SIZE = int(os.getenv('SSE_QUEUE_SIZE', '256'))  # undelivered events before a slow client is dropped
+
+# Cross-process fan-out: NOTIFY on commit, one LISTEN connection per worker
+DB_NOTIFY = os.getenv('DB_NOTIFY', 'true').lower() == 'true'
+NOTIFY_CHANNEL = os.getenv('NOTIFY_CHANNEL', 'chat_messages')
+
+# In-process membership cache (user_id -> room ids) for authorization checks
+MEMBERSHIP_CACHE_TTL = float(os.getenv('MEMBERSHIP_CACHE_TTL', '30'))  # seconds an entry stays valid
+MEMBERSHIP_CACHE_SIZE = int(os.getenv('MEMBERSHIP_CACHE_SIZE', '10000'))  # users kept (LRU)
+
+# In-process user directory cache (user_id -> user row) for sender names and the current user
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '3600'))  # usernames never change; bounds deleted users
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '50000'))  # users kept (LRU)
+
+# In-process buffer of each room's latest messages (answers latest-page and sync reads)
+ROOM_BUFFER_SIZE = int(os.getenv('ROOM_BUFFER_SIZE', '100'))  # messages per room, at least MAX_PAGE_SIZE
+ROOM_BUFFER_TTL = float(os.getenv('ROOM_BUFFER_TTL', '30'))  # seconds before a room is reloaded
+ROOM_BUFFER_MAX_MESSAGES = int(os.getenv('ROOM_BUFFER_MAX_MESSAGES', '50000'))  # all rooms together (LRU)
+
+# Optional shared cache tier behind the in-process caches, shared by every worker and container
+# '' = off, 'memory://' = in-process stand-in (tests, local load tests), 'redis://host:6379/0' = Redis
+SHARED_CACHE_URL = os.getenv('SHARED_CACHE_URL', '')
+SHARED_CACHE_TTL = int(os.getenv('SHARED_CACHE_TTL', '300'))  # seconds every shared entry stays valid
+SHARED_CACHE_MAX_KEYS = int(os.getenv('SHARED_CACHE_MAX_KEYS', '100000'))  # stand-in only (LRU); Redis uses maxmemory
+
+# Concurrent identical model reads (same function and arguments) share one query
+SINGLE_FLIGHT = os.getenv('SINGLE_FLIGHT', 'true').lower() == 'true'
+
+# Room codenames are derived from room ids with this key (see codename.py).
+# Never change it once rooms exist: their codenames would stop decoding
+CODENAME_KEY = os.getenv('CODENAME_KEY', 'change-me-before-creating-rooms')
+# Look up codenames that do not decode to their room (made before codename.py) by column
+CODENAME_LEGACY_LOOKUP = os.getenv('CODENAME_LEGACY_LOOKUP', 'true').lower() == 'true'
+# Ids each worker reserves from id_blocks at a time (see idgen.py)
+ID_BLOCK_SIZE = int(os.getenv('ID_BLOCK_SIZE', '100'))
+
+# Write-behind ingestion for POST /api/rooms/<id>/messages (see ingest.py): accepted
+# messages are queued and inserted in batches by a flusher per worker
+INGEST_QUEUE = os.getenv('INGEST_QUEUE', 'false').lower() == 'true'
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', '10000'))  # queued messages per worker before 429
+INGEST_BATCH_ROWS = int(os.getenv('INGEST_BATCH_ROWS', '500'))  # rows per insert
+INGEST_FLUSH_MS = int(os.getenv('INGEST_FLUSH_MS', '20'))  # longest wait for a batch to fill
+INGEST_SPILL_DIR = os.getenv('INGEST_SPILL_DIR', '/var/tmp/chat-ingest')  # '' = no spill file
+
+# GET /api/stats shows pool, cache and queue internals: it answers only
+# requests that send this token in an X-Stats-Token header ('' = stats off)
+STATS_TOKEN = os.getenv('STATS_TOKEN', '')
+
 # Flask Configuration
 SECRET_KEY = os.getenv('SECRET_KEY', 'your-secret-key-here-change-in-production')
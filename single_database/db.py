@@ -1,54 +1,270 @@
+import atexit
+import logging
+import threading
+import weakref
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
 import psycopg
+from psycopg.pq import TransactionStatus
 from psycopg.rows import dict_row
-from config import DB_CONFIG
+from psycopg.types.numeric import Int8Dumper, Int8BinaryDumper
+from psycopg_pool import ConnectionPool
+from flask import g, has_request_context
+from config import DB_CONFIG, DB_POOL_CONFIG, DB_PIPELINE, DB_PREPARED_STATEMENTS
 
-def get_connection():
-    """Get database connection"""
-    return psycopg.connect(
-        host=DB_CONFIG['host'],
-        port=DB_CONFIG['port'],
-        dbname=DB_CONFIG['database'],
-        user=DB_CONFIG['user'],
-        password=DB_CONFIG['password']
-    )
-
-def execute_query(query, params=None, fetch_one=False, fetch_all=False):
-    """Execute a query and optionally fetch results"""
-    conn = get_connection()
-    cursor = conn.cursor(row_factory=dict_row)
-    
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Statements prepared on each pooled connection, for the hit/miss counters
+_prepared = weakref.WeakKeyDictionary()
+_prepare_stats = {'hits': 0, 'misses': 0}
+_prepare_lock = threading.Lock()
+
+def configure_connection(conn):
+    """Dump every Python int as int8 so a statement keeps one parameter
+    signature (psycopg otherwise picks int2/int4/int8 by value, and each
+    signature is a separate prepared statement)
+    """
+    conn.adapters.register_dumper(int, Int8Dumper)
+    conn.adapters.register_dumper(int, Int8BinaryDumper)
+
+def _check_connection(conn):
+    """Health check run on every checkout; a broken connection is discarded"""
+    conn.autocommit = True
     try:
-        cursor.execute(query, params)
-        
-        if fetch_one:
-            result = cursor.fetchone()
-        elif fetch_all:
-            result = cursor.fetchall()
+        conn.execute("SELECT 1")
+    finally:
+        conn.autocommit = False
+
+def get_pool():
+    """Get the process-wide connection pool, opening it on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    kwargs={
+                        'host': DB_CONFIG['host'],
+                        'port': DB_CONFIG['port'],
+                        'dbname': DB_CONFIG['database'],
+                        'user': DB_CONFIG['user'],
+                        'password': DB_CONFIG['password']
+                    },
+                    min_size=DB_POOL_CONFIG['min_size'],
+                    max_size=DB_POOL_CONFIG['max_size'],
+                    max_idle=DB_POOL_CONFIG['max_idle'],
+                    timeout=DB_POOL_CONFIG['timeout'],
+                    configure=configure_connection,
+                    check=_check_connection,
+                    name='chat_pool',
+                    open=True
+                )
+                atexit.register(close_pool)
+    return _pool
+
+def close_pool():
+    """Close the connection pool (e.g. on shutdown)"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+def get_pool_stats():
+    """Get connection pool usage: size, in use, waiting and checkout wait time"""
+    stats = get_pool().get_stats()
+    requests_num = stats.get('requests_num', 0)
+    wait_ms = stats.get('requests_wait_ms', 0)
+    return {
+        'min_size': stats.get('pool_min', 0),
+        'max_size': stats.get('pool_max', 0),
+        'size': stats.get('pool_size', 0),
+        'available': stats.get('pool_available', 0),
+        'in_use': stats.get('pool_size', 0) - stats.get('pool_available', 0),
+        'waiting': stats.get('requests_waiting', 0),
+        'checkouts': requests_num,
+        'checkout_errors': stats.get('requests_errors', 0),
+        'checkout_wait_ms_total': wait_ms,
+        'checkout_wait_ms_avg': round(wait_ms / requests_num, 3) if requests_num else 0,
+        'connections_lost': stats.get('connections_lost', 0)
+    }
+
+# ============ PREPARED STATEMENTS ============
+
+def prepare_flag(conn, query, prepare):
+    """Get the psycopg prepare= argument for a statement and count hits/misses
+
+    Hot statements (prepare=True) are kept as named server-side prepared
+    statements on each pooled connection, so they are parsed and planned once
+    per connection instead of once per call. Other statements keep psycopg's
+    default (auto-prepare after a few executions).
+    """
+    if not prepare or not DB_PREPARED_STATEMENTS:
+        return None
+    with _prepare_lock:
+        seen = _prepared.setdefault(conn, set())
+        if query in seen:
+            _prepare_stats['hits'] += 1
         else:
-            result = None
-            
+            _prepare_stats['misses'] += 1
+            seen.add(query)
+    return True
+
+def get_prepare_stats():
+    """Get prepared statement reuse: hits, misses and hit rate"""
+    with _prepare_lock:
+        hits = _prepare_stats['hits']
+        misses = _prepare_stats['misses']
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / total, 4) if total else 0
+    }
+
+# ============ REQUEST-SCOPED UNIT OF WORK ============
+
+def init_app(app):
+    """Give every HTTP request one connection and one transaction"""
+    app.after_request(_finish_request_transaction)
+    app.teardown_request(_release_request_connection)
+
+def read_only(f):
+    """Decorator for routes that never write: the request transaction is not committed"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.db_read_only = True
+        return f(*args, **kwargs)
+    return decorated_function
+
+def _get_request_connection():
+    """Get the connection bound to the current request, checking one out on first use"""
+    conn = g.get('db_conn')
+    if conn is None:
+        conn = get_pool().getconn()
+        g.db_conn = conn
+    return conn
+
+def on_commit(callback):
+    """Run callback() once the request transaction has committed (dropped on rollback)
+    Outside a request the work is already committed, so it runs immediately
+    """
+    if has_request_context():
+        g.setdefault('db_on_commit', []).append(callback)
+    else:
+        callback()
+
+def _finish_request_transaction(response):
+    """Commit the request transaction once; roll back error responses and read-only routes"""
+    conn = g.get('db_conn')
+    callbacks = g.pop('db_on_commit', [])
+    if g.get('db_read_only') or response.status_code >= 400:
+        if conn is not None:
+            conn.rollback()
+        return response
+    if conn is not None:
         conn.commit()
-        return result
-    except Exception as e:
-        conn.rollback()
-        raise e
-    finally:
-        cursor.close()
-        conn.close()
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception:
+            # already committed: an error response would make the client retry
+            # (and e.g. send its message twice), so a failed callback is only logged
+            logger.exception('on_commit callback %r failed', callback)
+    return response
 
-def execute_insert(query, params=None):
-    """Execute insert and return the inserted id"""
-    conn = get_connection()
-    cursor = conn.cursor(row_factory=dict_row)
-    
+def _release_request_connection(exc=None):
+    """Return the request connection to the pool, rolling back anything left open"""
+    conn = g.pop('db_conn', None)
+    if conn is None:
+        return
     try:
-        cursor.execute(query + " RETURNING id", params)
-        result = cursor.fetchone()
-        conn.commit()
-        return result['id'] if result else None
-    except Exception as e:
-        conn.rollback()
-        raise e
+        if conn.info.transaction_status != TransactionStatus.IDLE:
+            conn.rollback()
+    except psycopg.Error:
+        pass  # broken connection: the pool discards it on return
     finally:
-        cursor.close()
-        conn.close()
+        get_pool().putconn(conn)
+
+@contextmanager
+def get_connection():
+    """Get a connection for the current unit of work
+
+    Inside a request this is the request-scoped connection and the commit is
+    deferred to the end of the request. Outside a request (scripts, background
+    threads) a connection is borrowed from the pool and committed on exit.
+    """
+    if has_request_context():
+        yield _get_request_connection()
+    else:
+        with get_pool().connection() as conn:
+            yield conn
+
+def execute_query(query, params=None, fetch_one=False, fetch_all=False, prepare=False):
+    """Execute a query and optionally fetch results (prepare=True for hot statements)"""
+    with get_connection() as conn:
+        with conn.cursor(row_factory=dict_row) as cursor:
+            cursor.execute(query, params, prepare=prepare_flag(conn, query, prepare))
+
+            if fetch_one:
+                return cursor.fetchone()
+            elif fetch_all:
+                return cursor.fetchall()
+            return None
+
+def execute_detached(query, params=None, fetch_one=False, fetch_all=False):
+    """Execute one statement in its own short transaction, outside the unit of
+    work of the current request (committed at once, e.g. reserving an id block)
+    """
+    with get_pool().connection() as conn:
+        with conn.cursor(row_factory=dict_row) as cursor:
+            cursor.execute(query, params)
+            if fetch_one:
+                return cursor.fetchone()
+            if fetch_all:
+                return cursor.fetchall()
+            return None
+
+def execute_insert(query, params=None, prepare=False):
+    """Execute insert and return the inserted id"""
+    with get_connection() as conn:
+        with conn.cursor(row_factory=dict_row) as cursor:
+            query = query + " RETURNING id"
+            cursor.execute(query, params, prepare=prepare_flag(conn, query, prepare))
+            result = cursor.fetchone()
+            return result['id'] if result else None
+
+def execute_batch(statements, prepare=False):
+    """Execute several independent statements with a single network flush
+
+    statements: list of (query, params, fetch) tuples where fetch is 'one',
+    'all' or None. Statements are sent back-to-back in psycopg pipeline mode
+    and the results are returned in the same order once the pipeline syncs.
+    Falls back to sequential execution when pipelining is unavailable.
+    prepare=True keeps every statement of the batch prepared on the connection.
+    """
+    with get_connection() as conn:
+        use_pipeline = DB_PIPELINE and psycopg.Pipeline.is_supported()
+        cursors = []
+        try:
+            with conn.pipeline() if use_pipeline else nullcontext():
+                for query, params, fetch in statements:
+                    cursor = conn.cursor(row_factory=dict_row)
+                    cursors.append(cursor)
+                    cursor.execute(query, params, prepare=prepare_flag(conn, query, prepare))
+
+            results = []
+            for cursor, (_, _, fetch) in zip(cursors, statements):
+                if fetch == 'one':
+                    results.append(cursor.fetchone())
+                elif fetch == 'all':
+                    results.append(cursor.fetchall())
+                else:
+                    results.append(None)
+            return results
+        finally:
+            for cursor in cursors:
+                cursor.close()
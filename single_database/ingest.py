@@ -0,0 +1,366 @@
+# Write-behind message ingestion (INGEST_QUEUE, one queue per worker process)
+# An accepted message goes into a bounded queue instead of being inserted by
+# the request; a flusher writes the queue in batches of up to
+# INGEST_BATCH_ROWS rows, waiting at most INGEST_FLUSH_MS for a batch to
+# fill, so the write cost grows with batches, not messages. Ids are given
+# when a batch is written (the SERIAL default), so they follow commit order
+# like every other insert; until then a queued message is known by its room,
+# sender and accept time. A full queue rejects new messages (the API answers
+# 429). A batch that fails because the database is unreachable is retried
+# with backoff; any other error is retried row by row, and a row that still
+# fails goes to the dead-letter file, so one bad row never stops the flusher.
+# Every accepted message is first appended to this worker's spill files in
+# INGEST_SPILL_DIR and fsynced before it is acknowledged (group commit: one
+# fsync, outside the queue lock, covers every message appended before it), segments of up to INGEST_BATCH_ROWS messages,
+# each deleted once all of its messages are written, so the spill files only hold
+# messages that may not be in the database yet. A worker holds a lock on its
+# files while it runs; the next worker to start replays the files of a
+# worker that died (inserts skip messages that are already there)
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+import psycopg
+from config import INGEST_QUEUE, INGEST_QUEUE_SIZE, INGEST_BATCH_ROWS, INGEST_FLUSH_MS, INGEST_SPILL_DIR
+
+logger = logging.getLogger(__name__)
+
+DEAD_LETTER_FILE = 'dead-letter.jsonl'
+
+_queue = deque()
+_lock = threading.Lock()
+_ready = threading.Condition(_lock)  # notified when a message is queued
+_handlers = []
+_flusher = None
+_flusher_lock = threading.Lock()
+_segments = deque()  # [path, messages, done] per spill segment, in queue order
+_spill = None  # open spill segment file, appended to until it is full
+_spill_segment = None  # its entry in _segments
+_spill_count = 0  # spill segments opened by this worker
+_spill_prefix = None  # INGEST_SPILL_DIR/ingest-<pid>-<start time>
+_spill_lock_file = None  # held (flock) for the life of the worker
+_spilled = 0  # messages appended to spill files so far
+_synced = 0  # of those, the ones known to be on disk
+_unsynced = []  # spill files closed since the last fsync
+_new_names = False  # segments created since the last fsync of INGEST_SPILL_DIR
+_sync_lock = threading.Lock()  # one group fsync at a time
+_dead_letter_lock = threading.Lock()
+_stats = {'accepted': 0, 'rejected': 0, 'written': 0, 'batches': 0, 'write_errors': 0, 'recovered': 0, 'dead_lettered': 0}
+
+# ============ SPILL FILE ============
+
+def encode_message(message):
+    """One spill file line"""
+    return json.dumps({**message, 'created_at': message['created_at'].isoformat()})
+
+def decode_message(line):
+    """Message from a spill file line"""
+    message = json.loads(line)
+    message['created_at'] = datetime.fromisoformat(message['created_at'])
+    return message
+
+def message_key(message):
+    """What tells queued messages apart before they have an id"""
+    return (message['room_id'], message['sender_id'], message['created_at'])
+
+def _sync(file):
+    """Flush a file to disk"""
+    file.flush()
+    os.fsync(file.fileno())
+
+def _sync_dir():
+    """Flush the spill directory to disk (a new file name survives a crash of the host)"""
+    fd = os.open(INGEST_SPILL_DIR, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _lock_spill():
+    """This worker's spill file prefix, locking its name first (lock held)"""
+    global _spill_prefix, _spill_lock_file
+    if _spill_prefix is None:
+        os.makedirs(INGEST_SPILL_DIR, exist_ok=True)
+        prefix = os.path.join(INGEST_SPILL_DIR, f'ingest-{os.getpid()}-{time.time_ns()}')
+        _spill_lock_file = open(prefix + '.lock', 'w')
+        fcntl.flock(_spill_lock_file, fcntl.LOCK_EX)
+        _spill_prefix = prefix
+    return _spill_prefix
+
+def _new_segment():
+    """Open this worker's next spill segment; returns (file, segment) (lock held)"""
+    global _spill_count, _new_names
+    _spill_count += 1
+    _new_names = True
+    path = f'{_lock_spill()}.{_spill_count:08d}.jsonl'
+    return open(path, 'a'), [path, 0, 0]
+
+def _close_spill():
+    """Stop appending to the spill segment; the next message opens a new one
+    and the next group fsync closes it (lock held)
+    """
+    global _spill, _spill_segment
+    _spill.flush()
+    _unsynced.append(_spill)
+    _spill = _spill_segment = None
+
+def _spill_messages(messages):
+    """Append messages to the spill segments (lock held); returns the ticket
+    to pass to _sync_spill, after which they survive a crash of this worker
+    or of its host
+    """
+    global _spill, _spill_segment, _spilled
+    if not INGEST_SPILL_DIR:
+        return 0
+    for message in messages:
+        if _spill is None:
+            _spill, _spill_segment = _new_segment()
+            _segments.append(_spill_segment)
+        _spill.write(encode_message(message) + '\n')
+        _spill_segment[1] += 1
+        _spilled += 1
+        if _spill_segment[1] >= INGEST_BATCH_ROWS:
+            _close_spill()
+    if _spill is not None:
+        _spill.flush()
+    return _spilled
+
+def _sync_spill(ticket):
+    """Wait until the messages spilled up to `ticket` are on disk (lock not held)
+    Group commit: one fsync of the spill files (and of the directory, for
+    new segment names) covers every message appended before it started, so
+    the senders waiting behind it are released together
+    """
+    global _unsynced, _new_names, _synced
+    if _synced >= ticket:
+        return
+    with _sync_lock:
+        if _synced >= ticket:
+            return
+        with _lock:
+            target = _spilled
+            closed, _unsynced = _unsynced, []
+            current = _spill
+            new_names, _new_names = _new_names, False
+        for spill in closed:
+            os.fsync(spill.fileno())
+            spill.close()
+        if current is not None:
+            os.fsync(current.fileno())
+        if new_names:
+            _sync_dir()
+        _synced = target
+
+def _spill_recovered(messages):
+    """Spill recovered messages to a segment of their own, ahead of the others
+    like the messages in the queue (lock held)
+    """
+    spill, segment = _new_segment()
+    with spill:
+        spill.writelines(encode_message(message) + '\n' for message in messages)
+        _sync(spill)
+    _sync_dir()
+    segment[1] = len(messages)
+    _segments.appendleft(segment)
+
+def _drop_spilled(count):
+    """Count the oldest `count` spilled messages as done, deleting every segment
+    whose messages are all done (the open one too: the next message opens a
+    new one) (lock held)
+    """
+    while count and _segments:
+        segment = _segments[0]
+        done = min(count, segment[1] - segment[2])
+        segment[2] += done
+        count -= done
+        if segment[2] < segment[1]:
+            break
+        if segment is _spill_segment:
+            _close_spill()
+        _segments.popleft()
+        os.remove(segment[0])
+
+def _read_spill(path):
+    """Messages of one spill file; a torn last line (crash while writing) is skipped"""
+    messages = []
+    with open(path) as spill:
+        for line in spill:
+            try:
+                messages.append(decode_message(line))
+            except ValueError:
+                logger.warning('Skipping unreadable line in %s', path)
+    return messages
+
+def recover():
+    """Queue the messages in spill files of workers that are no longer running
+    (before this worker's flusher runs: the spill segments count batches in
+    queue order)
+    """
+    if not INGEST_SPILL_DIR:
+        return 0
+    os.makedirs(INGEST_SPILL_DIR, exist_ok=True)
+    recovered = 0
+    for lock_path in glob.glob(os.path.join(INGEST_SPILL_DIR, 'ingest-*.lock')):
+        prefix = lock_path[:-len('.lock')]
+        if prefix == _spill_prefix:
+            continue
+        with open(lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue  # its worker is alive
+            # Files of workers from before spill segments first, then the segments in order
+            paths = [path for path in (prefix + '.flushing.jsonl', prefix + '.jsonl') if os.path.exists(path)]
+            paths += sorted(glob.glob(glob.escape(prefix) + '.[0-9]*.jsonl'))
+            messages = list({message_key(message): message for path in paths for message in _read_spill(path)}.values())
+            with _lock:
+                # Into this worker's spill files before the old files go
+                if messages:
+                    _spill_recovered(messages)
+                _queue.extendleft(reversed(messages))
+                _stats['recovered'] += len(messages)
+            for path in paths + [lock_path]:
+                os.remove(path)
+            recovered += len(messages)
+            logger.info('Recovered %s spilled messages from %s', len(messages), prefix)
+    return recovered
+
+def dead_letter(message, error):
+    """Keep a message that cannot be written in INGEST_SPILL_DIR/dead-letter.jsonl
+    (fsynced, with the error) for an operator to look at
+    """
+    logger.error('Dead-lettering a queued message for room %s: %s', message['room_id'], error)
+    with _lock:
+        _stats['dead_lettered'] += 1
+    if INGEST_SPILL_DIR:
+        os.makedirs(INGEST_SPILL_DIR, exist_ok=True)
+        with _dead_letter_lock, open(os.path.join(INGEST_SPILL_DIR, DEAD_LETTER_FILE), 'a') as dead:
+            dead.write(encode_message({**message, 'error': str(error)}) + '\n')
+            _sync(dead)
+
+# ============ QUEUE ============
+
+def enqueue(message):
+    """Queue an accepted message, returning once it is spilled to disk; False
+    if the queue is full
+    """
+    with _lock:
+        if len(_queue) >= INGEST_QUEUE_SIZE:
+            _stats['rejected'] += 1
+            return False
+        ticket = _spill_messages([message])
+        _queue.append(message)
+        _stats['accepted'] += 1
+        _ready.notify()
+    _sync_spill(ticket)
+    return True
+
+def queued():
+    """Number of messages waiting for the flusher"""
+    return len(_queue)
+
+def take_batch():
+    """Take up to INGEST_BATCH_ROWS queued messages for one write"""
+    with _lock:
+        return [_queue.popleft() for _ in range(min(len(_queue), INGEST_BATCH_ROWS))]
+
+def batch_done(batch, written):
+    """Forget a finished batch (`written` of it inserted, the rest already in the
+    database or dead-lettered): delete the spill segments it completes
+    """
+    with _lock:
+        _drop_spilled(len(batch))
+        _stats['written'] += len(written)
+        _stats['batches'] += 1
+
+def count_write_error():
+    """Count one failed write (the flusher retries it)"""
+    with _lock:
+        _stats['write_errors'] += 1
+
+# ============ FLUSHER ============
+
+def submit(message):
+    """Accept a message for the flusher; False if the queue is full"""
+    return enqueue(message)
+
+def add_handler(handler):
+    """Register handler(messages); runs in the flusher thread after each batch
+    is written, with the messages written (ids set)
+    """
+    _handlers.append(handler)
+
+def _write_retrying(messages, write):
+    """write(messages), retried with backoff for as long as the database is
+    unreachable (the queue fills meanwhile); other errors are raised
+    """
+    delay = 0.1
+    while True:
+        try:
+            return write(messages)
+        except psycopg.OperationalError:
+            count_write_error()
+            logger.exception('Writing %s queued messages failed, retrying in %ss', len(messages), delay)
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+def _write(batch, write):
+    """Write one batch; if it fails for another reason than a lost database, write
+    it row by row and dead-letter the rows that fail again
+    """
+    try:
+        written = _write_retrying(batch, write)
+    except Exception:
+        count_write_error()
+        logger.exception('Writing %s queued messages failed, writing them one by one', len(batch))
+        written = []
+        for message in batch:
+            try:
+                written += _write_retrying([message], write)
+            except Exception as e:
+                dead_letter(message, e)
+    batch_done(batch, written)
+    for handler in list(_handlers):
+        try:
+            handler(written)
+        except Exception:
+            logger.exception('Ingest handler %r failed', handler)
+
+def _flush_forever(write):
+    """Flusher loop: wait for a full batch or INGEST_FLUSH_MS, then write"""
+    while True:
+        with _ready:
+            _ready.wait_for(lambda: _queue)
+            _ready.wait_for(lambda: len(_queue) >= INGEST_BATCH_ROWS, timeout=INGEST_FLUSH_MS / 1000)
+        _write(take_batch(), write)
+
+def start_flusher(write):
+    """Replay dead workers' spill files and start this worker's flusher thread
+    (once per process); write(messages) inserts one batch and returns the
+    messages it wrote
+    """
+    global _flusher
+    with _flusher_lock:
+        if _flusher is None or not _flusher.is_alive():
+            recover()
+            _flusher = threading.Thread(target=_flush_forever, args=(write,), name='ingest-flusher', daemon=True)
+            _flusher.start()
+
+def get_ingest_stats():
+    """Get queue state: enabled, queued now, accepted, rejected (429), written,
+    batches and dead-lettered
+    """
+    with _lock:
+        return {
+            'enabled': INGEST_QUEUE,
+            'queued': len(_queue),
+            'queue_size': INGEST_QUEUE_SIZE,
+            'spill': bool(INGEST_SPILL_DIR),
+            'spill_segments': len(_segments),
+            **_stats
+        }
@@ -1,79 +1,145 @@
 # User functions (Functional style - no OOP)
-from db import execute_query, execute_insert
-import random
-import string
-
-# ============ HELPER FUNCTIONS ============
-
-def generate_codename():
-    """Generate a random 8-character codename"""
-    chars = string.ascii_uppercase + string.digits
-    return ''.join(random.choices(chars, k=8))
+from db import execute_query, execute_insert, execute_batch, execute_detached, on_commit
+from config import DB_NOTIFY, NOTIFY_CHANNEL, ROOM_BUFFER_SIZE, CODENAME_LEGACY_LOOKUP
+from singleflight import coalesced
+from codename import encode_codename, decode_codename
+import cache
+import shared_cache
+import idgen
+import ingest
+from datetime import datetime
 
 # ============ USER FUNCTIONS ============
 
+# A taken username inserts nothing (no separate username_exists check, no race)
+CREATE_USER_SQL = "INSERT INTO users (username) VALUES (%s) ON CONFLICT (username) DO NOTHING"
+
 def create_user(username):
-    """Create a new user"""
-    query = "INSERT INTO users (username) VALUES (%s)"
-    return execute_insert(query, (username,))
+    """Create a new user; returns None if the username is taken"""
+    return execute_insert(CREATE_USER_SQL, (username,))
+
+USER_BY_ID_SQL = "SELECT * FROM users WHERE id = %s"
+
+USERS_BY_IDS_SQL = "SELECT * FROM users WHERE id = ANY(%s)"
+
+def get_users_by_ids(user_ids):
+    """Get {user_id: user row, or None if deleted} for many users in at most one query
+    Only the ids missing from the user directory cache are fetched, from the
+    shared cache first, then from the database
+    """
+    users, missing = cache.get_cached_users(user_ids)
+    if missing:
+        shared = shared_cache.get_many(users=missing)[0]
+        users.update(restore_users(shared))
+        missing = [user_id for user_id in missing if user_id not in shared]
+    if missing:
+        rows = execute_query(USERS_BY_IDS_SQL, (missing,), fetch_all=True, prepare=True)
+        fetched = cache.set_users(rows, missing)
+        shared_cache.set_users(fetched)
+        users.update(fetched)
+    return users
+
+def restore_users(shared):
+    """Put users read from the shared cache in the user directory cache"""
+    return cache.set_users([user for user in shared.values() if user], shared)
 
 def get_user_by_id(user_id):
-    """Get user by ID"""
-    query = "SELECT * FROM users WHERE id = %s"
-    return execute_query(query, (user_id,), fetch_one=True)
+    """Get user by ID (user directory cache)"""
+    return get_users_by_ids([user_id])[user_id]
+
+USER_BY_USERNAME_SQL = "SELECT * FROM users WHERE username = %s"
 
 def get_user_by_username(username):
     """Get user by username"""
-    query = "SELECT * FROM users WHERE username = %s"
-    return execute_query(query, (username,), fetch_one=True)
+    return execute_query(USER_BY_USERNAME_SQL, (username,), fetch_one=True)
 
 def username_exists(username):
     """Check if username already exists"""
     user = get_user_by_username(username)
     return user is not None
 
+DELETE_USER_SQL = "DELETE FROM users WHERE id = %s"
+
 def delete_user(user_id):
     """Delete a user"""
-    query = "DELETE FROM users WHERE id = %s"
-    execute_query(query, (user_id,))
+    rooms = execute_query(MEMBER_ROOM_IDS_SQL, (user_id,), fetch_all=True) if shared_cache.enabled() else []
+    execute_query(DELETE_USER_SQL, (user_id,))
+    forget_member_rooms(user_id)
+    cache.invalidate_user(user_id)
+    on_commit(lambda: cache.set_users([], [user_id]))  # remember it as deleted
+    on_commit(cache.clear_room_buffers)  # their messages were deleted with them
+    on_commit(lambda: shared_cache.drop_member_rooms(user_id, deleted_user_commands(user_id, rooms)))
+
+def deleted_user_commands(user_id, rooms):
+    """Shared cache writes after deleting a user: a negative entry, and the
+    recent messages of their rooms dropped (rooms they had left keep them until the TTL)
+    """
+    return [
+        *shared_cache.set_users_commands({user_id: None}),
+        ('delete', shared_cache.member_rooms_key(user_id)),
+        *(command for row in rooms or [] for command in shared_cache.delete_recent_messages_commands(row['room_id']))
+    ]
 
 # ============ ROOM FUNCTIONS ============
 
+CREATE_ROOM_SQL = "INSERT INTO rooms (id, codename, type) VALUES (%s, %s, %s)"
+
 def create_room(room_type, creator_id):
-    """Create a new room and add creator as member"""
-    # Generate unique codename
-    codename = generate_codename()
-    while get_room_by_codename(codename):  # Ensure unique
-        codename = generate_codename()
-    
-    # Create room with codename
-    query = "INSERT INTO rooms (codename, type) VALUES (%s, %s)"
-    room_id = execute_insert(query, (codename, room_type))
-    
-    # Add creator as member
-    add_room_member(room_id, creator_id)
-    
+    """Create a new room and add creator as member, in one round trip
+    The id is handed out in process by idgen.py (hi/lo: now and then a block
+    of ID_BLOCK_SIZE ids is reserved from id_blocks in a short transaction of
+    its own, execute_detached, never in this one) and the codename is derived
+    from it, so there is nothing to look up and nothing that can collide
+    """
+    room_id = idgen.next_id('rooms')
+    codename = encode_codename(room_id)
+    execute_batch([
+        (CREATE_ROOM_SQL, (room_id, codename, room_type), None),
+        (ADD_ROOM_MEMBER_SQL, (room_id, creator_id, 1 if room_type == 'dm' else None), None)
+    ], prepare=True)
+    forget_member_rooms(creator_id)
+    on_commit(lambda: shared_cache.add_member_room(creator_id, room_id))
     return room_id, codename
 
+ROOM_BY_ID_SQL = "SELECT * FROM rooms WHERE id = %s"
+
+@coalesced
 def get_room_by_id(room_id):
-    """Get room by ID"""
-    query = "SELECT * FROM rooms WHERE id = %s"
-    return execute_query(query, (room_id,), fetch_one=True)
+    """Get room by ID (shared cache first: rooms never change)"""
+    room = shared_cache.get_many(rooms=[room_id])[1].get(room_id)
+    if room is None:
+        room = execute_query(ROOM_BY_ID_SQL, (room_id,), fetch_one=True)
+        shared_cache.set_room(room)
+    return room
+
+ROOM_BY_CODENAME_SQL = "SELECT * FROM rooms WHERE codename = %s"
 
 def get_room_by_codename(codename):
-    """Get room by codename"""
-    query = "SELECT * FROM rooms WHERE codename = %s"
-    return execute_query(query, (codename.upper(),), fetch_one=True)
+    """Get room by codename: decoded to its room id and read by primary key
+    (cached); rooms created before derived codenames are looked up by codename
+    """
+    codename = codename.upper()
+    room_id = decode_codename(codename)
+    if room_id is not None:
+        room = get_room_by_id(room_id)
+        if room and room['codename'] == codename:
+            return room
+    if not CODENAME_LEGACY_LOOKUP:
+        return None
+    return execute_query(ROOM_BY_CODENAME_SQL, (codename,), fetch_one=True)
+
+ROOMS_BY_USER_SQL = """
+    SELECT r.* FROM rooms r
+    JOIN room_members rm ON r.id = rm.room_id
+    WHERE rm.user_id = %s
+    ORDER BY r.created_at DESC
+"""
 
 def get_rooms_by_user(user_id):
-    """Get all rooms for a user"""
-    query = """
-        SELECT r.* FROM rooms r
-        JOIN room_members rm ON r.id = rm.room_id
-        WHERE rm.user_id = %s
-        ORDER BY r.created_at DESC
-    """
-    return execute_query(query, (user_id,), fetch_all=True)
+    """Get all rooms for a user (also refreshes the membership cache)"""
+    rooms = execute_query(ROOMS_BY_USER_SQL, (user_id,), fetch_all=True)
+    shared_cache.set_member_rooms(user_id, cache.set_member_rooms(user_id, (room['id'] for room in rooms or [])))
+    return rooms
 
 def room_exists(room_id):
     """Check if room exists"""
@@ -82,62 +148,540 @@ def room_exists(room_id):
 
 # ============ ROOM MEMBER FUNCTIONS ============
 
-def add_room_member(room_id, user_id):
-    """Add user to room"""
-    query = "INSERT INTO room_members (room_id, user_id) VALUES (%s, %s) ON CONFLICT DO NOTHING"
-    execute_query(query, (room_id, user_id))
+ADD_ROOM_MEMBER_SQL = "INSERT INTO room_members (room_id, user_id, slot) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING"
+
+# Joining by codename in one statement: the room lookup (by the id the
+# codename decodes to, a primary key read; the codename must match), the
+# membership check, the DM limit and the insert. A DM member takes a free slot (1 or 2) and
+# UNIQUE (room_id, slot) turns a concurrent join into a conflict, so two users
+# can never both become the second member. status says which rule applied:
+# 'joined', 'member' (already a member) or 'full' (DM room); no row: no such room
+JOIN_ROOM_SQL = """
+    WITH room AS (
+        SELECT * FROM rooms WHERE id = %s AND codename = %s
+    ), member AS (
+        SELECT rm.room_id FROM room_members rm, room
+        WHERE rm.room_id = room.id AND rm.user_id = %s
+    ), free_slot AS (
+        SELECT MIN(s.slot) AS slot FROM room, (VALUES (1), (2)) AS s(slot)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM room_members rm WHERE rm.room_id = room.id AND rm.slot = s.slot
+        )
+    ), joined AS (
+        INSERT INTO room_members (room_id, user_id, slot)
+        SELECT room.id, %s, CASE WHEN room.type = 'dm' THEN free_slot.slot END
+        FROM room, free_slot
+        WHERE NOT EXISTS (SELECT 1 FROM member)
+          AND (room.type <> 'dm' OR free_slot.slot IS NOT NULL)
+        ON CONFLICT DO NOTHING
+        RETURNING room_id
+    )
+    SELECT room.*, CASE
+        WHEN EXISTS (SELECT 1 FROM joined) THEN 'joined'
+        WHEN room.type = 'dm' AND NOT EXISTS (SELECT 1 FROM member) THEN 'full'
+        ELSE 'member'
+    END AS status
+    FROM room
+"""
+
+# Same join for rooms whose codename does not decode to their id (made before
+# codename.py): the room is found by the codename column (CODENAME_LEGACY_LOOKUP)
+JOIN_LEGACY_ROOM_SQL = JOIN_ROOM_SQL.replace('WHERE id = %s AND codename = %s', 'WHERE codename = %s')
+
+def join_room_statements(codename, user_id):
+    """The (query, params) of a join to try in turn until one finds the room:
+    by the id the codename decodes to, then by the codename column for rooms
+    made before codename.py (only with CODENAME_LEGACY_LOOKUP)
+    """
+    codename = codename.upper()
+    room_id = decode_codename(codename)
+    statements = []
+    if room_id is not None:
+        statements.append((JOIN_ROOM_SQL, (room_id, codename, user_id, user_id)))
+    if CODENAME_LEGACY_LOOKUP:
+        statements.append((JOIN_LEGACY_ROOM_SQL, (codename, user_id, user_id)))
+    return statements
+
+def join_room(codename, user_id):
+    """Join a room by codename; returns the room row with its status, or None
+    if there is no such room
+    """
+    room = None
+    for query, params in join_room_statements(codename, user_id):
+        room = execute_query(query, params, fetch_one=True, prepare=True)
+        if room:
+            break
+    if room and room['status'] == 'joined':
+        forget_member_rooms(user_id)
+        on_commit(lambda: shared_cache.add_member_room(user_id, room['id']))
+    return room
+
+REMOVE_ROOM_MEMBER_SQL = "DELETE FROM room_members WHERE room_id = %s AND user_id = %s RETURNING room_id"
 
 def remove_room_member(room_id, user_id):
-    """Remove user from room"""
-    query = "DELETE FROM room_members WHERE room_id = %s AND user_id = %s"
-    execute_query(query, (room_id, user_id))
+    """Remove user from room; returns False if they were not a member"""
+    if not execute_query(REMOVE_ROOM_MEMBER_SQL, (room_id, user_id), fetch_one=True):
+        return False
+    forget_member_rooms(user_id)
+    on_commit(lambda: shared_cache.remove_member_room(user_id, room_id))
+    return True
+
+MEMBER_ROOM_IDS_SQL = "SELECT room_id FROM room_members WHERE user_id = %s"
+
+def forget_member_rooms(user_id):
+    """Drop a user's cached rooms now and again once the change commits
+    (a concurrent request could re-cache the old rooms in between)
+    """
+    cache.invalidate_member(user_id)
+    on_commit(lambda: cache.invalidate_member(user_id))
+
+def remember_member_rooms(user_id, rows):
+    """Cache a user's room ids from MEMBER_ROOM_IDS_SQL rows; returns the set
+    (callers also write it to the shared cache)
+    """
+    return cache.set_member_rooms(user_id, (row['room_id'] for row in rows or []))
+
+def restore_member_rooms(user_id, room_id, shared):
+    """Check membership in room ids read from the shared cache, keeping them
+    in the membership cache when they contain the room
+    """
+    if room_id not in shared.get(user_id, ()):
+        return False
+    cache.set_member_rooms(user_id, shared[user_id])
+    return True
 
 def is_room_member(room_id, user_id):
-    """Check if user is member of room"""
-    query = "SELECT 1 FROM room_members WHERE room_id = %s AND user_id = %s"
-    result = execute_query(query, (room_id, user_id), fetch_one=True)
-    return result is not None
+    """Check if user is member of room (no query when the membership cache
+    or the shared cache says yes)
+    """
+    if cache.check_membership(user_id, room_id):
+        return True
+    if restore_member_rooms(user_id, room_id, shared_cache.get_many(member_rooms=[user_id])[2]):
+        return True
+    rows = execute_query(MEMBER_ROOM_IDS_SQL, (user_id,), fetch_all=True, prepare=True)
+    room_ids = remember_member_rooms(user_id, rows)
+    shared_cache.set_member_rooms(user_id, room_ids)
+    return room_id in room_ids
+
+def has_member(members, user_id):
+    """Check if user_id is in a ROOM_MEMBERS_SQL result"""
+    return any(member['id'] == user_id for member in members or [])
+
+ROOM_MEMBERS_SQL = """
+    SELECT u.* FROM users u
+    JOIN room_members rm ON u.id = rm.user_id
+    WHERE rm.room_id = %s
+"""
 
+@coalesced
 def get_room_members(room_id):
     """Get all members of a room"""
-    query = """
-        SELECT u.* FROM users u
-        JOIN room_members rm ON u.id = rm.user_id
-        WHERE rm.room_id = %s
-    """
-    return execute_query(query, (room_id,), fetch_all=True)
+    return execute_query(ROOM_MEMBERS_SQL, (room_id,), fetch_all=True, prepare=True)
+
+ROOM_MEMBER_COUNT_SQL = "SELECT COUNT(*) as count FROM room_members WHERE room_id = %s"
 
 def get_room_member_count(room_id):
     """Get member count of a room"""
-    query = "SELECT COUNT(*) as count FROM room_members WHERE room_id = %s"
-    result = execute_query(query, (room_id,), fetch_one=True)
+    result = execute_query(ROOM_MEMBER_COUNT_SQL, (room_id,), fetch_one=True)
     return result['count'] if result else 0
 
 # ============ MESSAGE FUNCTIONS ============
 
-def create_message(room_id, sender_id, content):
-    """Create a new message"""
-    query = "INSERT INTO messages (room_id, sender_id, content) VALUES (%s, %s, %s)"
-    return execute_insert(query, (room_id, sender_id, content))
+CREATE_MESSAGE_SQL = "INSERT INTO messages (room_id, sender_id, content) VALUES (%s, %s, %s) RETURNING *"
+
+# Same insert plus the NOTIFY for other workers, still one statement
+# (payload matches notify.format_payload; Postgres delivers it on commit)
+CREATE_MESSAGE_NOTIFY_SQL = """
+    WITH m AS (
+        INSERT INTO messages (room_id, sender_id, content) VALUES (%s, %s, %s) RETURNING *
+    )
+    SELECT m.* FROM m, pg_notify(%s, m.room_id || ':' || m.id)
+"""
+
+def create_message_statement(room_id, sender_id, content):
+    """Get the (query, params) that inserts a message and returns the row"""
+    if DB_NOTIFY:
+        return CREATE_MESSAGE_NOTIFY_SQL, (room_id, sender_id, content, NOTIFY_CHANNEL)
+    return CREATE_MESSAGE_SQL, (room_id, sender_id, content)
+
+def create_message(room_id, sender_id, content, sender_name):
+    """Create a new message and return the inserted row (sender_name from the caller)"""
+    query, params = create_message_statement(room_id, sender_id, content)
+    message = dict(execute_query(query, params, fetch_one=True, prepare=True))
+    message['sender_name'] = sender_name
+    on_commit(lambda: cache.append_room_message(room_id, message))
+    on_commit(lambda: shared_cache.append_recent_message(room_id, message))
+    return message
+
+# Batch send: one statement whatever the batch size (contents unnested into
+# rows, in order). Ids come from the SERIAL default as in create_message, so a
+# batch never holds ids reserved earlier that would land behind messages
+# other requests commit in the meantime
+CREATE_MESSAGES_SQL = """
+    INSERT INTO messages (room_id, sender_id, content)
+    SELECT %s, %s, batch.content
+    FROM unnest(%s::text[]) WITH ORDINALITY AS batch(content, position)
+    ORDER BY batch.position
+    RETURNING *
+"""
+
+CREATE_MESSAGES_NOTIFY_SQL = f"""
+    WITH m AS ({CREATE_MESSAGES_SQL})
+    SELECT m.* FROM m, pg_notify(%s, m.room_id || ':' || m.id)
+"""
+
+def create_messages_statement(room_id, sender_id, contents):
+    """Get the (query, params) that inserts several messages and returns the rows"""
+    if DB_NOTIFY:
+        return CREATE_MESSAGES_NOTIFY_SQL, (room_id, sender_id, list(contents), NOTIFY_CHANNEL)
+    return CREATE_MESSAGES_SQL, (room_id, sender_id, list(contents))
 
-def get_messages_by_room(room_id, limit=50):
-    """Get messages in a room"""
-    query = """
-        SELECT m.*, u.username as sender_name
-        FROM messages m
-        JOIN users u ON m.sender_id = u.id
-        WHERE m.room_id = %s
-        ORDER BY m.created_at ASC
-        LIMIT %s
+# Write-behind ingestion (INGEST_QUEUE, see ingest.py): one statement per batch
+# whatever its size (arrays unnested into rows, in queue order). Ids come from
+# the SERIAL default when the batch is written, so they follow commit order
+# like create_message's. A message already in the table (a batch retried
+# after an unknown outcome, or replayed from a spill file) is recognised by
+# its room, sender and accept time and skipped; RETURNING holds the rest
+INSERT_MESSAGES_SQL = """
+    INSERT INTO messages (room_id, sender_id, content, created_at)
+    SELECT batch.room_id, batch.sender_id, batch.content, batch.created_at
+    FROM unnest(%s::int[], %s::int[], %s::text[], %s::timestamp[])
+        WITH ORDINALITY AS batch(room_id, sender_id, content, created_at, position)
+    WHERE NOT EXISTS (
+        SELECT 1 FROM messages m
+        WHERE m.created_at = batch.created_at AND m.room_id = batch.room_id AND m.sender_id = batch.sender_id
+    )
+    ORDER BY batch.position
+    RETURNING *
+"""
+
+INSERT_MESSAGES_NOTIFY_SQL = f"""
+    WITH m AS ({INSERT_MESSAGES_SQL})
+    SELECT m.* FROM m, pg_notify(%s, m.room_id || ':' || m.id)
+"""
+
+MESSAGE_COLUMNS = ('room_id', 'sender_id', 'content', 'created_at')
+
+def insert_messages_statement(messages):
+    """Get the (query, params) that inserts a batch of queued messages and returns the rows written"""
+    columns = tuple([message[column] for message in messages] for column in MESSAGE_COLUMNS)
+    if DB_NOTIFY:
+        return INSERT_MESSAGES_NOTIFY_SQL, (*columns, NOTIFY_CHANNEL)
+    return INSERT_MESSAGES_SQL, columns
+
+def written_messages(messages, rows):
+    """The rows a batch of queued messages inserted, with sender_name, in id order"""
+    sender_names = {message['sender_id']: message['sender_name'] for message in messages}
+    return sorted(({**row, 'sender_name': sender_names[row['sender_id']]} for row in rows), key=lambda message: message['id'])
+
+def new_message(message_id, room_id, sender_id, content, sender_name):
+    """A message row built in process (inserted later by insert_messages_statement)"""
+    return {
+        'id': message_id,
+        'room_id': room_id,
+        'sender_id': sender_id,
+        'content': content,
+        'created_at': datetime.now(),
+        'sender_name': sender_name
+    }
+
+def create_messages(room_id, sender_id, contents, sender_name):
+    """Create several messages in a room with one statement; returns them in order"""
+    rows = execute_query(*create_messages_statement(room_id, sender_id, contents), fetch_all=True, prepare=True)
+    messages = sorted(({**row, 'sender_name': sender_name} for row in rows), key=lambda message: message['id'])
+    on_commit(lambda: remember_new_messages(messages))
+    return messages
+
+def queue_message(room_id, sender_id, content, sender_name):
+    """Accept a message for write-behind ingestion; returns it (no id until the
+    flusher writes it), or None if this worker's queue is full
+    """
+    message = new_message(None, room_id, sender_id, content, sender_name)
+    return message if ingest.submit(message) else None
+
+def write_messages(messages):
+    """Ingest flusher: insert one batch in its own transaction, then add it to
+    the room caches; returns the messages written, ids set
+    """
+    rows = execute_detached(*insert_messages_statement(messages), fetch_all=True)
+    messages = written_messages(messages, rows)
+    remember_new_messages(messages)
+    return messages
+
+def remember_new_messages(messages):
+    """Add committed messages to the room buffers and the shared cache (one pipeline)"""
+    commands = []
+    for message in messages:
+        cache.append_room_message(message['room_id'], message)
+        commands += shared_cache.append_recent_message_commands(message['room_id'], message)
+    shared_cache.write(commands)
+
+# Keyset pagination on the (room_id, id) index: every page is one index
+# range scan, whatever the size of the room history
+MESSAGES_LATEST_SQL = """
+    SELECT m.*, u.username as sender_name
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    WHERE m.room_id = %s
+    ORDER BY m.id DESC
+    LIMIT %s
+"""
+
+MESSAGES_BEFORE_SQL = """
+    SELECT m.*, u.username as sender_name
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    WHERE m.room_id = %s AND m.id < %s
+    ORDER BY m.id DESC
+    LIMIT %s
+"""
+
+MESSAGES_AFTER_SQL = """
+    SELECT m.*, u.username as sender_name
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    WHERE m.room_id = %s AND m.id > %s
+    ORDER BY m.id ASC
+    LIMIT %s
+"""
+
+def messages_page_statement(room_id, limit=50, before=None, after=None):
+    """Build the keyset query for one page of room history
+    Returns (query, params, newest_first)
+    """
+    if after is not None:
+        return MESSAGES_AFTER_SQL, (room_id, after, limit), False
+    if before is not None:
+        return MESSAGES_BEFORE_SQL, (room_id, before, limit), True
+    return MESSAGES_LATEST_SQL, (room_id, limit), True
+
+def chronological(messages, newest_first):
+    """Put a fetched page in display order (oldest first)"""
+    messages = messages or []
+    return messages[::-1] if newest_first else messages
+
+def messages_read_statement(room_id, limit=50, before=None, after=None):
+    """messages_page_statement for a page the room buffer could not answer
+    A latest-page or sync read of an unbuffered room fetches the whole buffer
+    window instead, so the buffer can be filled (a sync read only while the
+    buffers follow every message, see cache.follows_messages)
+    Returns (query, params, newest_first, fills)
+    """
+    if before is None and limit <= ROOM_BUFFER_SIZE and not cache.has_room_buffer(room_id) and (
+        after is None or cache.follows_messages()
+    ):
+        return (*messages_page_statement(room_id, ROOM_BUFFER_SIZE), True)
+    return (*messages_page_statement(room_id, limit, before, after), False)
+
+def messages_read_result(room_id, limit, before, after, messages, newest_first, fills):
+    """Turn the rows of messages_read_statement into the requested page (oldest first)
+    None if the page is still not covered (a sync cursor older than the buffer)
+    """
+    messages = chronological(messages, newest_first)
+    if not fills:
+        return messages
+    cache.set_room_buffer(room_id, messages, complete=len(messages) < ROOM_BUFFER_SIZE)
+    return cache.peek_room_page(room_id, limit, before, after)
+
+def restore_room_buffer(room_id, recent, limit, before=None, after=None):
+    """Buffer a room's recent messages read from the shared cache, (messages,
+    complete) as shared_cache.recent_messages_result gives them
+    Returns the requested page, or None if there were none or they do not cover it
     """
-    return execute_query(query, (room_id, limit), fetch_all=True)
+    if recent is None:
+        return None
+    messages, complete = recent
+    cache.set_room_buffer(room_id, messages, complete=complete)
+    return cache.peek_room_page(room_id, limit, before, after)
+
+def share_room_buffer_commands(room_id, fills):
+    """Shared cache writes after messages_read_result: a filled buffer is shared"""
+    buffer = cache.get_room_buffer(room_id) if fills else None
+    return shared_cache.set_recent_messages_commands(room_id, *buffer) if buffer is not None else []
+
+def get_buffered_page(room_id, limit, before=None, after=None):
+    """Answer a page from the room buffer, loading it from the shared cache on a miss"""
+    page = cache.get_room_page(room_id, limit, before, after)
+    if page is None and not cache.has_room_buffer(room_id):
+        recent = shared_cache.get_many(recent_messages=[room_id])[3]
+        page = restore_room_buffer(room_id, recent.get(room_id), limit, before, after)
+    return page
+
+def fetch_messages_page(room_id, limit=50, before=None, after=None):
+    """Read one page straight from the database (no buffer)"""
+    query, params, newest_first = messages_page_statement(room_id, limit, before, after)
+    return chronological(execute_query(query, params, fetch_all=True, prepare=True), newest_first)
+
+@coalesced
+def get_messages_by_room(room_id, limit=50, before=None, after=None):
+    """Get one page of messages in a room
+    - no cursor: the latest `limit` messages
+    - before=<message_id>: the `limit` messages just older than it
+    - after=<message_id>: the `limit` messages just newer than it
+    Pages walk back from the newest message; rows in a page are oldest first
+    Pages inside the room's recent-messages buffer need no query
+    """
+    page = get_buffered_page(room_id, limit, before, after)
+    if page is None:
+        query, params, newest_first, fills = messages_read_statement(room_id, limit, before, after)
+        messages = execute_query(query, params, fetch_all=True, prepare=True)
+        page = messages_read_result(room_id, limit, before, after, messages, newest_first, fills)
+        shared_cache.write(share_room_buffer_commands(room_id, fills))
+    if page is None:
+        page = fetch_messages_page(room_id, limit, before, after)
+    return page
+
+# Latest messages of many rooms in one statement (one index range scan per room)
+LATEST_BY_ROOMS_SQL = """
+    SELECT m.*, u.username as sender_name
+    FROM unnest(%s::int[]) AS r(room_id)
+    CROSS JOIN LATERAL (
+        SELECT * FROM messages WHERE room_id = r.room_id ORDER BY id DESC LIMIT %s
+    ) m
+    JOIN users u ON m.sender_id = u.id
+    ORDER BY m.room_id, m.id
+"""
+
+def get_latest_messages(room_ids, limit):
+    """Get {room_id: latest `limit` messages, oldest first} for many rooms
+    Room buffers answer first, then one shared cache multi-get, then one query
+    for the rooms still missing
+    """
+    latest = {}
+    for room_id in room_ids:
+        page = cache.get_room_page(room_id, limit)
+        if page is not None:
+            latest[room_id] = page
+    missing = [room_id for room_id in room_ids if room_id not in latest]
+    if missing:
+        recent = shared_cache.get_many(recent_messages=missing)[3]
+        for room_id in missing:
+            page = restore_room_buffer(room_id, recent.get(room_id), limit)
+            if page is not None:
+                latest[room_id] = page
+        missing = [room_id for room_id in missing if room_id not in latest]
+    if missing:
+        latest.update({room_id: [] for room_id in missing})
+        for message in execute_query(LATEST_BY_ROOMS_SQL, (missing, limit), fetch_all=True, prepare=True):
+            latest[message['room_id']].append(message)
+    return latest
+
+def get_latest_messages_for_member(room_ids, user_id, limit):
+    """get_latest_messages for the rooms in room_ids that user_id is a member of"""
+    return get_latest_messages([room_id for room_id in room_ids if is_room_member(room_id, user_id)], limit)
+
+MESSAGE_BY_ID_SQL = """
+    SELECT m.*, u.username as sender_name
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    WHERE m.id = %s
+"""
 
 def get_message_by_id(message_id):
     """Get message by ID"""
-    query = """
-        SELECT m.*, u.username as sender_name
-        FROM messages m
-        JOIN users u ON m.sender_id = u.id
-        WHERE m.id = %s
+    return execute_query(MESSAGE_BY_ID_SQL, (message_id,), fetch_one=True)
+
+# ============ BATCHED READS ============
+# Independent reads of one handler sent in a single pipeline flush
+
+def get_dashboard_context(user_id):
+    """Get user and their rooms in one round trip"""
+    user, rooms = execute_batch([
+        (USER_BY_ID_SQL, (user_id,), 'one'),
+        (ROOMS_BY_USER_SQL, (user_id,), 'all')
+    ], prepare=True)
+    shared_cache.set_member_rooms(user_id, cache.set_member_rooms(user_id, (room['id'] for room in rooms or [])))
+    return user, rooms
+
+def get_chat_room_context(room_id, user_id, limit=50):
+    """Get everything the chat page needs in one round trip
+    Membership is read from the member list, no separate check;
+    messages come from the room buffer when it is warm, and the room, the
+    user and the recent messages from one shared cache multi-get
+    """
+    messages = cache.get_room_page(room_id, limit)
+    load_recent = messages is None and not cache.has_room_buffer(room_id)
+    users, rooms, _, recent = shared_cache.get_many(
+        users=[user_id], rooms=[room_id], recent_messages=[room_id] if load_recent else []
+    )
+    room, user = rooms.get(room_id), users.get(user_id)
+    if messages is None:
+        messages = restore_room_buffer(room_id, recent.get(room_id), limit)
+
+    statements = [(ROOM_MEMBERS_SQL, (room_id,), 'all')]
+    if room is None:
+        statements.append((ROOM_BY_ID_SQL, (room_id,), 'one'))
+    if user is None:
+        statements.append((USER_BY_ID_SQL, (user_id,), 'one'))
+    if messages is None:
+        messages_query, messages_params, newest_first, fills = messages_read_statement(room_id, limit)
+        statements.append((messages_query, messages_params, 'all'))
+    members, *rows = execute_batch(statements, prepare=True)
+
+    rows, writes = iter(rows), []
+    if room is None:
+        room = next(rows)
+        writes += shared_cache.set_room_commands(room)
+    if user is None:
+        user = next(rows)
+        writes += shared_cache.set_users_commands({user_id: user})
+    if messages is None:
+        messages = messages_read_result(room_id, limit, None, None, next(rows), newest_first, fills)
+        writes += share_room_buffer_commands(room_id, fills)
+    shared_cache.write(writes)
+    return {
+        'room': room,
+        'is_member': has_member(members, user_id),
+        'user': user,
+        'messages': messages,
+        'members': members
+    }
+
+def get_messages_for_member(room_id, user_id, limit=50, before=None, after=None):
+    """Check membership and get a page of messages in one round trip (None if not a member)
+    A membership cache hit skips the check and a room buffer hit skips the
+    messages query: a member reading recent messages costs no query at all;
+    other page reads are coalesced with concurrent readers of the same room and cursor
     """
-    return execute_query(query, (message_id,), fetch_one=True)
+    if cache.check_membership(user_id, room_id):
+        return get_messages_by_room(room_id, limit, before, after)  # coalesced with other readers of the room
+
+    # Membership not cached: one shared cache multi-get for what is missing
+    page = cache.get_room_page(room_id, limit, before, after)
+    load_recent = page is None and not cache.has_room_buffer(room_id)
+    _, _, member_rooms, recent = shared_cache.get_many(
+        member_rooms=[user_id], recent_messages=[room_id] if load_recent else []
+    )
+    is_member = restore_member_rooms(user_id, room_id, member_rooms)
+    if page is None:
+        page = restore_room_buffer(room_id, recent.get(room_id), limit, before, after)
+    if is_member and page is not None:
+        return page
+
+    statements = []
+    if not is_member:
+        statements.append((MEMBER_ROOM_IDS_SQL, (user_id,), 'all'))
+    if page is None:
+        messages_query, messages_params, newest_first, fills = messages_read_statement(room_id, limit, before, after)
+        statements.append((messages_query, messages_params, 'all'))
+    results = execute_batch(statements, prepare=True)
+
+    writes = []
+    if not is_member:
+        room_ids = remember_member_rooms(user_id, results[0])
+        writes += shared_cache.set_member_rooms_commands(user_id, room_ids)
+        if room_id not in room_ids:
+            shared_cache.write(writes)
+            return None
+    if page is None:
+        page = messages_read_result(room_id, limit, before, after, results[-1], newest_first, fills)
+        writes += share_room_buffer_commands(room_id, fills)
+    shared_cache.write(writes)
+    if page is None:
+        page = fetch_messages_page(room_id, limit, before, after)
+    return page
+
+def get_members_for_member(room_id, user_id):
+    """Get room members if the user is one of them (None if not a member)"""
+    members = get_room_members(room_id)  # coalesced with other members of the room
+    return members if has_member(members, user_id) else None
@@ -0,0 +1,92 @@
+# Cross-process fan-out over Postgres LISTEN/NOTIFY
+# create_message sends a compact '<room_id>:<message_id>' NOTIFY in its insert
+# statement (Postgres only delivers it on commit). Every worker process runs
+# one listener thread with one dedicated connection for all rooms and hands
+# each notification to the registered handlers (stream push, cache refresh)
+# While the listener is connected the room buffers in cache.py see every new
+# message and may answer sync reads; each (re)connect drops them first
+import logging
+import threading
+import time
+
+import psycopg
+from psycopg import sql
+from config import DB_CONFIG, NOTIFY_CHANNEL
+import cache
+
+logger = logging.getLogger(__name__)
+
+_handlers = []
+_listener = None
+_listener_lock = threading.Lock()
+_stats = {'received': 0, 'handler_errors': 0, 'reconnects': 0}
+
+def format_payload(room_id, message_id):
+    """Encode a notification payload"""
+    return f'{room_id}:{message_id}'
+
+def parse_payload(payload):
+    """Decode a notification payload into (room_id, message_id)"""
+    room_id, message_id = payload.split(':')
+    return int(room_id), int(message_id)
+
+def listen_statement():
+    """LISTEN statement for the message channel"""
+    return sql.SQL("LISTEN {}").format(sql.Identifier(NOTIFY_CHANNEL))
+
+def add_handler(handler):
+    """Register handler(room_id, message_id); runs in the listener thread"""
+    _handlers.append(handler)
+
+def dispatch(payload):
+    """Pass one notification to every handler; a failing handler does not stop the others"""
+    room_id, message_id = parse_payload(payload)
+    _stats['received'] += 1
+    for handler in list(_handlers):
+        try:
+            handler(room_id, message_id)
+        except Exception:
+            _stats['handler_errors'] += 1
+            logger.exception('Notify handler %r failed for %s', handler, payload)
+
+def _listen_forever():
+    """Listener loop: LISTEN on a dedicated autocommit connection, reconnecting with backoff"""
+    delay = 1
+    while True:
+        try:
+            with psycopg.connect(
+                host=DB_CONFIG['host'],
+                port=DB_CONFIG['port'],
+                dbname=DB_CONFIG['database'],
+                user=DB_CONFIG['user'],
+                password=DB_CONFIG['password'],
+                autocommit=True
+            ) as conn:
+                conn.execute(listen_statement())
+                cache.follow_messages(True)
+                delay = 1
+                for notification in conn.notifies():
+                    dispatch(notification.payload)
+        except psycopg.Error as e:
+            logger.warning('Notify listener disconnected (%s), retrying in %ss', e, delay)
+        finally:
+            cache.follow_messages(False)
+        _stats['reconnects'] += 1
+        time.sleep(delay)
+        delay = min(delay * 2, 30)
+
+def start_listener():
+    """Start this worker's listener thread (once per process)"""
+    global _listener
+    with _listener_lock:
+        if _listener is None or not _listener.is_alive():
+            _listener = threading.Thread(target=_listen_forever, name='notify-listener', daemon=True)
+            _listener.start()
+
+def get_notify_stats():
+    """Get listener state: running, notifications received, handler errors and reconnects"""
+    return {
+        'listening': _listener is not None and _listener.is_alive(),
+        'handlers': len(_handlers),
+        **_stats
+    }
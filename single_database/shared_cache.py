@@ -0,0 +1,516 @@
+# Optional shared cache tier (Redis protocol) between the per-process caches
+# in cache.py and Postgres: every worker and app container reads the same
+# users, rooms, room membership and recent messages of each room.
+# SHARED_CACHE_URL selects the backend:
+#   ''             disabled (default): per-process caches only
+#   'memory://'    MemoryClient, an in-process stand-in with the same interface
+#                  (tests and local load tests; shared by this process only)
+#   'redis://...'  a Redis server (needs the redis package)
+# Best effort: a failing backend is logged and counted, reads fall through to Postgres.
+# Writes run as one MULTI/EXEC each, reads as plain pipelines. The one write
+# that is not best effort drops a user's rooms after a leave or their
+# deletion (drop_member_rooms): until it lands it is retried in a background
+# thread, and this worker reads that user's rooms from Postgres meanwhile
+import datetime
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from config import SHARED_CACHE_URL, SHARED_CACHE_TTL, SHARED_CACHE_MAX_KEYS, ROOM_BUFFER_SIZE
+
+logger = logging.getLogger(__name__)
+
+# ============ IN-PROCESS STAND-IN ============
+
+class MemoryClient:
+    """The subset of the redis-py client used here, kept in process memory
+    Keys expire after their TTL (lazily, on access) and the least recently
+    used keys are evicted beyond max_keys, like Redis with allkeys-lru
+    """
+
+    def __init__(self, max_keys=SHARED_CACHE_MAX_KEYS):
+        self._data = OrderedDict()  # key -> [expires_at or None, str | set | dict (sorted set: member -> score)]
+        self._max_keys = max_keys
+        self._lock = threading.RLock()
+
+    def _entry(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+            del self._data[key]
+            return None
+        if entry is not None:
+            self._data.move_to_end(key)
+        return entry
+
+    def _put(self, key, value, ttl=None):
+        self._data[key] = [None if ttl is None else time.monotonic() + ttl, value]
+        self._data.move_to_end(key)
+        while len(self._data) > self._max_keys:
+            self._data.popitem(last=False)
+
+    def _collection(self, key, kind):
+        entry = self._entry(key)
+        if entry is None:
+            self._put(key, kind())
+            entry = self._data[key]
+        return entry[1]
+
+    def _drop_if_empty(self, key):
+        entry = self._data.get(key)
+        if entry is not None and not entry[1]:
+            del self._data[key]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entry(key)
+            return None if entry is None else entry[1]
+
+    def setex(self, key, ttl, value):
+        with self._lock:
+            self._put(key, value, ttl)
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            deleted = 0
+            for key in keys:
+                if self._entry(key) is not None:
+                    del self._data[key]
+                    deleted += 1
+            return deleted
+
+    def expire(self, key, ttl):
+        with self._lock:
+            entry = self._entry(key)
+            if entry is not None:
+                entry[0] = time.monotonic() + ttl
+            return entry is not None
+
+    @staticmethod
+    def _range(items, start, end):
+        """items[start..end] with Redis index rules (inclusive end, negative from the end)"""
+        length = len(items)
+        start = max(start + length if start < 0 else start, 0)
+        end = end + length if end < 0 else end
+        return items[start:end + 1] if end >= 0 else []
+
+    def _ranked(self, members):
+        return sorted(members, key=lambda member: (members[member], member))
+
+    def zadd(self, key, mapping):
+        with self._lock:
+            items = self._collection(key, dict)
+            added = len(mapping.keys() - items.keys())
+            items.update(mapping)
+            return added
+
+    def zremrangebyscore(self, key, low, high):
+        with self._lock:
+            entry = self._entry(key)
+            if entry is None:
+                return 0
+            removed = [member for member, score in entry[1].items() if low <= score <= high]
+            for member in removed:
+                del entry[1][member]
+            self._drop_if_empty(key)
+            return len(removed)
+
+    def zremrangebyrank(self, key, start, end):
+        with self._lock:
+            entry = self._entry(key)
+            if entry is None:
+                return 0
+            removed = self._range(self._ranked(entry[1]), start, end)
+            for member in removed:
+                del entry[1][member]
+            self._drop_if_empty(key)
+            return len(removed)
+
+    def zrange(self, key, start, end):
+        with self._lock:
+            entry = self._entry(key)
+            return [] if entry is None else self._range(self._ranked(entry[1]), start, end)
+
+    def sadd(self, key, *members):
+        with self._lock:
+            items = self._collection(key, set)
+            added = len(set(members) - items)
+            items.update(members)
+            return added
+
+    def srem(self, key, *members):
+        with self._lock:
+            entry = self._entry(key)
+            if entry is None:
+                return 0
+            removed = len(entry[1] & set(members))
+            entry[1] -= set(members)
+            self._drop_if_empty(key)
+            return removed
+
+    def smembers(self, key):
+        with self._lock:
+            entry = self._entry(key)
+            return set() if entry is None else set(entry[1])
+
+    def sdiffstore(self, destination, key, *others):
+        with self._lock:
+            entry = self._entry(key)
+            members = set(entry[1]) if entry is not None else set()
+            for other in others:
+                other_entry = self._entry(other)
+                if other_entry is not None:
+                    members -= other_entry[1]
+            self._data.pop(destination, None)
+            if members:
+                self._put(destination, members)
+            return len(members)
+
+    def flushall(self):
+        with self._lock:
+            self._data.clear()
+            return True
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+class MemoryPipeline:
+    """Queues commands and runs them together on execute(), like a redis-py pipeline"""
+
+    def __init__(self, client):
+        self._client = client
+        self._commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+        def queue(*args):
+            self._commands.append((method, args))
+            return self
+        return queue
+
+    def execute(self):
+        with self._client._lock:
+            results = [method(*args) for method, args in self._commands]
+        self._commands = []
+        return results
+
+def connect(url):
+    """Create the client for SHARED_CACHE_URL"""
+    if url.startswith('memory://'):
+        return MemoryClient()
+    import redis  # optional dependency, only needed for redis:// URLs
+    return redis.Redis.from_url(url)
+
+# ============ KEYS AND ENCODING ============
+
+def user_key(user_id):
+    return f'chat:user:{user_id}'
+
+def room_key(room_id):
+    return f'chat:room:{room_id}'
+
+def member_rooms_key(user_id):
+    return f'chat:member:{user_id}:rooms'
+
+def left_rooms_key(user_id):
+    return f'chat:member:{user_id}:left'
+
+def recent_messages_key(room_id):
+    return f'chat:room:{room_id}:messages'
+
+def recent_from_key(room_id):
+    return f'chat:room:{room_id}:messages:from'
+
+def _encode_default(value):
+    if isinstance(value, datetime.datetime):
+        return {'$dt': value.isoformat()}
+    raise TypeError(f'Cannot cache {type(value).__name__}')
+
+def _decode_hook(obj):
+    if obj.keys() == {'$dt'}:
+        return datetime.datetime.fromisoformat(obj['$dt'])
+    return obj
+
+def encode(value):
+    """Serialize a row (or None) for the cache (keys sorted: one message is one sorted set member)"""
+    return json.dumps(value, default=_encode_default, sort_keys=True)
+
+def decode(raw):
+    """Deserialize a cached row"""
+    return json.loads(raw, object_hook=_decode_hook)
+
+# ============ COMMANDS ============
+# Reads and writes are lists of (command, *args) sent in one pipeline, so the
+# sync client here and the async one in aio_shared_cache.py share them
+
+_stats = {'reads': 0, 'hits': 0, 'misses': 0, 'writes': 0, 'errors': 0, 'drop_retries': 0}
+_undropped = {}  # user_id -> commands of a drop_member_rooms that failed
+
+def enabled():
+    """Check if a shared cache is configured"""
+    return bool(SHARED_CACHE_URL)
+
+def get_many_commands(users=(), rooms=(), member_rooms=(), recent_messages=()):
+    """Read commands for get_many; returns (commands, [(kind, id)] in the same order)
+    Users whose rooms are still to be dropped (see drop_member_rooms) are not read
+    """
+    commands, targets = [], []
+    member_rooms = [user_id for user_id in member_rooms if user_id not in _undropped]
+    for kind, ids, command in (
+        ('users', users, lambda i: ('get', user_key(i))),
+        ('rooms', rooms, lambda i: ('get', room_key(i))),
+        ('member_rooms', member_rooms, lambda i: ('smembers', member_rooms_key(i))),
+        ('recent_messages', recent_messages, lambda i: ('zrange', recent_messages_key(i), 0, -1)),
+        ('recent_from', recent_messages, lambda i: ('get', recent_from_key(i)))
+    ):
+        for item_id in dict.fromkeys(ids):
+            commands.append(command(item_id))
+            targets.append((kind, item_id))
+    return commands, targets
+
+def recent_messages_result(raw_messages, raw_from):
+    """A room's cached recent messages (oldest first) and whether they are the
+    room's whole history, or None if they may not be the room's latest
+    messages: no fill since the key appeared (appends alone, e.g. after an
+    eviction) or fewer messages than the last fill left. The history is whole
+    if the last fill was (see set_recent_messages_commands) and its oldest
+    message has not been trimmed since
+    """
+    if not raw_messages or raw_from is None:
+        return None
+    messages = {msg['id']: msg for msg in map(decode, raw_messages)}
+    marker = decode(raw_from)
+    oldest = min(messages)
+    if len(messages) < ROOM_BUFFER_SIZE and oldest > marker['from']:
+        return None
+    return [messages[msg_id] for msg_id in sorted(messages)], marker['complete'] and oldest <= marker['from']
+
+def get_many_result(targets, raw):
+    """Turn pipeline results into (users, rooms, member_rooms, recent_messages)
+    dicts holding the hits only; a user may be None (deleted)
+    """
+    found = {'users': {}, 'rooms': {}, 'member_rooms': {}, 'recent_messages': {}}
+    recent_from = {item_id: value for (kind, item_id), value in zip(targets, raw) if kind == 'recent_from'}
+    for (kind, item_id), value in zip(targets, raw):
+        if kind == 'recent_from':
+            continue
+        if kind == 'recent_messages':
+            value = recent_messages_result(value, recent_from[item_id])
+        if not value:  # absent key (a deleted user is cached as 'null')
+            _stats['misses'] += 1
+            continue
+        _stats['hits'] += 1
+        if kind == 'member_rooms':
+            found[kind][item_id] = frozenset(int(room_id) for room_id in value)
+        elif kind == 'recent_messages':
+            found[kind][item_id] = value
+        else:
+            found[kind][item_id] = decode(value)
+    return found['users'], found['rooms'], found['member_rooms'], found['recent_messages']
+
+def set_users_commands(users):
+    """Cache {user_id: row, or None for a deleted user}"""
+    return [('setex', user_key(user_id), SHARED_CACHE_TTL, encode(user and dict(user))) for user_id, user in users.items()]
+
+def set_room_commands(room):
+    """Cache a room row (rooms never change)"""
+    return [('setex', room_key(room['id']), SHARED_CACHE_TTL, encode(dict(room)))] if room else []
+
+def set_member_rooms_commands(user_id, room_ids):
+    """Replace a user's room ids with ones read from the database (a user in
+    no room is simply not cached). The read may predate a leave whose
+    write-through already ran: rooms left within the TTL are taken out again,
+    so a stale read never lets a user back into a room. A join it missed is
+    only checked in the database
+    """
+    key = member_rooms_key(user_id)
+    if not room_ids:
+        return [('delete', key)]
+    return [
+        ('delete', key), ('sadd', key, *room_ids),
+        ('sdiffstore', key, key, left_rooms_key(user_id)), ('expire', key, SHARED_CACHE_TTL)
+    ]
+
+def add_member_room_commands(user_id, room_id):
+    """Write-through of a join
+    If the set had expired it now holds only this room; other rooms then read
+    as not cached and are checked in the database, never wrongly allowed
+    """
+    key = member_rooms_key(user_id)
+    return [('srem', left_rooms_key(user_id), room_id), ('sadd', key, room_id), ('expire', key, SHARED_CACHE_TTL)]
+
+def remove_member_room_commands(user_id, room_id):
+    """Write-through of a leave, remembered for one TTL (see
+    set_member_rooms_commands): the user's rooms are deleted, not edited, and
+    read again from the database by the next check
+    """
+    left = left_rooms_key(user_id)
+    return [('sadd', left, room_id), ('expire', left, SHARED_CACHE_TTL), ('delete', member_rooms_key(user_id))]
+
+def add_recent_messages_commands(room_id, messages):
+    """Add messages to a room's sorted set (score: message id), one member per
+    id: a row read by a fill and the same row appended by its writer need not
+    encode alike (a fill row may lack sender_name), so any member already
+    holding the id is removed first. Then the oldest are trimmed
+    """
+    key = recent_messages_key(room_id)
+    return [
+        *(('zremrangebyscore', key, msg['id'], msg['id']) for msg in messages),
+        ('zadd', key, {encode(dict(msg)): msg['id'] for msg in messages}),
+        ('zremrangebyrank', key, 0, -ROOM_BUFFER_SIZE - 1),
+        ('expire', key, SHARED_CACHE_TTL)
+    ]
+
+def set_recent_messages_commands(room_id, messages, complete=False):
+    """Merge a room's latest messages (oldest first) read from the database
+    into its cached ones. The read may predate a message whose append already
+    ran, so nothing is deleted: the set keeps the newest ROOM_BUFFER_SIZE of
+    both. The fill's oldest id, and whether the fill is the room's whole
+    history, mark the set as the room's latest messages (see
+    recent_messages_result)
+    """
+    messages = list(messages)
+    complete = complete and len(messages) <= ROOM_BUFFER_SIZE
+    messages = messages[-ROOM_BUFFER_SIZE:]
+    if not messages:
+        return []
+    marker = encode({'from': messages[0]['id'], 'complete': complete})
+    return [*add_recent_messages_commands(room_id, messages), ('setex', recent_from_key(room_id), SHARED_CACHE_TTL, marker)]
+
+def append_recent_message_commands(room_id, message):
+    """Write-through of a new message, to every room: a room not cached yet
+    keeps it for the next fill, which may have been read before it committed
+    """
+    return add_recent_messages_commands(room_id, [message])
+
+def delete_recent_messages_commands(room_id):
+    """Drop a room's cached recent messages (after some were deleted)"""
+    return [('delete', recent_messages_key(room_id), recent_from_key(room_id))]
+
+def _failed(action):
+    _stats['errors'] += 1
+    logger.warning('Shared cache %s failed', action, exc_info=True)
+
+# ============ SYNC CLIENT ============
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Get this process's client (created on first use)"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = connect(SHARED_CACHE_URL)
+        return _client
+
+def execute(commands, transaction=False):
+    """Run commands in one pipeline round trip; returns their results
+    (transaction: as one MULTI/EXEC, so no other client's commands interleave)
+    """
+    pipe = get_client().pipeline(transaction=transaction)
+    for command, *args in commands:
+        getattr(pipe, command)(*args)
+    return pipe.execute()
+
+def get_many(users=(), rooms=(), member_rooms=(), recent_messages=()):
+    """Pipelined multi-get of any mix of entries (see get_many_result)"""
+    commands, targets = get_many_commands(users, rooms, member_rooms, recent_messages)
+    if not enabled() or not commands:
+        return {}, {}, {}, {}
+    _stats['reads'] += 1
+    try:
+        raw = execute(commands)
+    except Exception:
+        _failed('read')
+        return {}, {}, {}, {}
+    return get_many_result(targets, raw)
+
+def write(commands):
+    """Run write commands in one pipeline round trip (no-op when disabled)"""
+    if not enabled() or not commands:
+        return
+    _stats['writes'] += 1
+    try:
+        execute(commands, transaction=True)
+    except Exception:
+        _failed('write')
+
+def drop_member_rooms(user_id, commands):
+    """Run write commands that delete a user's rooms (remove_member_room_commands,
+    a deleted user); if they fail, retry them in the background until they
+    land, reading the user's rooms from the database here meanwhile
+    """
+    if not enabled():
+        return
+    _stats['writes'] += 1
+    try:
+        execute(commands, transaction=True)
+    except Exception:
+        _failed('write')
+        retry_drop(user_id, commands)
+
+_dropper = None
+_dropper_lock = threading.Lock()
+
+def retry_drop(user_id, commands):
+    """Queue a failed drop_member_rooms for the retry thread (started once per process)"""
+    global _dropper
+    with _dropper_lock:
+        _undropped[user_id] = _undropped.get(user_id, []) + list(commands)
+        if _dropper is None:
+            _dropper = threading.Thread(target=_drop_forever, name='shared-cache-drops', daemon=True)
+            _dropper.start()
+
+def _drop_forever():
+    while True:
+        time.sleep(1)
+        with _dropper_lock:
+            undropped = list(_undropped.items())
+        for user_id, commands in undropped:
+            _stats['drop_retries'] += 1
+            try:
+                execute(commands, transaction=True)
+            except Exception:
+                _failed('write')
+                break
+            with _dropper_lock:
+                if _undropped.get(user_id) is commands:
+                    del _undropped[user_id]
+
+def set_users(users):
+    write(set_users_commands(users))
+
+def set_room(room):
+    write(set_room_commands(room))
+
+def set_member_rooms(user_id, room_ids):
+    write(set_member_rooms_commands(user_id, room_ids))
+
+def add_member_room(user_id, room_id):
+    write(add_member_room_commands(user_id, room_id))
+
+def remove_member_room(user_id, room_id):
+    drop_member_rooms(user_id, remove_member_room_commands(user_id, room_id))
+
+def delete_member_rooms(user_id):
+    write([('delete', member_rooms_key(user_id))])
+
+def set_recent_messages(room_id, messages, complete=False):
+    write(set_recent_messages_commands(room_id, messages, complete))
+
+def append_recent_message(room_id, message):
+    write(append_recent_message_commands(room_id, message))
+
+def get_shared_cache_stats():
+    """Get backend, pipelined reads and writes, key hits/misses, errors and
+    membership drops waiting for a retry
+    """
+    hits, misses = _stats['hits'], _stats['misses']
+    return {
+        'backend': SHARED_CACHE_URL.split('://')[0] if enabled() else None,
+        **_stats,
+        'undropped': len(_undropped),
+        'hit_rate': round(hits / (hits + misses), 4) if hits + misses else 0
+    }
@@ -0,0 +1,69 @@
+# Single-flight request coalescing for read functions (one copy per worker process)
+# Concurrent calls of a @coalesced function with the same arguments share one
+# execution: the first caller runs it, the others wait for its result (or
+# error) instead of sending the same query. Nothing is cached: a call that
+# starts after the first one finished runs again. The result object is shared
+# by every waiter, so callers must not modify it
+import functools
+import threading
+from config import SINGLE_FLIGHT
+
+_calls = {}  # (function name, args) -> in-flight call
+_lock = threading.Lock()
+_stats = {}  # function name -> {'calls': n, 'coalesced': n}
+
+def call_key(name, args, kwargs):
+    """Identify a call by function name and arguments"""
+    return (name, args, tuple(sorted(kwargs.items())))
+
+def count_call(name, coalesced):
+    """Count one call of a function (lock held)"""
+    stats = _stats.setdefault(name, {'calls': 0, 'coalesced': 0})
+    stats['calls'] += 1
+    stats['coalesced'] += coalesced
+
+def coalesced(func):
+    """Decorator: concurrent identical calls share one execution"""
+    if not SINGLE_FLIGHT:
+        return func
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = call_key(name, args, kwargs)
+        with _lock:
+            call = _calls.get(key)
+            leader = call is None
+            if leader:
+                call = _calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+            count_call(name, not leader)
+
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func(*args, **kwargs)
+            return call['result']
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with _lock:
+                del _calls[key]
+            call['done'].set()
+
+    return wrapper
+
+def get_single_flight_stats():
+    """Get calls and coalesced calls per function, and calls in flight now"""
+    with _lock:
+        return {
+            'enabled': SINGLE_FLIGHT,
+            'in_flight': len(_calls),
+            'calls': sum(stats['calls'] for stats in _stats.values()),
+            'coalesced': sum(stats['coalesced'] for stats in _stats.values()),
+            'functions': {name: dict(stats) for name, stats in _stats.items()}
+        }
@@ -9,8 +9,15 @@ import requests
 import time
 import argparse
 import json
+import os
+import sys
+from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+# Shard placement of the sharded app (same SHARD_* environment as the app)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "multiple_database"))
+from placement import shard_of  # noqa: E402
+
 # Configuration
 SINGLE_DB_URL = "http://localhost:5000"
 MULTIPLE_DB_URL = "http://localhost:5001"
@@ -294,14 +301,14 @@ def verify_sharding(room_ids):
     print("VERIFYING SHARD DISTRIBUTION")
     print("="*60)
     
-    shard_distribution = {0: 0, 1: 0, 2: 0, 3: 0}
+    shard_distribution = defaultdict(int)
     
     for room_id in room_ids:
-        shard = room_id % 4
+        shard = shard_of(room_id)
         shard_distribution[shard] += 1
     
     print(f"\nRoom distribution by shard:")
-    for shard, count in shard_distribution.items():
+    for shard, count in sorted(shard_distribution.items()):
         bar = "█" * count
         print(f"  Shard {shard}: {count} rooms {bar}")
     
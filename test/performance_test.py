@@ -13,12 +13,18 @@ import requests
 import time
 import argparse
 import json
+import os
 import random
+import sys
 import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from collections import defaultdict
 import statistics
 
+# Shard placement of the sharded app (same SHARD_* environment as the app)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "multiple_database"))
+from placement import shard_of  # noqa: E402
+
 # Configuration
 SINGLE_DB_URL = "http://localhost:5000"
 MULTIPLE_DB_URL = "http://localhost:5001"
@@ -203,7 +209,7 @@ def run_performance_test(base_url, db_name, db_type="single"):
     # Shard distribution (for sharded DB)
     shard_dist = defaultdict(int)
     for room in rooms:
-        shard = int(room["room_id"]) % 4
+        shard = shard_of(int(room["room_id"]))
         shard_dist[shard] += 1
     print(f"      Shard distribution: {dict(shard_dist)}")
     
@@ -0,0 +1,291 @@
+"""
+Routing Benchmark - ShardingSphere Proxy vs Direct Shard Routing
+Membandingkan path app -> proxy -> shard dengan path app -> shard (SHARD_ROUTING=direct)
+
+Test Configuration:
+- 100 benchmark rooms (room_id mulai 900000000, tidak bentrok dengan room asli)
+- 2000 operasi per mode: INSERT 1 message + SELECT 50 message terbaru dari room yang sama
+- 20 concurrent workers
+- Message benchmark memakai id negatif dan dihapus lagi setelah test
+
+Shard bisa berupa container docker-compose (port 5441-5444) atau beberapa
+database Postgres lokal biasa yang berperan sebagai shard (--setup membuat
+tabel messages di sana); tanpa proxy jalankan dengan --no-proxy.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg
+from psycopg_pool import ConnectionPool
+
+# Shard placement of the sharded app (same SHARD_* environment as the app)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "multiple_database"))
+from config import MESSAGE_SHARDS  # noqa: E402
+from placement import shard_of  # noqa: E402
+
+# Configuration
+PROXY_DSN = "host=localhost port=3307 dbname=sharding_db user=chatuser password=chatpass"
+SHARD_DSNS = [
+    f"host=localhost port={5441 + shard} dbname=chat_shard_{shard} user=chatuser password=chatpass"
+    for shard in range(MESSAGE_SHARDS)
+]
+
+TOTAL_ROOMS = 100
+TOTAL_OPERATIONS = 2000
+CONCURRENT_WORKERS = 20
+ROOM_ID_BASE = 900000000
+
+# Same statements as multiple_database/models.py
+CREATE_MESSAGE_SQL = "INSERT INTO messages (id, room_id, sender_id, content) VALUES (%s, %s, %s, %s) RETURNING *"
+MESSAGES_LATEST_SQL = "SELECT * FROM messages WHERE room_id = %s ORDER BY id DESC LIMIT %s"
+DELETE_BENCHMARK_SQL = "DELETE FROM messages WHERE room_id = ANY(%s) AND id < 0"
+
+SETUP_SQL = """
+    CREATE TABLE IF NOT EXISTS messages (
+        id BIGINT PRIMARY KEY,
+        room_id BIGINT NOT NULL,
+        sender_id BIGINT NOT NULL,
+        content TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_messages_room_id_id ON messages(room_id, id)
+"""
+
+# Benchmark messages get negative ids: the app only hands out positive ones
+_ids = itertools.count(-1, -1)
+_ids_lock = threading.Lock()
+
+
+def next_message_id():
+    with _ids_lock:
+        return next(_ids)
+
+
+class Router:
+    """Connection pools of one mode: 'proxy' (one pool) or 'direct' (one pool per shard)"""
+
+    def __init__(self, mode, proxy_dsn, shard_dsns, workers):
+        self.mode = mode
+        dsns = [proxy_dsn] if mode == "proxy" else shard_dsns
+        self.pools = [
+            ConnectionPool(dsn, min_size=1, max_size=workers, name=f"bench_{mode}_{i}", open=True)
+            for i, dsn in enumerate(dsns)
+        ]
+
+    def pool(self, room_id):
+        if self.mode == "proxy":
+            return self.pools[0]
+        return self.pools[shard_of(room_id)]
+
+    def send_and_read(self, room_id):
+        """One operation: insert a message and read the room's latest page"""
+        with self.pool(room_id).connection() as conn:
+            conn.execute(CREATE_MESSAGE_SQL, (next_message_id(), room_id, 0, f"benchmark {time.time()}"))
+            conn.execute(MESSAGES_LATEST_SQL, (room_id, 50)).fetchall()
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
+
+
+def calculate_percentiles(times):
+    """Calculate P50, P95, P99 latencies"""
+    if not times:
+        return {"p50": 0, "p95": 0, "p99": 0, "avg": 0, "min": 0, "max": 0}
+
+    sorted_times = sorted(times)
+    n = len(sorted_times)
+
+    return {
+        "p50": sorted_times[int(n * 0.50)],
+        "p95": sorted_times[int(n * 0.95)],
+        "p99": sorted_times[int(n * 0.99)],
+        "avg": statistics.mean(times),
+        "min": min(times),
+        "max": max(times)
+    }
+
+
+def setup_shards(shard_dsns):
+    """Create the messages table on plain local databases standing in for the shards"""
+    for dsn in shard_dsns:
+        with psycopg.connect(dsn) as conn:
+            conn.execute(SETUP_SQL)
+
+
+def cleanup(shard_dsns, rooms):
+    """Delete the benchmark messages from every shard"""
+    for dsn in shard_dsns:
+        with psycopg.connect(dsn) as conn:
+            conn.execute(DELETE_BENCHMARK_SQL, (rooms,))
+
+
+def verify_routing(proxy_dsn, shard_dsns, rooms, use_proxy):
+    """Check that direct routing puts every room's messages on the shard the proxy uses
+
+    Writes one message per room straight to its shard, then checks that each
+    shard holds exactly its own rooms and (with the proxy) that the proxy
+    reads every message back.
+    """
+    print("[1/3] Verifying routing...")
+    written = {}
+    router = Router("direct", proxy_dsn, shard_dsns, 1)
+    try:
+        for room_id in rooms:
+            message_id = next_message_id()
+            with router.pool(room_id).connection() as conn:
+                conn.execute(CREATE_MESSAGE_SQL, (message_id, room_id, 0, "routing check"))
+            written[room_id] = message_id
+    finally:
+        router.close()
+
+    errors = 0
+    for shard, dsn in enumerate(shard_dsns):
+        with psycopg.connect(dsn) as conn:
+            rows = conn.execute("SELECT DISTINCT room_id FROM messages WHERE room_id = ANY(%s)", (rooms,)).fetchall()
+        misplaced = [room_id for (room_id,) in rows if shard_of(room_id) != shard]
+        errors += len(misplaced)
+        print(f"      Shard {shard}: {len(rows)} rooms, {len(misplaced)} misplaced")
+
+    if use_proxy:
+        with psycopg.connect(proxy_dsn) as conn:
+            for room_id, message_id in written.items():
+                row = conn.execute("SELECT id FROM messages WHERE id = %s AND room_id = %s", (message_id, room_id)).fetchone()
+                if row is None:
+                    errors += 1
+        print(f"      Proxy read back {len(written)} messages")
+
+    print(f"      Routing check: {'OK' if errors == 0 else f'{errors} errors'}")
+    return errors
+
+
+def run_benchmark(mode, proxy_dsn, shard_dsns, rooms):
+    """Run TOTAL_OPERATIONS operations through one routing mode"""
+    router = Router(mode, proxy_dsn, shard_dsns, CONCURRENT_WORKERS)
+    response_times = []
+    errors = 0
+    lock = threading.Lock()
+
+    def operation(room_id):
+        nonlocal errors
+        start_time = time.perf_counter()
+        try:
+            router.send_and_read(room_id)
+        except psycopg.Error:
+            with lock:
+                errors += 1
+            return
+        elapsed = (time.perf_counter() - start_time) * 1000
+        with lock:
+            response_times.append(elapsed)
+
+    try:
+        workload = [random.choice(rooms) for _ in range(TOTAL_OPERATIONS)]
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=CONCURRENT_WORKERS) as executor:
+            list(executor.map(operation, workload))
+        duration = time.time() - start
+    finally:
+        router.close()
+
+    perf_stats = calculate_percentiles(response_times)
+    throughput = len(response_times) / duration if duration > 0 else 0
+
+    print(f"\n   {mode.upper()}: {throughput:.2f} ops/sec | avg {perf_stats['avg']:.2f} ms | "
+          f"p50 {perf_stats['p50']:.2f} ms | p95 {perf_stats['p95']:.2f} ms | "
+          f"p99 {perf_stats['p99']:.2f} ms | errors {errors}")
+
+    return {
+        "mode": mode,
+        "duration": duration,
+        "throughput": throughput,
+        "errors": errors,
+        "perf_stats": perf_stats
+    }
+
+
+def print_comparison(proxy, direct):
+    """Print side-by-side comparison"""
+    print("\n" + "="*70)
+    print("📊 ROUTING COMPARISON: Proxy vs Direct")
+    print("="*70)
+    print(f"\n{'Metric':<25} {'Proxy':>15} {'Direct':>15} {'Change':>12}")
+    print("-"*70)
+
+    def change(p_val, d_val):
+        return f"{(d_val - p_val) / p_val * 100:+.1f}%" if p_val else "-"
+
+    print(f"{'Throughput (ops/sec)':<25} {proxy['throughput']:>15.2f} {direct['throughput']:>15.2f} "
+          f"{change(proxy['throughput'], direct['throughput']):>12}")
+    for metric in ("avg", "p50", "p95", "p99", "max"):
+        p_val, d_val = proxy['perf_stats'][metric], direct['perf_stats'][metric]
+        print(f"{metric.upper() + ' Response (ms)':<25} {p_val:>15.2f} {d_val:>15.2f} {change(p_val, d_val):>12}")
+    print("="*70)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Routing Benchmark - Proxy vs Direct Shard Routing")
+    parser.add_argument("--proxy-dsn", default=PROXY_DSN, help="ShardingSphere proxy connection string")
+    parser.add_argument("--shard-dsn", action="append", help="Shard connection string, in shard order (repeat per shard)")
+    parser.add_argument("--no-proxy", action="store_true", help="Only verify and time direct routing")
+    parser.add_argument("--setup", action="store_true", help="Create the messages table on the shard databases")
+    parser.add_argument("--rooms", type=int, default=100, help="Number of benchmark rooms")
+    parser.add_argument("--ops", type=int, default=2000, help="Operations per mode")
+    parser.add_argument("--workers", type=int, default=20, help="Concurrent worker threads")
+
+    args = parser.parse_args()
+
+    global TOTAL_ROOMS, TOTAL_OPERATIONS, CONCURRENT_WORKERS
+    TOTAL_ROOMS = args.rooms
+    TOTAL_OPERATIONS = args.ops
+    CONCURRENT_WORKERS = args.workers
+    shard_dsns = args.shard_dsn or SHARD_DSNS
+    if len(shard_dsns) != MESSAGE_SHARDS:
+        parser.error(f"{len(shard_dsns)} shards given, the app places rooms on MESSAGE_SHARDS={MESSAGE_SHARDS}")
+    use_proxy = not args.no_proxy
+    rooms = list(range(ROOM_ID_BASE, ROOM_ID_BASE + TOTAL_ROOMS))
+
+    print("\n" + "="*70)
+    print("      ROUTING BENCHMARK - PROXY vs DIRECT SHARD ROUTING")
+    print("="*70)
+    print(f"\nTest Configuration:")
+    print(f"  - Shards: {len(shard_dsns)}")
+    print(f"  - Rooms: {TOTAL_ROOMS}")
+    print(f"  - Operations/Mode: {TOTAL_OPERATIONS}")
+    print(f"  - Concurrent Workers: {CONCURRENT_WORKERS}\n")
+
+    if args.setup:
+        setup_shards(shard_dsns)
+
+    results = {}
+    try:
+        errors = verify_routing(args.proxy_dsn, shard_dsns, rooms, use_proxy)
+        print("[2/3] Benchmarking...")
+        if use_proxy:
+            results["proxy"] = run_benchmark("proxy", args.proxy_dsn, shard_dsns, rooms)
+        results["direct"] = run_benchmark("direct", args.proxy_dsn, shard_dsns, rooms)
+    finally:
+        print("\n[3/3] Cleaning up benchmark messages...")
+        cleanup(shard_dsns, rooms)
+
+    if len(results) == 2:
+        print_comparison(results["proxy"], results["direct"])
+
+    with open("routing_benchmark_results.json", "w") as f:
+        json.dump({"routing_errors": errors, **results}, f, indent=2)
+    print("\nResults saved to routing_benchmark_results.json")
+
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
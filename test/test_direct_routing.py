@@ -0,0 +1,63 @@
+"""
+Direct Routing Test - SHARD_ROUTING=direct terhadap shard Postgres lokal
+Memeriksa bahwa aplikasi multiple_database (models.py) menulis message ke
+shard yang dipilih placement.py, tidak ke shard lain, dan membacanya kembali
+dari shard itu (halaman history dan latest multi-room).
+
+Butuh Postgres lokal (lihat local_shards.py), tanpa itu di-skip:
+    python test/test_direct_routing.py   (atau: python -m pytest test/test_direct_routing.py)
+"""
+
+import unittest
+
+import local_shards
+from local_shards import message_ids
+
+
+class DirectRoutingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        local_shards.create_shards()
+        cls.models, cls.placement = local_shards.load_app("models", "placement")
+
+    def rooms(self, first):
+        """One room id per message shard, starting at `first`"""
+        rooms = {}
+        room_id = first
+        while len(rooms) < local_shards.MESSAGE_SHARDS:
+            rooms.setdefault(self.placement.shard_of(room_id), room_id)
+            room_id += 1
+        return rooms
+
+    def assertOnlyOn(self, shard, room_id, ids):
+        for node in range(local_shards.SHARD_NODES):
+            self.assertEqual(message_ids(node, room_id), ids if node == shard else [], f"ds_{node}")
+
+    def test_message_goes_to_placement_shard(self):
+        for shard, room_id in self.rooms(1000).items():
+            message = self.models.create_message(room_id, 7, "hello", "alice")
+            self.assertOnlyOn(shard, room_id, [message["id"]])
+
+    def test_batch_goes_to_placement_shard(self):
+        for shard, room_id in self.rooms(2000).items():
+            messages = self.models.create_messages(room_id, 7, ["one", "two", "three"], "alice")
+            self.assertOnlyOn(shard, room_id, [message["id"] for message in messages])
+
+    def test_history_is_read_from_placement_shard(self):
+        for room_id in self.rooms(3000).values():
+            sent = [self.models.create_message(room_id, 7, f"message {i}", "alice")["id"] for i in range(5)]
+            page = self.models.fetch_messages_page(room_id, limit=3)
+            self.assertEqual([message["id"] for message in page], sent[-3:])
+            older = self.models.fetch_messages_page(room_id, limit=3, before=sent[2])
+            self.assertEqual([message["id"] for message in older], sent[:2])
+
+    def test_latest_messages_of_rooms_on_every_shard(self):
+        rooms = list(self.rooms(4000).values())
+        sent = {room_id: [self.models.create_message(room_id, 7, "hi", "alice")["id"]] for room_id in rooms}
+        self.models.cache.clear_room_buffers()  # read from the shards, not this worker's buffers
+        latest = self.models.get_latest_messages(rooms, 10)
+        self.assertEqual({room_id: [message["id"] for message in messages] for room_id, messages in latest.items()}, sent)
+
+
+if __name__ == "__main__":
+    unittest.main()
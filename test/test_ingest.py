@@ -0,0 +1,196 @@
+"""
+Ingest Test - ingest.py (write-behind ingestion) tanpa database
+Flusher diberi fungsi write palsu untuk memeriksa:
+- spill file di-rotasi per INGEST_BATCH_ROWS pesan, segmen dihapus setelah ditulis
+- fsync spill file dilakukan di luar lock queue, satu untuk pengirim yang menunggu bersama
+- spill file worker yang mati diputar ulang, tanpa pesan ganda
+- database yang tidak bisa dihubungi membuat batch dicoba ulang
+- baris yang gagal ditulis masuk dead-letter, sisa batch tetap ditulis
+
+Dijalankan untuk kedua aplikasi (single_database dan multiple_database):
+    python test/test_ingest.py   (atau: python -m pytest test/test_ingest.py)
+"""
+
+import glob
+import importlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+import psycopg
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BATCH_ROWS = 3
+
+
+def load_ingest(tree, spill_dir):
+    """Import ingest.py of one app with a fresh queue spilling to spill_dir"""
+    os.environ["INGEST_SPILL_DIR"] = spill_dir
+    os.environ["INGEST_BATCH_ROWS"] = str(BATCH_ROWS)
+    for name in ("config", "ingest"):
+        sys.modules.pop(name, None)
+    sys.path.insert(0, os.path.join(ROOT, tree))
+    try:
+        return importlib.import_module("ingest")
+    finally:
+        sys.path.pop(0)
+
+
+def message(n, room_id=1):
+    return {
+        "id": None,
+        "room_id": room_id,
+        "sender_id": 7,
+        "content": f"message {n}",
+        "created_at": datetime(2025, 1, 1, 12) + timedelta(microseconds=n),
+        "sender_name": "alice",
+    }
+
+
+class Database:
+    """Stands in for models.write_messages: ids in write order, replays skipped"""
+
+    def __init__(self):
+        self.rows = {}
+        self.fail = []  # errors raised by the next writes
+        self.bad = set()  # contents that always fail
+
+    def write(self, messages):
+        if self.fail:
+            raise self.fail.pop(0)
+        if any(message["content"] in self.bad for message in messages):
+            raise psycopg.errors.CheckViolation("bad row")
+        written = []
+        for message in messages:
+            key = (message["room_id"], message["sender_id"], message["created_at"])
+            if key not in self.rows:
+                self.rows[key] = {**message, "id": len(self.rows) + 1}
+                written.append(self.rows[key])
+        return written
+
+    def contents(self):
+        return [row["content"] for row in sorted(self.rows.values(), key=lambda row: row["id"])]
+
+
+class IngestTests:
+    """Tests run against ingest.py of the app in `tree`"""
+    tree = None
+
+    def setUp(self):
+        spill_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spill_dir.cleanup)
+        self.spill_dir = spill_dir.name
+        self.load()
+        self.db = Database()
+        self.handled = []
+        self.ingest.add_handler(self.handled.extend)
+
+    def load(self):
+        self.ingest = load_ingest(self.tree, self.spill_dir)
+        self.addCleanup(self.close_files, self.ingest)
+
+    @staticmethod
+    def close_files(ingest):
+        for file in (ingest._spill, ingest._spill_lock_file, *ingest._unsynced):
+            if file is not None:
+                file.close()
+
+    def segments(self):
+        return sorted(glob.glob(os.path.join(self.spill_dir, "ingest-*.[0-9]*.jsonl")))
+
+    def flush(self):
+        while batch := self.ingest.take_batch():
+            self.ingest._write(batch, self.db.write)
+
+    def test_spill_rotates_and_segments_go_once_written(self):
+        for n in range(7):
+            self.assertTrue(self.ingest.submit(message(n)))
+        self.assertEqual(len(self.segments()), 3)
+        self.ingest._write(self.ingest.take_batch(), self.db.write)
+        self.assertEqual(len(self.segments()), 2)
+        self.flush()
+        self.assertEqual(self.segments(), [])
+        self.assertEqual(self.db.contents(), [f"message {n}" for n in range(7)])
+        self.assertEqual([m["id"] for m in self.handled], list(range(1, 8)))
+
+    def test_waiting_senders_share_one_fsync(self):
+        fsyncs = []
+
+        def fsync(fd):
+            fsyncs.append(self.ingest._lock.locked())
+
+        with mock.patch.object(self.ingest.os, "fsync", fsync):
+            with self.ingest._sync_lock:  # a group fsync is running
+                senders = [threading.Thread(target=self.ingest.submit, args=(message(n),)) for n in range(5)]
+                for sender in senders:
+                    sender.start()
+                while self.ingest._spilled < 5:
+                    pass
+            for sender in senders:
+                sender.join()
+        self.assertEqual(fsyncs, [False] * 3)  # the rotated segment, the open one, the directory
+        self.assertEqual(self.ingest.queued(), 5)
+
+    def test_written_open_segment_goes(self):
+        self.ingest.submit(message(0))
+        self.flush()
+        self.assertEqual(self.segments(), [])
+        self.ingest.submit(message(1))
+        self.assertEqual(len(self.segments()), 1)
+        self.flush()
+        self.assertEqual(self.segments(), [])
+        self.assertEqual(self.db.contents(), ["message 0", "message 1"])
+
+    def test_recover_replays_a_dead_workers_spill_once(self):
+        for n in range(5):
+            self.ingest.submit(message(n))
+        self.db.write([message(0)])  # written before the worker died
+        dead = self.ingest._spill_prefix
+        self.ingest._spill_lock_file.close()  # the worker dies: its lock goes
+        with open(dead + ".00000002.jsonl", "a") as spill:  # a torn last line
+            spill.write('{"room_id": 1')
+
+        self.load()
+        self.assertEqual(self.ingest.recover(), 5)
+        self.assertFalse(glob.glob(glob.escape(dead) + ".*"))
+        self.flush()
+        self.assertEqual(self.db.contents(), [f"message {n}" for n in range(5)])
+        self.assertEqual(self.segments(), [])
+
+    def test_lost_database_is_retried(self):
+        self.db.fail = [psycopg.OperationalError("connection lost")] * 3
+        self.ingest.submit(message(0))
+        self.flush()
+        self.assertEqual(self.db.contents(), ["message 0"])
+        self.assertEqual(self.ingest.get_ingest_stats()["write_errors"], 3)
+
+    def test_bad_row_is_dead_lettered(self):
+        self.db.bad = {"message 1"}
+        for n in range(3):
+            self.ingest.submit(message(n))
+        self.flush()
+        self.assertEqual(self.db.contents(), ["message 0", "message 2"])
+        with open(os.path.join(self.spill_dir, self.ingest.DEAD_LETTER_FILE)) as dead:
+            lines = [json.loads(line) for line in dead]
+        self.assertEqual([line["content"] for line in lines], ["message 1"])
+        self.assertIn("bad row", lines[0]["error"])
+        stats = self.ingest.get_ingest_stats()
+        self.assertEqual((stats["written"], stats["dead_lettered"]), (2, 1))
+        self.assertEqual(self.segments(), [])
+
+
+class SingleDatabaseIngestTest(IngestTests, unittest.TestCase):
+    tree = "single_database"
+
+
+class MultipleDatabaseIngestTest(IngestTests, unittest.TestCase):
+    tree = "multiple_database"
+
+
+if __name__ == "__main__":
+    unittest.main()
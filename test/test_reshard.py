@@ -0,0 +1,170 @@
+"""
+Reshard Test - reshard.py dan route per room terhadap shard Postgres lokal
+Memindahkan room dari shard placement-nya ke ds_4 dengan SHARD_ROUTING=direct:
+- room tetap terbaca setelah dipindah (dan message baru masuk ke ds_4)
+- selama dual/flipped message baru sampai ke kedua shard
+- verify hanya membandingkan sampai id yang sudah disalin
+- cleanup membawa message yang hanya ada di shard lama ke shard baru
+- move yang di-kill di tengah salinan dilanjutkan oleh resume, tidak dari awal
+- aplikasi lewat proxy menolak room yang punya route
+
+Butuh Postgres lokal (lihat local_shards.py), tanpa itu di-skip:
+    python test/test_reshard.py   (atau: python -m pytest test/test_reshard.py)
+"""
+
+import subprocess
+import sys
+import time
+import unittest
+
+import local_shards
+from local_shards import message_ids
+
+NEW_SHARD = 4
+
+
+class ReshardTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        local_shards.create_shards()
+        cls.load()
+
+    @classmethod
+    def load(cls):
+        cls.models, cls.shard_routes, cls.reshard, cls.placement = local_shards.load_app(
+            "models", "shard_routes", "reshard", "placement"
+        )
+        cls.reshard.GRACE_SECONDS = 0  # the test reloads the routes itself
+        cls.reshard.VERIFY_ATTEMPTS = 1
+
+    def setUp(self):
+        self.meta = self.reshard.connect(self.reshard.METADATA_SHARD, autocommit=True)
+        self.addCleanup(self.meta.close)
+
+    def send(self, room_id, count):
+        return [message["id"] for message in self.models.create_messages(room_id, 7, [f"message {i}" for i in range(count)], "alice")]
+
+    def route(self, room_id):
+        return self.meta.execute(self.reshard.ROUTE_SQL, (room_id,)).fetchone()
+
+    def start(self, room_id):
+        job = self.reshard.start_move(self.meta, room_id, NEW_SHARD)
+        self.shard_routes.reload_routes()
+        return job
+
+    def finish(self):
+        self.assertEqual(self.reshard.run_moves(self.meta, 7, 0), 0)
+        self.shard_routes.reload_routes()
+
+    def test_room_is_readable_after_move(self):
+        room_id = 5000
+        old = self.placement.shard_of(room_id)
+        sent = self.send(room_id, 20)
+        self.start(room_id)
+        self.finish()
+        self.assertEqual(self.route(room_id)["state"], "done")
+        self.assertEqual(self.models.message_shard(room_id), NEW_SHARD)
+        self.assertEqual(message_ids(NEW_SHARD, room_id), sent)
+        self.assertEqual(message_ids(old, room_id), [])
+        page = self.models.fetch_messages_page(room_id, limit=50)
+        self.assertEqual([message["id"] for message in page], sent)
+        after = self.models.create_message(room_id, 7, "after the move", "alice")["id"]
+        self.assertEqual(message_ids(NEW_SHARD, room_id), sent + [after])
+        self.assertEqual(message_ids(old, room_id), [])
+
+    def test_dual_write_reaches_both_shards(self):
+        room_id = 6000
+        old = self.placement.shard_of(room_id)
+        sent = self.send(room_id, 3)
+        job = self.start(room_id)
+        self.assertEqual(self.models.message_shard(room_id), old)  # dual: reads stay on the old shard
+        dual = [self.models.create_message(room_id, 7, "dual", "alice")["id"], *self.send(room_id, 2)]
+        self.assertEqual(message_ids(old, room_id), sent + dual)
+        self.assertEqual(message_ids(NEW_SHARD, room_id), dual)
+        self.reshard.set_state(self.meta, job, "flipped")
+        self.shard_routes.reload_routes()
+        self.assertEqual(self.models.message_shard(room_id), NEW_SHARD)
+        flipped = self.models.create_message(room_id, 7, "flipped", "alice")["id"]
+        self.assertEqual(message_ids(old, room_id), sent + dual + [flipped])
+        self.assertEqual(message_ids(NEW_SHARD, room_id), dual + [flipped])
+        self.finish()
+        self.assertEqual(message_ids(NEW_SHARD, room_id), sent + dual + [flipped])
+        self.assertEqual(message_ids(old, room_id), [])
+
+    def test_verify_compares_up_to_the_copied_id(self):
+        room_id = 7000
+        old = self.placement.shard_of(room_id)
+        self.send(room_id, 10)
+        job = {"room_id": room_id, "from_shard": old, "to_shard": NEW_SHARD, "copied_up_to": 0}
+        with self.reshard.connect(old) as source, self.reshard.connect(NEW_SHARD) as target:
+            self.reshard.copy_history(self.meta, source, target, job, 4, self.reshard.Throttle(0))
+            late = self.send(room_id, 1)[0]  # no route: only on the old shard
+            self.assertTrue(self.reshard.verify(source, target, room_id, job["copied_up_to"]))
+            self.assertFalse(self.reshard.verify(source, target, room_id, late))
+
+    def test_cleanup_copies_messages_only_the_old_shard_has(self):
+        room_id = 8000
+        old = self.placement.shard_of(room_id)
+        sent = self.send(room_id, 5)
+        job = self.start(room_id)
+        with self.reshard.connect(old) as source, self.reshard.connect(NEW_SHARD) as target:
+            self.reshard.copy_history(self.meta, source, target, job, 100, self.reshard.Throttle(0))
+        job = self.reshard.set_state(self.meta, self.route(room_id), "flipped")
+        self.reshard.set_state(self.meta, job, "cleanup")
+        # a dual write whose second commit failed: after the verified ids, old shard only
+        message = self.models.new_message(self.models.new_message_id(room_id, old), room_id, 7, "lost", "alice")
+        self.models.execute_query(*self.models.insert_messages_statement([message]), shard=old)
+        self.finish()
+        self.assertEqual(message_ids(NEW_SHARD, room_id), sent + [message["id"]])
+        self.assertEqual(message_ids(old, room_id), [])
+
+    def test_resume_after_kill(self):
+        room_id = 9000
+        old = self.placement.shard_of(room_id)
+        sent = self.send(room_id, 200)
+        script = (
+            "import sys, reshard; reshard.GRACE_SECONDS = 0; "
+            f"sys.argv = ['reshard.py', 'move', '--rooms', '{room_id}', '--to', '{NEW_SHARD}', "
+            "'--batch-rows', '10', '--max-rows-per-sec', '40']; reshard.main()"
+        )
+        move = subprocess.Popen([sys.executable, "-c", script], cwd=local_shards.APP_DIR, stdout=subprocess.DEVNULL)
+        try:
+            deadline = time.monotonic() + 10
+            while time.monotonic() < deadline:
+                route = self.route(room_id)
+                if route and route["copied_up_to"]:
+                    break
+                time.sleep(0.05)
+        finally:
+            move.kill()
+            move.wait()
+        route = self.route(room_id)
+        self.assertEqual(route["state"], "dual")
+        self.assertTrue(0 < route["copied_up_to"] < sent[-1])
+
+        throttle = self.reshard.Throttle(0)
+        self.reshard.run_move(self.meta, route, 1000, throttle)
+        self.shard_routes.reload_routes()
+        self.assertEqual(self.route(room_id)["state"], "done")
+        self.assertEqual(message_ids(NEW_SHARD, room_id), sent)
+        self.assertEqual(message_ids(old, room_id), [])
+        # rows moved by the resumed run: the rest of the copy (not all of it again), then every delete
+        self.assertLess(throttle.rows, 2 * len(sent))
+
+    def test_proxy_refuses_moved_rooms(self):
+        room_id, other = 10000, 10001
+        self.start(room_id)
+        try:
+            shard_routes, models = local_shards.load_app("shard_routes", "models", routing="proxy")
+            with self.assertRaises(ValueError):
+                shard_routes.check_routing()
+            with self.assertRaises(ValueError):
+                models.message_shard(room_id)
+            self.assertEqual(models.message_shard(other), self.placement.shard_of(other))
+        finally:
+            self.load()
+            self.finish()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+"""
+Room Buffer Test - buffer message terbaru per room (cache.py) dan listener NOTIFY
+Memeriksa bahwa sync (after) tidak dijawab dari buffer yang bisa terlewat
+message worker lain:
+- notifikasi yang hilang (listener putus) lalu append lokal tidak memajukan
+  cursor sync melewati message yang hilang
+- tanpa listener (DB_NOTIFY=false) sync selalu dibaca dari database
+- listener yang (re)connect membuang semua buffer sebelum lanjut
+
+Dijalankan untuk kedua aplikasi (single_database dan multiple_database), tanpa database:
+    python test/test_room_buffer.py   (atau: python -m pytest test/test_room_buffer.py)
+"""
+
+import importlib
+import os
+import sys
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+
+import psycopg
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def load(tree, *names):
+    """Import fresh modules of one app"""
+    for name in ("config", "cache", "db", "notify"):
+        sys.modules.pop(name, None)
+    sys.path.insert(0, os.path.join(ROOT, tree))
+    try:
+        return [importlib.import_module(name) for name in names]
+    finally:
+        sys.path.pop(0)
+
+
+def message(message_id, room_id=1):
+    return {
+        "id": message_id,
+        "room_id": room_id,
+        "sender_id": 7,
+        "content": f"message {message_id}",
+        "created_at": datetime(2025, 1, 1, 12, 0, message_id % 60),
+        "sender_name": "alice",
+    }
+
+
+class Stop(Exception):
+    """Ends the listener loop under test"""
+
+
+class FakeListenConnection:
+    """A LISTEN connection that delivers `payloads`, then drops"""
+
+    def __init__(self, payloads):
+        self.payloads = payloads
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, statement):
+        pass
+
+    def notifies(self):
+        for payload in self.payloads:
+            yield SimpleNamespace(payload=payload)
+        raise psycopg.OperationalError("connection lost")
+
+
+class RoomBufferTests:
+    """Tests run against cache.py and notify.py of the app in `tree`"""
+    tree = None
+
+    def setUp(self):
+        self.cache, self.notify = load(self.tree, "cache", "notify")
+
+    def ids(self, page):
+        return None if page is None else [msg["id"] for msg in page]
+
+    def sync(self, after, room_id=1):
+        return self.ids(self.cache.get_room_page(room_id, 50, after=after))
+
+    def test_lost_notification_then_local_append(self):
+        self.cache.follow_messages(True)
+        self.cache.set_room_buffer(1, [message(1), message(2)], complete=True)
+        self.assertEqual(self.sync(2), [])
+        self.cache.follow_messages(False)  # listener drops: message 3 of another worker is never heard of
+        self.cache.append_room_message(1, message(4))  # a local append
+        self.assertIsNone(self.sync(2))  # read from the database, which has 3
+        self.assertEqual(self.ids(self.cache.get_room_page(1, 2)), [2, 4])  # latest pages may still use it
+
+    def test_sync_skips_buffers_without_listener(self):
+        self.cache.set_room_buffer(1, [message(1), message(2)], complete=True)
+        self.assertIsNone(self.sync(1))
+        self.assertEqual(self.ids(self.cache.get_room_page(1, 50)), [1, 2])
+
+    def test_reconnect_drops_buffers(self):
+        self.cache.follow_messages(True)
+        self.cache.set_room_buffer(1, [message(1)], complete=True)
+        self.cache.follow_messages(False)
+        self.cache.follow_messages(True)
+        self.assertFalse(self.cache.has_room_buffer(1))
+
+    def test_listener_follows_while_connected(self):
+        following = []
+        self.notify.add_handler(lambda room_id, message_id: following.append(self.cache.follows_messages()))
+        connections = iter([FakeListenConnection(["1:3"]), FakeListenConnection(["1:4"])])
+        self.notify.connect = lambda: next(connections)
+        self.cache.set_room_buffer(1, [message(1)], complete=True)
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(self.cache.follows_messages())
+            self.cache.set_room_buffer(1, [message(1)], complete=True)  # filled while disconnected
+            if len(sleeps) == 2:
+                raise Stop()
+
+        self.notify.time = SimpleNamespace(sleep=sleep)
+        if self.tree == "single_database":
+            self.notify.psycopg = SimpleNamespace(connect=lambda **kwargs: self.notify.connect(), Error=psycopg.Error)
+        with self.assertRaises(Stop):
+            self.notify._listen_forever()
+        self.assertEqual(following, [True, True])
+        self.assertEqual(sleeps, [False, False])
+        self.assertTrue(self.cache.has_room_buffer(1))
+        self.cache.follow_messages(True)
+        self.assertFalse(self.cache.has_room_buffer(1))
+
+
+class SingleDatabaseRoomBufferTest(RoomBufferTests, unittest.TestCase):
+    tree = "single_database"
+
+
+class MultipleDatabaseRoomBufferTest(RoomBufferTests, unittest.TestCase):
+    tree = "multiple_database"
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,229 @@
+"""
+Shared Cache Test - shared_cache.py dengan backend memory:// (tanpa Redis)
+Memeriksa bahwa pengisian cache dari hasil query yang sudah basi (dibaca
+sebelum sebuah write commit) tidak menghapus write-through yang sudah jalan:
+- recent messages: message yang di-append tetap ada setelah fill basi
+- recent messages: satu member per id walaupun row fill tidak punya sender_name
+- recent messages: history dianggap lengkap hanya dari fill yang lengkap
+- membership: room yang baru ditinggalkan tidak kembali oleh fill basi
+- membership: leave yang gagal ditulis dicoba ulang, dan sampai berhasil set
+  room user tidak dibaca dari shared cache
+
+Dijalankan untuk kedua aplikasi (single_database dan multiple_database):
+    python test/test_shared_cache.py   (atau: python -m pytest test/test_shared_cache.py)
+"""
+
+import importlib
+import os
+import sys
+import time
+import unittest
+from datetime import datetime
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BUFFER_SIZE = 5
+
+
+def load_shared_cache(tree):
+    """Import shared_cache.py of one app with a fresh memory:// client"""
+    os.environ["SHARED_CACHE_URL"] = "memory://"
+    os.environ["ROOM_BUFFER_SIZE"] = str(BUFFER_SIZE)
+    for name in ("config", "shared_cache"):
+        sys.modules.pop(name, None)
+    sys.path.insert(0, os.path.join(ROOT, tree))
+    try:
+        return importlib.import_module("shared_cache")
+    finally:
+        sys.path.pop(0)
+
+
+def message(message_id, room_id=1, named=True):
+    """A message row; named=False is a row read from a shard (no sender_name)"""
+    row = {
+        "id": message_id,
+        "room_id": room_id,
+        "sender_id": 7,
+        "content": f"message {message_id}",
+        "created_at": datetime(2025, 1, 1, 12, 0, message_id % 60),
+    }
+    if named:
+        row["sender_name"] = "alice"
+    return row
+
+
+class SharedCacheTests:
+    """Tests run against shared_cache.py of the app in `tree`"""
+    tree = None
+
+    def setUp(self):
+        self.shared_cache = load_shared_cache(self.tree)
+
+    def cached(self, room_id=1):
+        return self.shared_cache.get_many(recent_messages=[room_id])[3].get(room_id)
+
+    def recent(self, room_id=1):
+        recent = self.cached(room_id)
+        return None if recent is None else [msg["id"] for msg in recent[0]]
+
+    def complete(self, room_id=1):
+        return self.cached(room_id)[1]
+
+    def member_rooms(self, user_id=7):
+        return self.shared_cache.get_many(member_rooms=[user_id])[2].get(user_id)
+
+    # ============ RECENT MESSAGES ============
+
+    def test_fill_and_append(self):
+        self.shared_cache.set_recent_messages(1, [message(1), message(2)])
+        self.shared_cache.append_recent_message(1, message(3))
+        self.assertEqual(self.recent(), [1, 2, 3])
+
+    def test_stale_fill_keeps_appended_message(self):
+        self.shared_cache.set_recent_messages(1, [message(1), message(2)])
+        stale = [message(1), message(2)]  # read before message 3 committed
+        self.shared_cache.append_recent_message(1, message(3))
+        self.shared_cache.set_recent_messages(1, stale)
+        self.assertEqual(self.recent(), [1, 2, 3])
+
+    def test_stale_fill_of_uncached_room_keeps_appended_message(self):
+        stale = [message(1), message(2)]
+        self.shared_cache.append_recent_message(1, message(3))
+        self.shared_cache.set_recent_messages(1, stale)
+        self.assertEqual(self.recent(), [1, 2, 3])
+
+    def test_appends_alone_are_not_a_hit(self):
+        self.shared_cache.append_recent_message(1, message(3))
+        self.assertIsNone(self.recent())
+
+    def test_appends_after_eviction_are_not_a_hit(self):
+        self.shared_cache.set_recent_messages(1, [message(1), message(2)])
+        self.shared_cache.get_client().delete(self.shared_cache.recent_messages_key(1))  # evicted
+        self.shared_cache.append_recent_message(1, message(3))
+        self.assertIsNone(self.recent())
+
+    def test_keeps_newest_messages(self):
+        self.shared_cache.set_recent_messages(1, [message(i) for i in range(1, 4)])
+        for message_id in range(4, 10):
+            self.shared_cache.append_recent_message(1, message(message_id))
+        self.shared_cache.set_recent_messages(1, [message(i) for i in range(1, 4)])  # stale fill
+        self.assertEqual(self.recent(), list(range(10 - BUFFER_SIZE, 10)))
+
+    def test_deleted_messages_drop_the_room(self):
+        self.shared_cache.set_recent_messages(1, [message(1), message(2)])
+        self.shared_cache.write(self.shared_cache.delete_recent_messages_commands(1))
+        self.shared_cache.append_recent_message(1, message(3))
+        self.assertIsNone(self.recent())
+
+    def test_fill_without_sender_names_after_appends(self):
+        for message_id in range(3, 6):
+            self.shared_cache.append_recent_message(1, message(message_id))
+        self.shared_cache.set_recent_messages(1, [message(i, named=False) for i in range(1, 6)], complete=True)
+        self.assertEqual(self.recent(), [1, 2, 3, 4, 5])
+        self.assertEqual(len(self.shared_cache.get_client().zrange(self.shared_cache.recent_messages_key(1), 0, -1)), 5)
+        self.assertTrue(self.complete())
+        self.shared_cache.append_recent_message(1, message(5))  # the same message again, named
+        self.shared_cache.append_recent_message(1, message(6))
+        self.assertEqual(self.recent(), [2, 3, 4, 5, 6])
+
+    def test_complete_only_from_a_complete_fill(self):
+        self.shared_cache.set_recent_messages(1, [message(1), message(2)], complete=True)
+        self.assertTrue(self.complete())
+        self.shared_cache.set_recent_messages(2, [message(i, 2) for i in range(3, 8)])
+        self.assertFalse(self.complete(2))  # as many as the buffer holds: older ones may exist
+        self.shared_cache.set_recent_messages(1, [message(i) for i in range(1, 8)], complete=True)
+        self.assertFalse(self.complete())  # more than fits: trimmed by the fill itself
+
+    def test_trimmed_complete_fill_is_not_complete(self):
+        self.shared_cache.set_recent_messages(1, [message(1), message(2), message(3)], complete=True)
+        for message_id in range(4, 7):
+            self.assertTrue(self.complete())
+            self.shared_cache.append_recent_message(1, message(message_id))
+        self.assertEqual(self.recent(), [2, 3, 4, 5, 6])
+        self.assertFalse(self.complete())
+
+    # ============ MEMBERSHIP ============
+
+    def test_fill_join_leave(self):
+        self.shared_cache.set_member_rooms(7, [1, 2])
+        self.shared_cache.add_member_room(7, 3)
+        self.assertEqual(self.member_rooms(), {1, 2, 3})
+        self.shared_cache.remove_member_room(7, 1)
+        self.assertIsNone(self.member_rooms())  # read again from the database
+        self.shared_cache.set_member_rooms(7, [2, 3])
+        self.assertEqual(self.member_rooms(), {2, 3})
+
+    def test_failed_leave_is_retried(self):
+        self.shared_cache.set_member_rooms(7, [1, 2])
+        execute = self.shared_cache.execute
+
+        def down(commands, transaction=False):
+            raise ConnectionError("shared cache down")
+
+        self.shared_cache.execute = down
+        self.shared_cache.remove_member_room(7, 1)
+        self.shared_cache.execute = execute
+        self.assertEqual(self.shared_cache.get_client().smembers(self.shared_cache.member_rooms_key(7)), {1, 2})
+        self.assertIsNone(self.member_rooms())  # not trusted until the leave lands
+        deadline = time.monotonic() + 5
+        while self.shared_cache.get_shared_cache_stats()["undropped"] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.shared_cache.get_shared_cache_stats()["undropped"], 0)
+        self.assertEqual(self.shared_cache.get_client().smembers(self.shared_cache.member_rooms_key(7)), set())
+        self.shared_cache.set_member_rooms(7, [1, 2])  # a stale read
+        self.assertEqual(self.member_rooms(), {2})
+
+    def test_stale_fill_does_not_bring_back_left_room(self):
+        self.shared_cache.set_member_rooms(7, [1, 2])
+        stale = [1, 2]  # read before the user left room 1
+        self.shared_cache.remove_member_room(7, 1)
+        self.shared_cache.set_member_rooms(7, stale)
+        self.assertEqual(self.member_rooms(), {2})
+
+    def test_rejoined_room_is_kept(self):
+        self.shared_cache.remove_member_room(7, 1)
+        self.shared_cache.add_member_room(7, 1)
+        self.shared_cache.set_member_rooms(7, [1, 2])
+        self.assertEqual(self.member_rooms(), {1, 2})
+
+    def test_stale_fill_of_only_left_rooms_is_not_a_hit(self):
+        self.shared_cache.remove_member_room(7, 1)
+        self.shared_cache.set_member_rooms(7, [1])
+        self.assertIsNone(self.member_rooms())
+
+    # ============ IN-PROCESS STAND-IN ============
+
+    def test_sorted_set_ranks_by_score(self):
+        client = self.shared_cache.MemoryClient()
+        client.zadd("z", {"c": 3, "a": 1, "b": 2})
+        self.assertEqual(client.zrange("z", 0, -1), ["a", "b", "c"])
+        self.assertEqual(client.zremrangebyrank("z", 0, -4), 0)
+        self.assertEqual(client.zremrangebyrank("z", 0, -3), 1)
+        self.assertEqual(client.zrange("z", 0, -1), ["b", "c"])
+
+    def test_sorted_set_removes_by_score(self):
+        client = self.shared_cache.MemoryClient()
+        client.zadd("z", {"a": 1, "a'": 1, "b": 2, "c": 3})
+        self.assertEqual(client.zremrangebyscore("z", 1, 2), 3)
+        self.assertEqual(client.zrange("z", 0, -1), ["c"])
+
+    def test_sdiffstore_replaces_destination(self):
+        client = self.shared_cache.MemoryClient()
+        client.sadd("a", 1, 2, 3)
+        client.sadd("b", 2)
+        self.assertEqual(client.sdiffstore("a", "a", "b", "missing"), 2)
+        self.assertEqual(client.smembers("a"), {1, 3})
+        client.sadd("c", 1)
+        self.assertEqual(client.sdiffstore("a", "c", "c"), 0)
+        self.assertEqual(client.smembers("a"), set())
+
+
+class SingleDatabaseSharedCacheTest(SharedCacheTests, unittest.TestCase):
+    tree = "single_database"
+
+
+class MultipleDatabaseSharedCacheTest(SharedCacheTests, unittest.TestCase):
+    tree = "multiple_database"
+
+
+if __name__ == "__main__":
+    unittest.main()
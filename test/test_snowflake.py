@@ -0,0 +1,130 @@
+"""
+Snowflake Test - id pesan multiple_database (snowflake.py) tanpa database
+Lease worker id diberi baris palsu dan jam diganti untuk memeriksa:
+- susunan bit id (waktu, shard, worker, sequence) dan decode_id
+- sequence yang habis meminjam milidetik berikutnya
+- jam yang mundur tidak membuat id turun
+- batas bawah (id terbaru room) dilewati
+- lease worker id: diambil sebelum id pertama, diambil ulang setelah habis
+  atau diambil alih, dan dimulai setelah last_ms pemegang sebelumnya
+
+Dijalankan tanpa database:
+    python test/test_snowflake.py   (atau: python -m pytest test/test_snowflake.py)
+"""
+
+import importlib
+import os
+import sys
+import time
+import unittest
+from types import SimpleNamespace
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+NOW_MS = 40_000_000_000  # about 15 months after EPOCH_MS
+
+
+def load_snowflake():
+    """Import a fresh snowflake.py of multiple_database"""
+    for name in ("config", "db", "snowflake"):
+        sys.modules.pop(name, None)
+    sys.path.insert(0, os.path.join(ROOT, "multiple_database"))
+    try:
+        return importlib.import_module("snowflake")
+    finally:
+        sys.path.pop(0)
+
+
+class Stop(Exception):
+    """Ends the lease renewer under test"""
+
+
+class SnowflakeTest(unittest.TestCase):
+    def setUp(self):
+        self.snowflake = load_snowflake()
+        self.now = NOW_MS
+        self.snowflake.now_ms = lambda: self.now
+        self.snowflake._start_renewer = lambda: None
+        self.leases = [{"worker_id": 5, "last_ms": 0}]
+        self.snowflake.execute_detached = self.execute_detached
+
+    def execute_detached(self, query, params, **kwargs):
+        """id_workers on the metadata node: hands out self.leases in turn"""
+        return self.leases.pop(0) if self.leases else None
+
+    def parts(self, message_id):
+        parts = self.snowflake.decode_id(message_id)
+        return parts["shard"], parts["worker_id"], parts["sequence"], message_id >> self.snowflake.TIME_SHIFT
+
+    def test_bit_layout(self):
+        sf = self.snowflake
+        message_id = sf.make_id(NOW_MS, 3, 77, 1000)
+        self.assertEqual(message_id, (NOW_MS << 22) | (3 << 17) | (77 << 10) | 1000)
+        self.assertEqual(self.parts(message_id), (3, 77, 1000, NOW_MS))
+        self.assertEqual(sf.message_id_shard(message_id), 3)
+        self.assertEqual(sf.decode_id(message_id)["created_at"].timestamp() * 1000, NOW_MS + sf.EPOCH_MS)
+        self.assertGreaterEqual(sf.make_id(50 * 24 * 3600 * 1000, 0, 0, 0), sf.MIN_ID)
+        self.assertIsNone(sf.decode_id(12345))  # an id from id_blocks
+        self.assertEqual(sf.make_id(1, sf.MAX_SHARDS - 1, sf.MAX_WORKERS - 1, sf.MAX_SEQUENCE), (2 << 22) - 1)
+
+    def test_sequence_rollover_borrows_next_ms(self):
+        ids = [self.snowflake.next_id(2) for _ in range(self.snowflake.MAX_SEQUENCE + 3)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(self.parts(ids[0]), (2, 5, 0, NOW_MS))
+        self.assertEqual(self.parts(ids[-3]), (2, 5, self.snowflake.MAX_SEQUENCE, NOW_MS))
+        self.assertEqual(self.parts(ids[-2]), (2, 5, 0, NOW_MS + 1))
+        self.assertEqual(self.parts(ids[-1]), (2, 5, 1, NOW_MS + 1))
+        self.assertEqual(self.snowflake.get_snowflake_stats()["borrowed_ms"], 1)
+
+    def test_clock_going_back_keeps_last_ms(self):
+        first = self.snowflake.next_id(0)
+        self.now -= 1000  # the clock is stepped back
+        second = self.snowflake.next_id(0)
+        self.now += 1001
+        third = self.snowflake.next_id(0)
+        self.assertLess(first, second)
+        self.assertLess(second, third)
+        self.assertEqual(self.parts(second)[2:], (1, NOW_MS))
+        self.assertEqual(self.parts(third)[2:], (0, NOW_MS + 1))
+
+    def test_floor_from_a_clock_ahead(self):
+        floor = self.snowflake.make_id(NOW_MS + 20, 1, 9, 4)
+        message_id = self.snowflake.next_id(0, floor)
+        self.assertGreater(message_id, floor)
+        self.assertEqual(self.parts(message_id), (0, 5, 0, NOW_MS + 21))
+        self.assertLess(self.snowflake.next_id(0, self.snowflake.make_id(NOW_MS, 1, 9, 4)), self.snowflake.next_id(0))
+        self.assertEqual(self.snowflake.get_snowflake_stats()["floor_raises"], 1)
+
+    def test_lease_starts_after_last_holder(self):
+        self.leases = [{"worker_id": 8, "last_ms": NOW_MS + 50}]
+        self.assertEqual(self.parts(self.snowflake.next_id(1)), (1, 8, 0, NOW_MS + 51))
+
+    def test_expired_lease_is_taken_again(self):
+        self.leases.append({"worker_id": 6, "last_ms": 0})
+        self.assertEqual(self.parts(self.snowflake.next_id(0))[1], 5)
+        self.snowflake._lease_deadline = time.monotonic() - 1  # could not renew in time
+        last = self.snowflake.next_id(0)
+        self.assertEqual(self.parts(last)[1], 6)
+        self.assertEqual(self.snowflake.get_snowflake_stats()["leases"], 2)
+        self.snowflake._lease_deadline = 0
+        with self.assertRaises(LookupError):  # every worker id is leased
+            self.snowflake.next_id(0)
+
+    def test_renewer_drops_a_lease_taken_over(self):
+        self.snowflake.next_id(0)
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 2:
+                raise Stop()
+
+        self.snowflake.time = SimpleNamespace(sleep=sleep, monotonic=time.monotonic, time=time.time)
+        self.leases = [None]  # RENEW_WORKER_SQL: another owner holds it now
+        with self.assertRaises(Stop):
+            self.snowflake._renew_forever()
+        self.assertIsNone(self.snowflake._worker)
+        self.assertTrue(self.snowflake.lease_expired())
+
+
+if __name__ == "__main__":
+    unittest.main()